@@ -0,0 +1,15 @@
+"""
+Files replaced whole.  The index, estimate and tuning caches and the metrics file are
+written to a temporary file that is then swapped in, so a crash leaves the old file or the
+new one and never a truncated one.
+"""
+
+import os
+
+
+def write_atomic(path: str, text: str):
+    """replace the file at path with text in one step"""
+    temp = path + '.tmp'
+    with open(temp, 'w') as f:
+        f.write(text)
+    os.replace(temp, path)
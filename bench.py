@@ -0,0 +1,245 @@
+#! /usr/bin/env python3
+
+"""
+Upload benchmark.  Generates synthetic gcode files and uploads them with MarlinClient to a
+MarlinHost for each combination of size, mode and noise level, then writes the results to a
+JSON file so runs from different commits can be compared.
+
+Noise is applied while the file data is transferred, the commands that open and close the
+file have no error recovery.  With --baud the upload runs over a simulated serial line on a
+virtual clock and link_seconds is the time it would take on a real one.  Every case runs in
+a fresh process so peak_rss_mb is the peak of that case alone, interpreter and file included.
+"""
+
+import sys
+import json
+import time
+import random
+import platform
+import resource
+import subprocess
+import multiprocessing
+from argparse import ArgumentParser
+
+import mock
+import protocol
+from clock import VirtualClock
+from client import MarlinClient
+from gcode import strip_comments
+from stream import iter_lines
+
+DEFAULT_SIZES = '1K,10K,100K,1M,10M,100M'
+DEFAULT_MODES = 'raw,line,binary'
+DEFAULT_NOISE = '0,0.01,0.1'
+DEFAULT_OUTPUT = 'bench_results.json'
+UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_size(text: str) -> int:
+    text = text.strip().upper()
+    if text[-1:] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+
+    return int(text)
+
+
+def generate_gcode(size: int, seed: int = 0) -> bytes:
+    """return about size bytes of slicer-like gcode: layers of extrusion moves with comments,
+    travel moves and retractions"""
+    rand = random.Random(seed)
+    chunks = [b'; generated by marser bench\nG28\nG90\nM82\nG92 E0\n']
+    total = len(chunks[0])
+    e = 0.0
+    layer = 0
+
+    while total < size:
+        layer += 1
+        lines = [b';LAYER:%d\nG0 F9000 X%.3f Y%.3f Z%.2f\n' % (
+            layer, rand.uniform(0, 200), rand.uniform(0, 200), layer * 0.2)]
+        for _ in range(200):
+            e += rand.uniform(0.01, 0.5)
+            lines.append(b'G1 F1800 X%.3f Y%.3f E%.5f\n' % (
+                rand.uniform(0, 200), rand.uniform(0, 200), e))
+        lines.append(b'G1 F2400 E%.5f ; retract\n' % (e - 1))
+        chunk = b''.join(lines)
+        chunks.append(chunk)
+        total += len(chunk)
+
+    data = b''.join(chunks)[:size]
+
+    return data[:data.rfind(b'\n') + 1] if size > 64 else data
+
+
+def sent_content(data: bytes, mode: str) -> bytes:
+    """what an upload of data in mode leaves on the card, line mode drops comments and blank
+    lines"""
+    if mode != 'line':
+        return data
+    lines = (strip_comments(line) for line in iter_lines([data]))
+
+    return b''.join(line + b'\n' for line in lines if line)
+
+
+def peak_rss_mb() -> float:
+    """peak resident set size of this process so far"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return rss / (1024 ** 2 if sys.platform == 'darwin' else 1024)
+
+
+def run_upload(data: bytes, mode: str, noise: float, baud: int = None, seed: int = 0) -> dict:
+    """upload data to a fresh mock printer and return the measurements"""
+    random.seed(seed)
+    host = mock.MarlinHost()
+    host.proc.capabilities[protocol.BINARY_CAPABILITY] = 1
+    clock = None
+    if baud:
+        clock = VirtualClock()
+        host.set_wire(baud, clock=clock)
+
+    # the settle time after connecting is not measured, skip it on a virtual clock
+    client = MarlinClient(clock=clock or VirtualClock())
+    client.connect(host)
+
+    # only corrupt the transfer of the file data
+    for name in ('_send_numbered', '_send_binary'):
+        send = getattr(client, name)
+
+        def noisy(*args, send=send):
+            host.error_prob['write'] = noise
+            try:
+                return send(*args)
+            finally:
+                host.error_prob['write'] = 0.0
+
+        setattr(client, name, noisy)
+    if mode == 'raw':
+        host.error_prob['write'] = noise
+
+    error = None
+    link_start = clock.time() if clock else None
+    start = time.perf_counter()
+    try:
+        client.save_file('BENCH.GCO', data, mode=mode)
+    except ValueError as e:
+        error = str(e)[:200]
+    seconds = time.perf_counter() - start
+    host.error_prob['write'] = 0.0
+
+    lines = data.count(b'\n')
+    result = {
+        'seconds': seconds,
+        'bytes_per_sec': len(data) / seconds if seconds else None,
+        'lines_per_sec': lines / seconds if seconds else None,
+        'resends': client.resends,
+        'peak_rss_mb': peak_rss_mb(),
+        'verified': (error is None and
+                     bytes(host.proc.files.get('BENCH.GCO', b'')) == sent_content(data, mode)),
+        'error': error,
+    }
+    if clock:
+        result['link_seconds'] = clock.time() - link_start
+
+    return result
+
+
+def run_case(size: int, mode: str, noise: float, baud: int = None, n: int = 0) -> dict:
+    """generate a file of size bytes and upload it, the n-th run of the case"""
+    data = generate_gcode(size)
+    result = {'size': len(data), 'lines': data.count(b'\n'), 'mode': mode, 'noise': noise,
+              'baud': baud, 'run': n}
+    result.update(run_upload(data, mode, noise, baud, seed=n))
+
+    return result
+
+
+def run(sizes, modes, noises, baud: int = None, repeat: int = 1, log=print) -> list:
+    results = []
+    # spawn rather than fork, a forked process starts with the memory of this one
+    context = multiprocessing.get_context('spawn')
+    for size in sizes:
+        for mode in modes:
+            for noise in noises:
+                for n in range(repeat):
+                    with context.Pool(1) as pool:
+                        result = pool.apply(run_case, (size, mode, noise, baud, n))
+                    results.append(result)
+                    log(format_result(result))
+
+    return results
+
+
+def format_result(result: dict) -> str:
+    rate = result['bytes_per_sec']
+    text = (f"{result['size']:>11} {result['mode']:>6} noise {result['noise']:<5} "
+            f"{result['seconds']:8.3f}s {rate / 1024 if rate else 0:10.1f} KiB/s "
+            f"resends {result['resends']:<6} rss {result['peak_rss_mb']:7.1f} MB")
+    if 'link_seconds' in result:
+        text += f" link {result['link_seconds']:8.2f}s"
+    if not result['verified']:
+        text += f" FAILED {result['error'] or 'content mismatch'}"
+
+    return text
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def case_key(result: dict) -> tuple:
+    return result['size'], result['mode'], result['noise'], result['baud'], result['run']
+
+
+def compare(results: list, baseline: list, log=print):
+    """log the speed of each result relative to the matching baseline result"""
+    previous = {case_key(r): r for r in baseline}
+    for result in results:
+        old = previous.get(case_key(result))
+        if old and old['bytes_per_sec'] and result['bytes_per_sec']:
+            ratio = result['bytes_per_sec'] / old['bytes_per_sec']
+            log(f"{result['size']:>11} {result['mode']:>6} noise {result['noise']:<5} "
+                f"{ratio:6.2f}x")
+
+
+def parse_args(argv):
+    parser = ArgumentParser(prog='bench', description='Marlin upload benchmark')
+    parser.add_argument('-s', '--sizes', default=DEFAULT_SIZES, help=f'file sizes ({DEFAULT_SIZES})')
+    parser.add_argument('-m', '--modes', default=DEFAULT_MODES, help=f'upload modes ({DEFAULT_MODES})')
+    parser.add_argument('-n', '--noise', default=DEFAULT_NOISE,
+                        help=f'write error probabilities ({DEFAULT_NOISE})')
+    parser.add_argument('-b', '--baud', type=int, default=None, help='simulate a serial line')
+    parser.add_argument('-r', '--repeat', type=int, default=1, help='runs per case')
+    parser.add_argument('-o', '--output', default=DEFAULT_OUTPUT, help=f'results file ({DEFAULT_OUTPUT})')
+    parser.add_argument('-c', '--compare', default=None, help='results file to compare against')
+
+    return parser.parse_args(args=argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    sizes = [parse_size(size) for size in args.sizes.split(',')]
+    modes = args.modes.split(',')
+    noises = [float(noise) for noise in args.noise.split(',')]
+
+    results = run(sizes, modes, noises, args.baud, args.repeat)
+    report = {
+        'commit': git_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f)['results'])
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,32 +1,181 @@
 
-import time
+import zlib
+import asyncio
+from collections import deque
+
+import protocol
+import tune
+from clock import Clock
+from gcode import strip_comments
+from metrics import command_code
+from stream import BLOCK_SIZE, iter_chunks, iter_lines
+from telemetry import SD_BYTES, Telemetry
+
+# hotend and bed temperatures by material
+MATERIALS = {
+    'PLA': (210, 60),
+    'PETG': (240, 80),
+    'ABS': (250, 100),
+    'TPU': (225, 50),
+}
+# degrees from the target a heater counts as heated
+TEMPERATURE_TOLERANCE = 2.0
+
+
+def material_temperatures(material: str) -> tuple:
+    try:
+        return MATERIALS[material.upper()]
+    except KeyError:
+        raise ValueError(f'unknown material: {material}')
+
+
+class Reply(bytes):
+    """the reply to a command, equal to its text: the lines up to and including the one that
+    ended it with reports left out.  terminator is the kind of that line, 'ok' or 'done', or
+    None if the port timed out first.  sent and received are clock times"""
+
+    def __new__(cls, lines: list, terminator: str = None, sent: float = None,
+                received: float = None):
+        reply = super().__new__(cls, b''.join(lines))
+        reply.lines = lines
+        reply.terminator = terminator
+        reply.sent = sent
+        reply.received = received
+
+        return reply
+
+    @property
+    def complete(self) -> bool:
+        return self.terminator is not None
+
+    @property
+    def latency(self):
+        if self.sent is None or self.received is None:
+            return None
+        return self.received - self.sent
+
+    @property
+    def errors(self) -> list:
+        return [line for line in self.lines if line.startswith(b'Error:')]
+
+    @property
+    def resend(self):
+        """the line number the firmware asked for, None if it did not"""
+        for line in self.lines:
+            if line.startswith(b'Resend:'):
+                return protocol.parse_resend(line)
 
 
 class MarlinClient:
-    FILTERS = [
-        b'echo:busy: processing',
-        b'echo:Now fresh file:',
-    ]
+    # the kinds of line that end the reply to a command by command code, ok for the rest.
+    # M29 closing a file is answered with 'Done saving file.' and no ok, with no file open
+    # with a plain ok.  an ok after the done would end the reply to the next command
+    TERMINATORS = {
+        'M29': ('done', 'ok'),
+    }
+    # prefixes of the reports that answer a command and are part of its reply
+    REPLY_REPORTS = {
+        'M27': (b'SD printing byte',),
+    }
 
-    def __init__(self):
+    # consecutive timeouts tolerated while streaming numbered lines
+    MAX_TIMEOUTS = 10
+    # times the firmware may ask for the same numbered line again
+    MAX_RESENDS = 10
+
+    def __init__(self, clock=None):
         self.port = None
+        self.clock = clock or Clock()
         self.bed_temp = 0
         self.hotend_temp = 0
+        self.bed_target = 0
+        self.hotend_target = 0
+        self.resends = 0
+        self._capabilities = None
+        # free firmware slots from the last advanced ok, None if not reported
+        self.planner_free = None
+        self.buffer_free = None
+        self.telemetry = Telemetry(clock=self.clock)
+        # a metrics.Metrics to instrument the connection
+        self.metrics = None
+        # a tune.LinkTuner to size transfers from the errors seen
+        self.tuner = None
+        self.report_hooks = {report: [] for report in protocol.REPORTS}
 
-    def _process_line(self, line: bytes):
-        line.replace(b'\r', b'')
-        if line.startswith(b'T:'):
-            return
-        elif any(line.startswith(x) for x in self.FILTERS):
-            return
+    def add_report_hook(self, report: str, hook):
+        """call hook with every 'temperature', 'progress' or 'busy' report line"""
+        self.report_hooks[report].append(hook)
+
+    def remove_report_hook(self, report: str, hook):
+        self.report_hooks[report].remove(hook)
+
+    def _sort_line(self, line: bytes, keep: tuple = ()):
+        """classify a line read from the port and record the reports in it.  returns its kind
+        and the line without carriage returns, or None for the line of a report that is not
+        part of the reply to the command.  keep holds the prefixes of reports that are"""
+        line = line.replace(b'\r', b'')
+        kind = protocol.classify(line)
+        if kind is None:
+            return None, line
+
+        if kind in ('ok', 'temperature', 'progress') and self.telemetry.feed(line):
+            self.hotend_temp = self.telemetry.latest('hotend') or 0
+            self.bed_temp = self.telemetry.latest('bed') or 0
+        if kind not in protocol.REPORTS and kind != 'notice' or keep and line.startswith(keep):
+            return kind, line
+
+        for hook in self.report_hooks.get(kind, ()):
+            hook(line)
+        if self.metrics:
+            self.metrics.line_filtered()
+
+        return kind, None
+
+    def _write(self, data: bytes):
+        self.port.write(data)
+        if self.metrics:
+            self.metrics.sent(len(data))
+
+    def _readline(self) -> bytes:
+        line = self.port.readline()
+        if self.metrics and line:
+            self.metrics.received(len(line))
 
         return line
 
-    def connect(self, port):
+    def _retry(self, kind: str):
+        self.resends += 1
+        if self.metrics:
+            self.metrics.retry(kind)
+        if self.tuner:
+            self.tuner.failed()
+
+    def command(self, command: str) -> Reply:
+        """send a command and return the reply"""
+        line = command.encode() + b'\n'
+        code = command_code(line)
+        if self.metrics:
+            self.metrics.command_sent(code, line)
+        sent = self.clock.time()
+        self._write(line)
+        reply = self.read_reply(self.TERMINATORS.get(code, ('ok',)),
+                                self.REPLY_REPORTS.get(code, ()), sent)
+        if self.metrics:
+            self.metrics.reply_received(code, reply, reply.latency)
+
+        return reply
+
+    def connect(self, port, reset: bool = True):
+        """attach to the firmware on port.  opening a serial port usually resets the board so
+        by default wait for it to boot.  without reset the firmware is expected to be running
+        already, see resume"""
         self.port = port
+        self.port.timeout = 2
+        if not reset:
+            self.resume()
+            return
 
         # look for start
-        self.port.timeout = 2
         response = self.port.readline()
         if response != b'start\n':
             raise RuntimeError(f'start expected: {response}')
@@ -36,53 +185,409 @@ class MarlinClient:
             response = self.port.readline()
 
         # wait to settle down
-        time.sleep(0.5)
+        self.clock.sleep(0.5)
         port.reset_input_buffer()
 
-    def readall(self):
-        out_data = b''
+    def resume(self):
+        """pick up a connection to running firmware without resetting the board.  output
+        left from an earlier session is dropped and a file left open by an interrupted upload
+        is closed, the firmware would write the commands that follow into it.  raises
+        ConnectionError if the firmware does not answer"""
+        self.port.reset_input_buffer()
+        self._write(b'M29\n')
+        self.read_reply(self.TERMINATORS['M29'])
+        if not self.ping():
+            raise ConnectionError('no reply from firmware')
+
+    def reset(self):
+        """reset the board by pulsing DTR and wait for the firmware to boot"""
+        self.port.dtr = False
+        self.clock.sleep(0.1)
+        self.port.dtr = True
+        self.connect(self.port)
+
+    def ping(self) -> bool:
+        """cheap health check, whether the firmware answers M105"""
+        try:
+            self.report_temperatures()
+        except (OSError, ValueError):
+            return False
 
+        return True
+
+    def read_reply(self, terminators: tuple = ('ok',), keep: tuple = (),
+                   sent: float = None) -> Reply:
+        """read the reply to a command up to a line of one of the terminators kinds.  reports
+        are passed to telemetry and the report hooks unless they start with a prefix in keep.
+        an error does not end a reply, the firmware follows it with an ok.  the port timeout
+        applies to every line so a firmware that reports busy can take as long as it needs"""
+        lines = []
+        terminator = None
         while True:
-            line = self.port.readline()
-            pline = self._process_line(line)
-            print(f"LINE: {repr(line)} PLINE: {repr(pline)}")
-            if pline:
-                out_data += pline
-            elif line:
-                # if we filtered something then retry
+            line = self._readline()
+            if not line:
+                break
+            kind, line = self._sort_line(line, keep)
+            if line is None:
                 continue
+            lines.append(line)
+            if kind in terminators:
+                terminator = kind
+                break
+
+        return Reply(lines, terminator, sent, self.clock.time())
+
+    def readall(self) -> Reply:
+        """read the reply to a command written to the port directly"""
+        return self.read_reply()
+
+    def _send_numbered(self, lines, window: int = None):
+        """send lines with line numbers and checksums keeping at most window lines waiting for
+        an ok, fewer if the tuner allows fewer.  window None is 4, or up to the tuner if there
+        is one.  comments and blank lines are left out, the firmware would drop the checksum
+        with a comment.  lines the firmware asks for again with Resend: are sent again from
+        history.  returns the number of the last line.  raises ValueError for a line too
+        long for the firmware's buffer or one it rejects more than MAX_RESENDS times"""
+        tuner = self.tuner
+        if window is None:
+            window = tune.MAX_WINDOW if tuner else 4
+        if window < 1:
+            raise ValueError(f'invalid window: {window}')
 
-            if not self.port.in_waiting:
+        limit = window
+        history = deque(maxlen=limit * 4)
+        pending = deque()
+        queue = deque()
+        lines = iter(lines)
+        number = 0
+        skip = 0
+        stale_oks = 0
+        timeouts = 0
+        resends = dict()
+        metrics = self.metrics
+        sent_at = dict()
+
+        while True:
+            # fill the window
+            if tuner:
+                window = min(limit, tuner.window)
+            while len(pending) < window:
+                if queue:
+                    item = queue.popleft()
+                else:
+                    line = next(lines, None)
+                    if line is None:
+                        break
+                    line = strip_comments(line)
+                    if not line:
+                        continue
+                    number += 1
+                    item = (number, protocol.number_line(number, line))
+                    if len(item[1]) > protocol.MAX_CMD_SIZE:
+                        raise ValueError(f'line {number} too long: {line[:40]!r}...')
+                    history.append(item)
+                self._write(item[1])
+                pending.append(item)
+                if metrics:
+                    metrics.command_sent(command_code(item[1]), item[1])
+                if metrics or tuner:
+                    sent_at[item[0]] = self.clock.time()
+
+            # wait for the replies to lines rejected after an error too
+            if not pending and not skip and not stale_oks:
                 break
 
-        print(f'readall: {out_data}')
-        return out_data
+            reply = self._readline()
+            if not reply and not pending:
+                break
+            elif not reply:
+                # nothing heard back, assume the lines in flight were lost
+                timeouts += 1
+                if timeouts > self.MAX_TIMEOUTS:
+                    raise ValueError(f'no response to line {pending[0][0]}')
+                self._retry('timeout')
+                queue = pending + queue
+                pending = deque()
+                skip = stale_oks = 0
+                continue
+
+            timeouts = 0
+            if reply.startswith(b'Resend:'):
+                stale_oks += 1
+                try:
+                    resend = protocol.parse_resend(reply)
+                except ValueError:
+                    continue
+                if skip:
+                    # every line in flight after a bad one is rejected too, so the requests
+                    # that follow the first one are duplicates
+                    skip -= 1
+                    continue
+                if not history or not history[0][0] <= resend <= number + 1:
+                    # garbled reply, the timeout above recovers if it was genuine
+                    continue
+
+                resends[resend] = resends.get(resend, 0) + 1
+                if resends[resend] > self.MAX_RESENDS:
+                    raise ValueError(f'line {resend} rejected {self.MAX_RESENDS} times')
+                self._retry('resend')
+                skip = max(len(pending) - 1, 0)
+                queue = deque(item for item in history if item[0] >= resend)
+                pending = deque()
+            elif reply.startswith(b'ok'):
+                # the ok following an error and resend request does not acknowledge a line
+                if stale_oks:
+                    stale_oks -= 1
+                elif pending:
+                    acked = pending.popleft()
+                    if metrics or tuner:
+                        latency = self.clock.time() - sent_at.pop(acked[0], self.clock.time())
+                    if metrics:
+                        metrics.reply_received(command_code(acked[1]), reply, latency)
+                    if tuner:
+                        tuner.acked(latency)
+
+        return number
+
+    def _send_packet(self, sequence: int, packet_type: int, payload: bytes = b'') -> bytes:
+        """send a binary transfer packet until the firmware acknowledges it and return the
+        acknowledgement"""
+        sequence &= 0xff
+        packet = protocol.encode_packet(sequence, packet_type, payload)
+        ack = b'ss%d,' % sequence if packet_type == protocol.PACKET_QUERY else b'ok%d\n' % sequence
+
+        for _ in range(self.MAX_TIMEOUTS):
+            if self.metrics:
+                self.metrics.command_sent('packet', packet)
+            started = self.clock.time()
+            self._write(packet)
+            while True:
+                reply = self._readline()
+                if reply.startswith(ack):
+                    if self.metrics:
+                        self.metrics.reply_received('packet', reply, self.clock.time() - started)
+                    if self.tuner:
+                        self.tuner.acked(self.clock.time() - started)
+                    return reply
+                if not reply or reply.startswith(b'rs'):
+                    break
+            self._retry('packet')
+
+        raise ValueError(f'no response to packet {sequence}')
+
+    def _send_binary(self, chunks, compress: bool):
+        """send a stream of chunks using the binary transfer protocol, compressed if
+        requested.  packets carry the firmware's maximum payload or what the tuner allows"""
+        reply = self._send_packet(0, protocol.PACKET_QUERY)
+        _, max_payload, compression = reply.strip().decode().split(',')
+        max_payload = int(max_payload)
+
+        compressor = None
+        packet_type = protocol.PACKET_WRITE
+        if compress and compression == 'zlib':
+            compressor = zlib.compressobj(9)
+            packet_type = protocol.PACKET_WRITE_COMPRESSED
+
+        def packet_size():
+            return self.tuner.packet_size(max_payload) if self.tuner else max_payload
+
+        sequence = 1
+        pending = bytearray()
+        for chunk in chunks:
+            pending += compressor.compress(chunk) if compressor else chunk
+            while len(pending) >= (size := packet_size()):
+                self._send_packet(sequence, packet_type, bytes(pending[:size]))
+                del pending[:size]
+                sequence += 1
+
+        if compressor:
+            pending += compressor.flush()
+        while pending:
+            size = packet_size()
+            self._send_packet(sequence, packet_type, bytes(pending[:size]))
+            del pending[:size]
+            sequence += 1
+
+        self._send_packet(sequence, protocol.PACKET_CLOSE)
+
+    def capabilities(self) -> dict:
+        """return the Cap: entries of the firmware info as a dict of name to value"""
+        if self._capabilities is None:
+            self._capabilities = dict()
+            for line in self.firmware_info().split(b'\n'):
+                if line.startswith(b'Cap:'):
+                    _, name, value = line.rstrip(b'\r').decode().split(':', 2)
+                    self._capabilities[name] = value
+
+        return self._capabilities
+
+    def can_resume(self) -> bool:
+        return self.capabilities().get('SD_RESUME') == '1'
+
+    def save_file(self, filename: str, data, mode: str = 'raw', window: int = None,
+                  compress: bool = True, block_size: int = BLOCK_SIZE, preprocess=None,
+                  offset: int = 0):
+        """write data to a file on the sd card.  data is bytes, a binary file object or an
+        iterable of chunks and is streamed in blocks of block_size.  mode 'raw' sends the data
+        as is.  mode 'line' sends it line by line with line numbers and checksums so corrupted
+        lines are sent again, keeping up to window lines in flight and no more than the tuner
+        allows if there is one.  window None is 4, or up to the tuner.  mode 'binary' uses
+        the binary transfer protocol, zlib compressed if compress is set, and falls back to
+        'line' if the firmware does not support it.  preprocess, if given, is called with the
+        stream of chunks and returns the stream to send, gcode.Minifier for example.  a non zero
+        offset resumes an interrupted upload, the file keeps its first offset bytes and data
+        is what follows them.  this needs the SD_RESUME capability"""
+        if mode not in ('raw', 'line', 'binary'):
+            raise ValueError(f'unknown mode: {mode}')
+        if offset and not self.can_resume():
+            raise ValueError('firmware cannot resume uploads')
+
+        if mode == 'binary' and self.capabilities().get(protocol.BINARY_CAPABILITY) != '1':
+            mode = 'line'
 
-    def save_file(self, filename: str, data: bytes):
         self.port.reset_input_buffer()
-        self.port.write(f'M23 {filename}\n'.encode())
-        response = self.readall()
-        if response.decode() not in (f'ok\n', f'Open failed, File: {filename}.\n\nok\n'):
+        response = self.command(f'M23 {filename}')
+        if response.decode() not in ('ok\n', f'Open failed, File: {filename}.\n\nok\n'):
             raise ValueError(response)
 
-        self.port.write(f'M28\n'.encode())
-        response = self.readall()
+        if mode == 'line':
+            response = self.command('M110 N0')
+            if response != b'ok\n':
+                raise ValueError(response)
+
+        command = 'M28 B1' if mode == 'binary' else 'M28'
+        if offset:
+            command += f' S{offset}'
+        response = self.command(command)
         if response != f'Writing to file: {filename}\nok\n'.encode():
             raise ValueError(response)
 
-        self.port.write(data)
-        if self.port.in_waiting:
-            response = self.readall()
-            raise ValueError(response)
+        chunks = iter_chunks(data, block_size)
+        if preprocess:
+            chunks = preprocess(chunks)
+        if self.tuner:
+            self.tuner.start()
+        try:
+            if mode == 'binary':
+                # closing the file ends the transfer, there is no M29
+                self._send_binary(chunks, compress)
+            elif mode == 'line':
+                last = self._send_numbered(iter_lines(chunks), window)
+            elif mode == 'raw':
+                for chunk in chunks:
+                    self._write(chunk)
+                if self.port.in_waiting:
+                    response = self.readall()
+                    raise ValueError(response)
+        finally:
+            if self.tuner:
+                self.tuner.finish()
 
-        self.port.write(b'M29\n')
-        response = self.readall()
-        if response != b'Done saving file.\n':
-            raise ValueError(response)
+        if mode != 'binary':
+            response = self.command('M29')
+            # the firmware rejects a line sent again after it had it, the reply can come late
+            while mode == 'line' and response.terminator == 'ok' and response.resend == last + 1:
+                response = self.read_reply(self.TERMINATORS['M29'])
+            if response != b'Done saving file.\n':
+                raise ValueError(response)
+
+        # the file is closed, the link is idle
+        if self.tuner and self.tuner.target != self.tuner.baud:
+            self.tuner.switched(self.set_baud(self.tuner.target))
+
+    def set_baud(self, baud: int) -> bool:
+        """move the link to baud with M575 and check the firmware answers at the new rate.
+        returns False, with the port at its old rate, if the firmware does not confirm the
+        change or does not answer after it"""
+        self.port.reset_input_buffer()
+        self._write(f'M575 B{baud}\n'.encode())
+        # the firmware confirms at the old rate, its ok already comes at the new one
+        line = self._readline()
+        while b'baud rate set to' not in line.lower():
+            if not line or protocol.classify(line) == 'ok':
+                return False
+            line = self._readline()
+
+        old = self.port.baudrate
+        self.port.baudrate = baud
+        self.clock.sleep(0.1)
+        self.port.reset_input_buffer()
+        if self.ping():
+            return True
+
+        self.port.baudrate = old
+        self.port.reset_input_buffer()
+        return False
+
+    def _parse_ok(self, line: bytes):
+        """record the free planner and buffer slots of an advanced ok"""
+        for word in line.split()[1:]:
+            try:
+                if word.startswith(b'P'):
+                    self.planner_free = int(word[1:])
+                elif word.startswith(b'B'):
+                    self.buffer_free = int(word[1:])
+            except ValueError:
+                pass
+
+    def send_commands(self, commands, window: int = 4):
+        """send commands keeping up to window of them in flight and return the reply of each
+        one.  oks are matched to commands in the order they were sent.  if the firmware reports
+        free command buffer slots (ADVANCED_OK) no more commands are sent than it can take"""
+        if window < 1:
+            raise ValueError(f'invalid window: {window}')
+
+        replies = []
+        pending = deque()
+        commands = iter(commands)
+        credit = window
+        done = False
+
+        while True:
+            while not done and credit > 0 and len(pending) < window:
+                command = next(commands, None)
+                if command is None:
+                    done = True
+                    break
+                line = command.encode() + b'\n'
+                self._write(line)
+                pending.append((command, [], self.clock.time()))
+                if self.metrics:
+                    self.metrics.command_sent(command_code(line), line)
+                credit -= 1
+
+            if not pending:
+                break
+
+            line = self._readline()
+            if not line:
+                raise ValueError(f'no reply to {pending[0][0]}')
+
+            kind, line = self._sort_line(line)
+            if line is None:
+                continue
+            if kind == 'ok':
+                command, reply, started = pending.popleft()
+                replies.append(b''.join(reply) + line)
+                if self.metrics:
+                    self.metrics.reply_received(command_code(command.encode()), replies[-1],
+                                                self.clock.time() - started)
+                self.buffer_free = None
+                self._parse_ok(line)
+                # commands still in flight may not have reached the buffer yet
+                if self.buffer_free is None:
+                    credit = window - len(pending)
+                else:
+                    credit = self.buffer_free - len(pending)
+                if not pending:
+                    credit = max(credit, 1)
+            else:
+                pending[0][1].append(line)
+
+        return replies
 
     def list_sd_card(self):
-        self.port.write(b'M20')
-        response = self.readall()
+        response = self.command('M20')
         files = {}
         for line in response.strip().split(b'\n'):
             if line in (b'Begin file list', b'End file list', b'ok'):
@@ -93,34 +598,214 @@ class MarlinClient:
         return files
 
     def delete_sd_file(self, filename: str):
-        self.port.write(f'M30 {filename}\n'.encode())
-        response = self.readall()
+        response = self.command(f'M30 {filename}')
         if response != f'File deleted:{filename}\nok\n'.encode():
             raise ValueError(response)
 
     def start_print(self, filename):
-        self.port.write(f'M23 {filename}\n'.encode())
-        response = self.readall()
-        if response != b'Writing to file: abc.gco\nok\n':
+        """select a file on the sd card and start printing it"""
+        response = self.command(f'M23 {filename}')
+        if response != b'ok\n':
+            raise ValueError(response)
+        response = self.command('M24')
+        if response != b'ok\n':
             raise ValueError(response)
 
-    def print_time(self):
-        self.port.write(f'M31\n'.encode())
-        response = self.readall()
+    def print_status(self):
+        """(byte, size) of the sd print in progress, None when not printing"""
+        response = self.command('M27')
+        m = SD_BYTES.match(response)
+        if m:
+            return int(m.group(1)), int(m.group(2))
+        if not response.startswith(b'Not SD printing'):
+            raise ValueError(response)
 
-        return response
+        return None
 
-    def firmware_info(self):
-        self.port.write(f'M115\n'.encode())
-        response = self.readall()
+    def print_time(self):
+        return self.command('M31')
 
-        return response
+    def firmware_info(self):
+        return self.command('M115')
 
     def set_hotend_temperature(self, temp: int):
-        self.port.write(f'M104 S{temp}\n'.encode())
+        """set the target, returns without waiting for it"""
+        response = self.command(f'M104 S{temp}')
+        if response != b'ok\n':
+            raise ValueError(response)
+        self.hotend_target = temp
 
     def set_bed_temperature(self, temp: int):
-        self.port.write(f'M140 S{temp}\n'.encode())
+        """set the target, returns without waiting for it"""
+        response = self.command(f'M140 S{temp}')
+        if response != b'ok\n':
+            raise ValueError(response)
+        self.bed_target = temp
+
+    def report_temperatures(self):
+        """query the temperatures, M105 answers at once and the report lands in telemetry"""
+        response = self.command('M105')
+        if not response.endswith(b'ok\n'):
+            raise ValueError(response)
+
+    def preheat(self, material: str):
+        """start heating the bed and hotend for material and return at once.  upload while
+        they heat and call wait_for_temperatures before printing"""
+        hotend, bed = material_temperatures(material)
+        self.set_bed_temperature(bed)
+        self.set_hotend_temperature(hotend)
+
+    def wait_for_temperatures(self, tolerance: float = TEMPERATURE_TOLERANCE,
+                              timeout: float = None, interval: float = 1.0):
+        """wait until both heaters are within tolerance of their targets.  polls with M105
+        instead of blocking the firmware in M109/M190 so the link stays usable"""
+        deadline = None if timeout is None else self.clock.time() + timeout
+        while True:
+            self.report_temperatures()
+            if self.telemetry.at_temperature(self.hotend_target, self.bed_target, tolerance):
+                return
+            if deadline is not None and self.clock.time() >= deadline:
+                raise TimeoutError(f'heating: hotend {self.hotend_temp} bed {self.bed_temp}')
+            self.clock.sleep(interval)
+
+
+class AsyncMarlinClient:
+    """asyncio Marlin client.  a single reader task demultiplexes the firmware output: replies
+    resolve the future of the oldest outstanding command and temperature, progress and busy
+    reports are published to subscriber queues.  reader and writer follow the asyncio stream
+    API, e.g. from serial_asyncio.open_serial_connection or mock.AsyncStream"""
+
+    def __init__(self, reader, writer, clock=None):
+        self.reader = reader
+        self.writer = writer
+        self.clock = clock or Clock()
+        self.pending = deque()
+        self.subscribers = {name: [] for name in protocol.REPORTS}
+        self.telemetry = Telemetry(clock=self.clock)
+        self.hotend_target = 0
+        self.bed_target = 0
+        # seconds between temperature auto reports, 0 if off
+        self.auto_report_interval = 0
+        self._task = None
+
+    async def connect(self):
+        """wait for the firmware to start and begin reading replies"""
+        response = await self.reader.readline()
+        if response != b'start\n':
+            raise RuntimeError(f'start expected: {response}')
+
+        while response != b'echo:SD card ok\r\n':
+            response = await self.reader.readline()
+
+        self._task = asyncio.create_task(self._read())
+
+    async def close(self):
+        self._fail_pending(ConnectionError('connection closed'))
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.writer.close()
+
+    def subscribe(self, report: str, maxsize: int = 100) -> asyncio.Queue:
+        """return a queue receiving report lines.  the oldest lines are dropped when a
+        subscriber falls behind"""
+        queue = asyncio.Queue(maxsize)
+        self.subscribers[report].append(queue)
+
+        return queue
+
+    def unsubscribe(self, report: str, queue: asyncio.Queue):
+        self.subscribers[report].remove(queue)
+
+    def _publish(self, report: str, line: bytes):
+        for queue in self.subscribers[report]:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(line)
+
+    async def _read(self):
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    raise ConnectionError('port closed')
+                line = line.replace(b'\r', b'')
+
+                kind = protocol.classify(line)
+                if kind in ('ok', 'temperature', 'progress'):
+                    self.telemetry.feed(line)
+                if kind in self.subscribers:
+                    self._publish(kind, line)
+                elif self.pending:
+                    future, reply = self.pending[0]
+                    if kind in ('ok', 'done'):
+                        self.pending.popleft()
+                        if not future.done():
+                            future.set_result(b''.join(reply) + line)
+                    else:
+                        reply.append(line)
+        except ConnectionError as e:
+            self._fail_pending(e)
+        finally:
+            # whatever stopped the reader, no reply is coming
+            self._fail_pending(ConnectionError('reader stopped'))
+
+    def _fail_pending(self, error: Exception):
+        while self.pending:
+            future, _ = self.pending.popleft()
+            if not future.done():
+                future.set_exception(error)
+
+    async def command(self, command: str) -> bytes:
+        """send a command and return its reply including the terminating line.  commands can
+        be issued concurrently, replies arrive in the order the commands were sent"""
+        if not self._task or self._task.done():
+            raise ConnectionError('not connected')
+
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((future, []))
+        self.writer.write(command.encode() + b'\n')
+        await self.writer.drain()
+
+        return await future
+
+    async def firmware_info(self) -> bytes:
+        return await self.command('M115')
+
+    async def set_hotend_temperature(self, temp: int):
+        await self.command(f'M104 S{temp}')
+        self.hotend_target = temp
+
+    async def set_bed_temperature(self, temp: int):
+        await self.command(f'M140 S{temp}')
+        self.bed_target = temp
+
+    async def preheat(self, material: str):
+        """start heating for material and return at once"""
+        hotend, bed = material_temperatures(material)
+        await asyncio.gather(self.set_bed_temperature(bed), self.set_hotend_temperature(hotend))
+
+    async def wait_for_temperatures(self, tolerance: float = TEMPERATURE_TOLERANCE,
+                                    interval: int = 1):
+        """wait for the heaters to reach their targets on temperature auto reports, other
+        commands can be issued meanwhile.  the auto report interval is restored after"""
+        queue = self.subscribe('temperature')
+        previous = self.auto_report_interval
+        try:
+            await self.auto_report_temperatures(interval)
+            while not self.telemetry.at_temperature(self.hotend_target, self.bed_target,
+                                                    tolerance):
+                await queue.get()
+        finally:
+            self.unsubscribe('temperature', queue)
+            if self.auto_report_interval != previous:
+                await self.auto_report_temperatures(previous)
 
-    def preheat(self, material):
-        pass
+    async def auto_report_temperatures(self, interval: int):
+        """have the firmware report temperatures every interval seconds, 0 to stop"""
+        await self.command(f'M155 S{interval}')
+        self.auto_report_interval = interval
@@ -0,0 +1,28 @@
+"""
+Clocks for simulations.  Clock follows the system's monotonic clock, VirtualClock only moves
+when something sleeps so a simulation runs as fast as the code allows while keeping the
+timing and order of events it would have in real time.
+"""
+
+import time
+
+
+class Clock:
+    def time(self) -> float:
+        return time.monotonic()
+
+    def sleep(self, seconds: float):
+        if seconds > 0:
+            time.sleep(seconds)
+
+
+class VirtualClock(Clock):
+    def __init__(self, start: float = 0.0):
+        self.now = start
+
+    def time(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        if seconds > 0:
+            self.now += seconds
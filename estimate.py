@@ -0,0 +1,100 @@
+"""
+Print time estimates.  A file is read once in blocks that end at a line end, each block is
+parsed into a gcode.Program and timed by gcode.Motion with the junction deviation planner,
+so memory stays at a block whatever the size of the file.
+
+Estimating a large file takes a while so results are cached by content hash, together with
+the machine settings they were made with, in a json file next to the upload index.
+"""
+
+import os
+import json
+import threading
+
+from atomic import write_atomic
+from stream import iter_chunks
+from gcode import (DEFAULT_ACCELERATION, DEFAULT_FEEDRATE, DEFAULT_JUNCTION_DEVIATION,
+                   Motion, parse)
+from upload import file_hash
+
+# lines are timed a block at a time, each block ends at rest
+ESTIMATE_BLOCK_SIZE = 1024 * 1024
+
+
+def iter_blocks(chunks):
+    """regroup a stream of chunks into blocks of whole lines"""
+    rest = b''
+    for chunk in chunks:
+        data = rest + chunk
+        cut = data.rfind(b'\n') + 1
+        if cut:
+            yield data[:cut]
+        rest = data[cut:]
+
+    if rest:
+        yield rest
+
+
+def estimate(data, acceleration: float = DEFAULT_ACCELERATION,
+             junction_deviation: float = DEFAULT_JUNCTION_DEVIATION,
+             feedrate: float = DEFAULT_FEEDRATE, block_size: int = ESTIMATE_BLOCK_SIZE) -> dict:
+    """estimate the print time of gcode.  data can be anything iter_chunks takes.  returns
+    the seconds, the number of lines and the number of those that take time"""
+    motion = Motion(acceleration, feedrate, junction_deviation)
+    seconds = 0.0
+    lines = moves = 0
+    for block in iter_blocks(iter_chunks(data, block_size)):
+        times = motion.times(parse(block))
+        seconds += sum(times)
+        lines += len(times)
+        moves += len(times) - times.count(0.0)
+
+    return {'seconds': seconds, 'lines': lines, 'moves': moves}
+
+
+class Estimator:
+    """print time estimates of files, cached by content hash in a json file if path is given.
+    safe to share between threads"""
+
+    def __init__(self, path: str = None, acceleration: float = DEFAULT_ACCELERATION,
+                 junction_deviation: float = DEFAULT_JUNCTION_DEVIATION,
+                 feedrate: float = DEFAULT_FEEDRATE):
+        self.path = path
+        self.settings = {'acceleration': acceleration, 'junction_deviation': junction_deviation,
+                         'feedrate': feedrate}
+        self.entries = dict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    @property
+    def key(self) -> str:
+        return ':'.join(f'{value}' for value in self.settings.values())
+
+    def estimate(self, path: str) -> dict:
+        """the estimate of the file at path"""
+        digest, _ = file_hash(path)
+        with self.lock:
+            result = self.entries.get(self.key, dict()).get(digest)
+            if result:
+                self.hits += 1
+                return result
+            self.misses += 1
+
+        with open(path, 'rb') as f:
+            result = estimate(f, **self.settings)
+
+        with self.lock:
+            self.entries.setdefault(self.key, dict())[digest] = result
+            self._save()
+
+        return result
+
+    def _save(self):
+        if not self.path:
+            return
+
+        write_atomic(self.path, json.dumps(self.entries, indent=1, sort_keys=True))
@@ -0,0 +1,356 @@
+"""
+Printer farm simulator.  Runs many mock printers spread over a pool of worker processes so
+a farm of fifty printers is simulated in parallel instead of in the caller one at a time.
+
+Every printer is a MarlinHost in a worker process, reachable through a pty or a socket
+pair.  The slave end of a pty is a device like /dev/pts/7 any program can open, pyserial
+included, so the upload server can be pointed at the farm with -p.  FdPort is a small
+serial.Serial look-alike for either end that does without pyserial.
+
+The controller talks to the workers over pipes to inject faults and collect statistics:
+
+    with Farm(50, processes=8) as farm:
+        client.connect(farm.port('printer0'))
+        farm.inject('printer3', 'noise', 0.01)
+        farm.stats()['printer3']['bytes_in']
+
+Faults:
+
+    noise       probability a write to the printer is corrupted
+    latency     seconds every command takes
+    hang        the firmware stops processing commands, False to undo
+    reboot      reset the board as a DTR pulse does
+"""
+
+import os
+import pty
+import tty
+import time
+import socket
+import select
+import logging
+import selectors
+import threading
+import multiprocessing
+
+from mock import DiskSdCard, MarlinHost
+
+# longest a worker sleeps without checking the printers' timers
+POLL_INTERVAL = 0.05
+FAULTS = ('noise', 'latency', 'hang', 'reboot')
+
+
+class FdPort:
+    """serial.Serial look-alike over a file descriptor, the slave end of a pty or a socket.
+    a write that cannot finish within write_timeout seconds raises TimeoutError"""
+
+    def __init__(self, fd: int, name: str = None, timeout: float = None, on_reset=None,
+                 write_timeout: float = None):
+        self.fd = fd
+        # a blocking write could outlast the write timeout
+        os.set_blocking(fd, False)
+        self.name = name
+        self.timeout = timeout
+        self.write_timeout = write_timeout
+        self.buf = bytearray()
+        self._dtr = True
+        # called when DTR is asserted, there is no modem control line to reset the board
+        self.on_reset = on_reset
+
+    @property
+    def port(self):
+        return self.name
+
+    @property
+    def dtr(self):
+        return self._dtr
+
+    @dtr.setter
+    def dtr(self, state: bool):
+        if state and not self._dtr and self.on_reset:
+            self.on_reset()
+        self._dtr = state
+
+    def _fill(self, timeout: float = 0.0) -> bool:
+        """read what has arrived, waiting up to timeout for something.  False at the end"""
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return True
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+        self.buf += data
+
+        return bool(data)
+
+    def _wait(self, ready):
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while not ready():
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                break
+            if not self._fill(remaining):
+                break
+
+    @property
+    def in_waiting(self) -> int:
+        self._fill()
+        return len(self.buf)
+
+    def read(self, num_bytes: int = 1) -> bytes:
+        self._wait(lambda: len(self.buf) >= num_bytes)
+        data = bytes(self.buf[:num_bytes])
+        del self.buf[:num_bytes]
+
+        return data
+
+    def readline(self) -> bytes:
+        self._wait(lambda: b'\n' in self.buf)
+        end = self.buf.find(b'\n') + 1 or len(self.buf)
+        data = bytes(self.buf[:end])
+        del self.buf[:end]
+
+        return data
+
+    def write(self, data: bytes):
+        view = memoryview(data)
+        deadline = None if self.write_timeout is None else time.monotonic() + self.write_timeout
+        while view:
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+            if not select.select([], [self.fd], [], remaining)[1]:
+                raise TimeoutError(f'write timeout on {self.name}')
+            try:
+                view = view[os.write(self.fd, view):]
+            except BlockingIOError:
+                pass
+
+    def reset_input_buffer(self):
+        self._fill()
+        self.buf.clear()
+
+    def reset_output_buffer(self):
+        pass
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class _Printer:
+    """a printer in a worker process, a mock host and its end of the channel"""
+
+    def __init__(self, name: str, fd: int, card: DiskSdCard = None):
+        self.name = name
+        self.fd = fd
+        os.set_blocking(fd, False)
+        self.host = MarlinHost()
+        if card is not None:
+            self.host.proc.files = card
+        self.pending = bytearray(self.host.inq.read(len(self.host.inq)))
+        self.stats = {'bytes_in': 0, 'bytes_out': 0, 'faults': 0}
+
+    def receive(self) -> bool:
+        """pass what the client sent to the firmware.  False once the client is gone"""
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except (BlockingIOError, InterruptedError):
+            return True
+        except OSError:
+            return False
+        self.stats['bytes_in'] += len(data)
+        self.host.write(data)
+
+        return bool(data)
+
+    def run(self):
+        """run the firmware's timers and move its output to the channel"""
+        self.host.proc.run(self.host.host_port, partial=False)
+        inq = self.host.inq
+        if len(inq):
+            self.pending += self.host._add_noise(inq.read(len(inq)), 'read')
+        if self.pending:
+            try:
+                sent = os.write(self.fd, self.pending)
+            except (BlockingIOError, InterruptedError):
+                return
+            self.stats['bytes_out'] += sent
+            del self.pending[:sent]
+
+    def inject(self, fault: str, value=None):
+        proc = self.host.proc
+        if fault == 'noise':
+            self.host.error_prob['write'] = value or 0.0
+        elif fault == 'latency':
+            proc.default_latency = value or 0.0
+        elif fault == 'hang':
+            proc.busy_until = float('inf') if value is None or value else 0.0
+        elif fault == 'reboot':
+            self.host.dtr = False
+            self.host.dtr = True
+        else:
+            raise ValueError(f'unknown fault: {fault}')
+        self.stats['faults'] += 1
+
+    def report(self) -> dict:
+        proc = self.host.proc
+        return dict(self.stats, files={name: len(data) for name, data in proc.files.items()},
+                    reboots=proc.reboots)
+
+
+def _serve(channels: dict, control, sd_path: str = None, sd_capacity: int = None):
+    """worker process main loop, serve the printers until told to stop"""
+    printers = dict()
+    cards = []
+    for name, fd in channels.items():
+        card = DiskSdCard(os.path.join(sd_path, name), sd_capacity) if sd_path else None
+        printers[name] = _Printer(name, fd, card)
+        if card is not None:
+            cards.append(card)
+    selector = selectors.DefaultSelector()
+    selector.register(control, selectors.EVENT_READ)
+    for printer in printers.values():
+        selector.register(printer.fd, selectors.EVENT_READ, printer)
+
+    try:
+        while True:
+            waiting = any(printer.pending for printer in printers.values())
+            for key, _ in selector.select(0.001 if waiting else POLL_INTERVAL):
+                if key.data is not None:
+                    if not key.data.receive():
+                        selector.unregister(key.fd)
+                    continue
+
+                request = control.recv()
+                if request[0] == 'stop':
+                    return
+                try:
+                    if request[0] == 'stats':
+                        reply = {name: printer.report() for name, printer in printers.items()}
+                    else:
+                        reply = printers[request[1]].inject(*request[2:])
+                except Exception as e:
+                    reply = e
+                control.send(reply)
+
+            for printer in printers.values():
+                printer.run()
+    finally:
+        # flush what is buffered for the files being written
+        for card in cards:
+            card.close()
+
+
+class Farm:
+    """count mock printers, named printer0 up, served by a pool of worker processes.
+    transport is 'pty' or 'socket'.  with sd_path the sd cards are directories under it,
+    named after the printers, so they hold more than fits in memory and outlive the farm.
+    sd_capacity is the size of a card in bytes"""
+
+    def __init__(self, count: int, processes: int = None, transport: str = 'pty',
+                 sd_path: str = None, sd_capacity: int = None):
+        if transport not in ('pty', 'socket'):
+            raise ValueError(f'unknown transport: {transport}')
+        self.names = [f'printer{n}' for n in range(count)]
+        self.processes = min(processes or os.cpu_count() or 1, count) or 1
+        self.transport = transport
+        self.sd_path = sd_path
+        self.sd_capacity = sd_capacity
+        # printer name to the path of its pty, the pty's slave end held open so the worker
+        # does not see a hang up between clients, or the client end of its socket pair
+        self.devices = dict()
+        self.slaves = dict()
+        self.sockets = dict()
+        self.owner = dict()
+        self.workers = []
+        self.controls = []
+        self.lock = threading.Lock()
+
+    def _channel(self, name: str) -> int:
+        """make the channel to a printer, returns the worker's end"""
+        if self.transport == 'pty':
+            master, slave = pty.openpty()
+            tty.setraw(slave)
+            self.devices[name] = os.ttyname(slave)
+            self.slaves[name] = slave
+            return master
+
+        worker_end, self.sockets[name] = socket.socketpair()
+        return worker_end.detach()
+
+    def start(self):
+        context = multiprocessing.get_context('fork')
+        groups = [self.names[n::self.processes] for n in range(self.processes)]
+        for index, names in enumerate(groups):
+            channels = {name: self._channel(name) for name in names}
+            control, worker_control = context.Pipe()
+            worker = context.Process(target=_serve, name=f'farm{index}', daemon=True,
+                                     args=(channels, worker_control, self.sd_path,
+                                           self.sd_capacity))
+            worker.start()
+            for fd in channels.values():
+                os.close(fd)
+            self.workers.append(worker)
+            self.controls.append(control)
+            for name in names:
+                self.owner[name] = control
+        logging.info(f'farm of {len(self.names)} printers in {self.processes} processes')
+
+    def stop(self):
+        for control in self.controls:
+            control.send(('stop',))
+        for worker in self.workers:
+            worker.join()
+        for slave in self.slaves.values():
+            os.close(slave)
+        for client_end in self.sockets.values():
+            client_end.close()
+        self.devices, self.slaves, self.sockets = dict(), dict(), dict()
+        self.workers, self.controls = [], []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def device(self, name: str) -> str:
+        """the pty device of a printer, for pyserial or the -p option"""
+        if self.transport != 'pty':
+            raise ValueError('printers are only reachable through ptys with the pty transport')
+        return self.devices[name]
+
+    def port(self, name: str, timeout: float = None, write_timeout: float = None) -> FdPort:
+        """open a port to a printer, pulsing its DTR reboots the printer"""
+        if self.transport == 'pty':
+            fd = os.open(self.devices[name], os.O_RDWR | os.O_NOCTTY)
+        else:
+            fd = os.dup(self.sockets[name].fileno())
+        return FdPort(fd, name, timeout, on_reset=lambda: self.inject(name, 'reboot'),
+                      write_timeout=write_timeout)
+
+    def _request(self, control, *request):
+        with self.lock:
+            control.send(request)
+            reply = control.recv()
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+    def inject(self, name: str, fault: str, value=None):
+        """inject one of FAULTS into a printer.  noise and latency take the amount, 0 clears
+        them, hang takes False to clear it"""
+        if fault not in FAULTS:
+            raise ValueError(f'unknown fault: {fault}')
+        self._request(self.owner[name], 'inject', name, fault, value)
+
+    def stats(self) -> dict:
+        """printer name to its bytes in and out, faults injected, sd card files and reboots"""
+        out = dict()
+        for control in self.controls:
+            out.update(self._request(control, 'stats'))
+
+        return out
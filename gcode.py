@@ -0,0 +1,573 @@
+"""
+Gcode preprocessing.  Slicer output carries a lot the firmware never looks at: comments,
+blank lines, padding, trailing zeros and words that repeat the current modal state.  On a
+serial link upload time scales with bytes so stripping them before the upload pays off.
+
+The Minifier is a streaming filter over chunks of a file and plugs into
+MarlinClient.save_file as its preprocess stage:
+
+    client.save_file(name, f, mode='line', preprocess=Minifier())
+
+Marlin has no modal motion commands, a line has to start with its G or M word, so the
+minifier keeps the command word and drops the unchanged F and axis words instead.
+
+Parsing: tokenize splits a single command line the way the firmware does, parse scans a
+whole buffer in one pass into a Program, a columnar set of arrays with one command per line
+and the letters and values of all words, for validating and simulating large files.  Motion
+estimates how long each line of a Program takes to execute.
+"""
+
+import re
+import math
+from array import array
+from operator import itemgetter
+
+from stream import BLOCK_SIZE, iter_lines
+
+WORD = re.compile(rb'\s*([A-Za-z])\s*([+-]?[0-9]*\.?[0-9]*)')
+COMMAND = re.compile(rb'\s*([A-Za-z])\s*([0-9.]*)')
+NUMBER = re.compile(rb'([+-]?)([0-9]*)(?:\.([0-9]*))?')
+COMMENT = re.compile(rb'\([^)\n]*\)')
+LINE = re.compile(rb'(?:\s*[A-Za-z]\s*[+-]?[0-9]*\.?[0-9]*)*\s*')
+# a register word ends at whitespace, any other token is a string argument
+TOKEN = re.compile(r'([A-Za-z])([0-9.-]*)(?!\S)|(\S+)')
+SEMICOLON = re.compile(rb';[^\n]*')
+NOT_LETTERS = bytes(b for b in range(256) if not bytes((b, )).isalpha())
+
+# commands whose argument is free text, a filename or a message
+STRING_COMMANDS = frozenset((b'M23', b'M28', b'M30', b'M32', b'M33', b'M117', b'M118', b'M928'))
+# commands that leave the position and feedrate alone
+PASSIVE_COMMANDS = frozenset((
+    b'G4', b'M73', b'M82', b'M83', b'M104', b'M105', b'M106', b'M107', b'M109', b'M140',
+    b'M190', b'M204', b'M205', b'M220', b'M221', b'M400'))
+MOVES = (b'G0', b'G1')
+AXES = b'XYZ'
+# extrusion per mm of two moves has to agree this closely for them to be merged
+EXTRUSION_TOLERANCE = 0.01
+# what Motion does for each command
+MOTION_COMMANDS = {'G0': 'move', 'G1': 'move', 'G4': 'dwell', 'G28': 'home', 'G92': 'set',
+                   'G90': 'absolute', 'G91': 'relative', 'M82': 'absolute_e',
+                   'M83': 'relative_e'}
+# mm/s^2 and mm/min, Marlin's defaults
+DEFAULT_ACCELERATION = 3000.0
+DEFAULT_FEEDRATE = 1500.0
+# mm, how far the path may deviate from a corner taken at speed
+DEFAULT_JUNCTION_DEVIATION = 0.013
+
+
+def format_number(text: bytes) -> bytes:
+    """shortest form of a number that parses to the same value: no sign for positive
+    numbers, no leading or trailing zeros and no bare decimal point"""
+    m = NUMBER.fullmatch(text)
+    if not m:
+        return text
+
+    sign, whole, fraction = m.groups()
+    whole = whole.lstrip(b'0')
+    fraction = (fraction or b'').rstrip(b'0')
+    if not whole and not fraction:
+        return b'0' if m.group(2) or m.group(3) else text
+
+    number = whole + (b'.' + fraction if fraction else b'')
+    return (b'-' if sign == b'-' else b'') + (number or b'0')
+
+
+def decimals(text: bytes) -> int:
+    """number of digits after the decimal point"""
+    point = text.find(b'.')
+    return 0 if point < 0 else len(text) - point - 1
+
+
+def command_word(line: bytes) -> bytes:
+    """the normalized command word a line starts with, G1 for 'g01 X1'"""
+    m = COMMAND.match(line)
+    return m.group(1).upper() + format_number(m.group(2)) if m else b''
+
+
+def strip_comments(line: bytes) -> bytes:
+    """remove ; and ( ) comments and surrounding whitespace"""
+    semicolon = line.find(b';')
+    if semicolon >= 0:
+        line = line[:semicolon]
+    if b'(' in line and command_word(line) not in STRING_COMMANDS:
+        line = COMMENT.sub(b'', line)
+
+    return line.strip()
+
+
+def parse_words(line: bytes):
+    """split a comment free line into (letter, number) words.  None if the line is not made
+    of words only, those are passed on as they are"""
+    if not LINE.fullmatch(line):
+        return None
+
+    return [(letter.upper(), format_number(value)) for letter, value in WORD.findall(line)]
+
+
+def tokenize(line) -> tuple:
+    """split a command line into its upper case command and a dict of arguments.  register
+    words like X10 map the letter to the value text, any other token is a string argument
+    stored under '@', the last one wins"""
+    if isinstance(line, (bytes, bytearray)):
+        line = line.decode(errors='replace')
+
+    tokens = TOKEN.findall(line)
+    if not tokens:
+        return '', dict()
+
+    letter, value, text = tokens[0]
+    args = {letter or '@': value or text for letter, value, text in tokens[1:]}
+
+    return (text or letter + value).upper(), args
+
+
+class Program:
+    """a parsed gcode buffer in columns.  line i has the command names[commands[i]] and the
+    words letters[offsets[i]:offsets[i + 1]] with values at the same positions, nan for words
+    without a number.  lines without a command, blank or comment only, have command 0.
+    string arguments such as file names are not kept"""
+
+    def __init__(self):
+        self.names = ['']
+        self.commands = array('H')
+        self.offsets = array('L', [0])
+        self.letters = array('B')
+        self.values = array('d')
+
+    def __len__(self):
+        return len(self.commands)
+
+    def command(self, index: int) -> str:
+        return self.names[self.commands[index]]
+
+    def words(self, index: int) -> dict:
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return dict(zip(map(chr, self.letters[start:end]), self.values[start:end]))
+
+    def count(self, command: str) -> int:
+        """number of lines with command"""
+        try:
+            return self.commands.count(self.names.index(command))
+        except ValueError:
+            return 0
+
+
+def _value(word: bytes) -> float:
+    try:
+        return float(word[1:])
+    except ValueError:
+        return math.nan
+
+
+def parse(data: bytes) -> Program:
+    """parse a whole buffer into a Program.  the lines are split and the words converted in
+    bulk, python only loops once per line"""
+    program = Program()
+    codes = dict()
+    skip = set()
+    words = []
+    commands, offsets = program.commands, program.offsets
+
+    text = SEMICOLON.sub(b'', data)
+    if b'(' in text:
+        text = COMMENT.sub(b'', text)
+    lines = text.split(b'\n')
+    if lines[-1] == b'':
+        lines.pop()
+
+    for line in lines:
+        tokens = line.split()
+        if not tokens:
+            commands.append(0)
+            offsets.append(len(words))
+            continue
+        if len(line.translate(None, NOT_LETTERS)) != len(tokens):
+            # not one word per token, compact like G1X10Y20 or spaced like X 10
+            tokens = [letter + value for letter, value in WORD.findall(line)]
+
+        code = codes.get(tokens[0])
+        if code is None:
+            name = command_word(tokens[0]).decode(errors='replace')
+            if name not in program.names:
+                program.names.append(name)
+            code = codes[tokens[0]] = program.names.index(name)
+            if name.encode() in STRING_COMMANDS:
+                skip.add(code)
+        commands.append(code)
+        if code not in skip:
+            words += tokens[1:]
+        offsets.append(len(words))
+
+    program.letters = array('B', bytes(map(itemgetter(0), words)).upper())
+    try:
+        program.values = array('d', map(float, map(itemgetter(slice(1, None)), words)))
+    except ValueError:
+        program.values = array('d', map(_value, words))
+
+    return program
+
+
+class Motion:
+    """times the lines of a Program.  a move takes the time of a trapezoidal speed profile,
+    reaching the feedrate if the move is long enough, G4 waits and anything else takes no
+    time.  without a junction deviation every move starts and ends at rest, which makes prints
+    of many short moves slow.  with one, moves are planned like Marlin's planner does: the
+    speed through the corner between two moves is limited by the junction deviation, and
+    each move has to be able to brake for the next.  the modal state carries over from one
+    Program to the next so a file can be timed a block at a time, a block ends at rest"""
+
+    def __init__(self, acceleration: float = DEFAULT_ACCELERATION,
+                 feedrate: float = DEFAULT_FEEDRATE, junction_deviation: float = None):
+        self.acceleration = acceleration
+        self.junction_deviation = junction_deviation
+        # mm/s
+        self.feedrate = feedrate / 60
+        self.position = [0.0, 0.0, 0.0, 0.0]
+        self.relative = False
+        self.relative_e = False
+
+    def times(self, program: Program) -> array:
+        """seconds each line of program takes"""
+        out = array('d', bytes(8 * len(program)))
+        offsets = program.offsets
+        letters, values = program.letters.tolist(), program.values.tolist()
+        kinds = [MOTION_COMMANDS.get(name) for name in program.names]
+        x, y, z, e = self.position
+        relative, relative_e = self.relative, self.relative_e
+        feedrate = self.feedrate
+        acceleration, deviation = self.acceleration, self.junction_deviation
+        # the moves: line, length, speed and the square of the highest entry speed
+        lines, lengths, speeds, entries = [], [], [], []
+        # direction of the previous move, None after a stop
+        previous = None
+
+        for i, code in enumerate(program.commands):
+            kind = kinds[code]
+            if kind is None:
+                continue
+            start, end = offsets[i], offsets[i + 1]
+
+            if kind == 'move':
+                dx = dy = dz = de = 0.0
+                for letter, value in zip(letters[start:end], values[start:end]):
+                    if value != value:
+                        continue
+                    if letter == 88:
+                        dx = value if relative else value - x
+                    elif letter == 89:
+                        dy = value if relative else value - y
+                    elif letter == 90:
+                        dz = value if relative else value - z
+                    elif letter == 69:
+                        de = value if relative_e else value - e
+                    elif letter == 70 and value > 0:
+                        feedrate = value / 60
+                x, y, z, e = x + dx, y + dy, z + dz, e + de
+                distance = math.sqrt(dx * dx + dy * dy + dz * dz)
+                if not distance:
+                    # extruder only moves stop the axes
+                    distance, previous = abs(de), None
+                    entry = 0.0
+                elif deviation is None:
+                    entry = 0.0
+                else:
+                    direction = (dx / distance, dy / distance, dz / distance)
+                    entry = 0.0
+                    if previous:
+                        cos = -(direction[0] * previous[0] + direction[1] * previous[1]
+                                + direction[2] * previous[2])
+                        if cos < -0.999999:
+                            # straight on
+                            entry = min(feedrate, speeds[-1]) ** 2
+                        elif cos < 0.999999:
+                            sin = math.sqrt(0.5 * (1 - cos))
+                            entry = min(acceleration * deviation * sin / (1 - sin),
+                                        feedrate * feedrate, speeds[-1] * speeds[-1])
+                    previous = direction
+            elif kind == 'dwell':
+                words = dict(zip(letters[start:end], values[start:end]))
+                out[i] = words.get(83, words.get(80, 0.0) / 1000)
+                previous = None
+                continue
+            elif kind == 'home':
+                homed = set(letters[start:end]) & {88, 89, 90} or {88, 89, 90}
+                distance = max(abs(x) if 88 in homed else 0.0, abs(y) if 89 in homed else 0.0,
+                               abs(z) if 90 in homed else 0.0)
+                x, y, z = (0.0 if 88 in homed else x, 0.0 if 89 in homed else y,
+                           0.0 if 90 in homed else z)
+                entry, previous = 0.0, None
+            elif kind == 'set':
+                for letter, value in zip(letters[start:end], values[start:end]):
+                    if value == value:
+                        x, y, z, e = (value if letter == 88 else x, value if letter == 89 else y,
+                                      value if letter == 90 else z, value if letter == 69 else e)
+                continue
+            else:
+                relative, relative_e = {
+                    'absolute': (False, False), 'relative': (True, True),
+                    'absolute_e': (relative, False), 'relative_e': (relative, True),
+                }[kind]
+                continue
+
+            if distance:
+                lines.append(i)
+                lengths.append(distance)
+                speeds.append(feedrate)
+                entries.append(entry)
+
+        if deviation is not None:
+            # every move has to be able to brake to the entry speed of the next, the last one
+            # to a stop, and to reach its own entry speed from the entry speed of the one before
+            following = 0.0
+            for k in range(len(entries) - 1, -1, -1):
+                following = min(entries[k], following + 2 * acceleration * lengths[k])
+                entries[k] = following
+            for k in range(1, len(entries)):
+                entries[k] = min(entries[k], entries[k - 1] + 2 * acceleration * lengths[k - 1])
+        entries.append(0.0)
+
+        for k, i in enumerate(lines):
+            length, speed, enter, leave = lengths[k], speeds[k], entries[k], entries[k + 1]
+            cruise = speed * speed
+            accelerating = (cruise - enter) / (2 * acceleration)
+            braking = (cruise - leave) / (2 * acceleration)
+            enter, leave = math.sqrt(enter), math.sqrt(leave)
+            if accelerating + braking <= length:
+                out[i] = ((2 * speed - enter - leave) / acceleration
+                          + (length - accelerating - braking) / speed)
+            else:
+                # a triangle, the move is over before it gets to speed
+                peak = math.sqrt(acceleration * length + (enter * enter + leave * leave) / 2)
+                out[i] = (2 * peak - enter - leave) / acceleration
+
+        self.position = [x, y, z, e]
+        self.relative, self.relative_e = relative, relative_e
+        self.feedrate = feedrate
+
+        return out
+
+
+class Minifier:
+    """streaming gcode minifier.  strips comments, blank lines and redundant whitespace,
+    shortens numbers and drops F and X/Y/Z words that repeat the current value.  with a
+    tolerance in mm, runs of G1 moves whose intermediate points are within tolerance of a
+    straight line and that extrude at the same rate are merged into a single move"""
+
+    def __init__(self, tolerance: float = None, block_size: int = BLOCK_SIZE):
+        self.tolerance = tolerance
+        self.block_size = block_size
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.merged = 0
+        self.relative = None
+        self.relative_e = None
+        self.pending = []
+        self._reset_state()
+
+    @property
+    def saved(self) -> int:
+        return self.bytes_in - self.bytes_out
+
+    def _reset_state(self):
+        self.position = dict()
+        self.extruder = None
+        # the command that set it too, G0 has its own feedrate on some firmware builds
+        self.feedrate = None
+
+    def _update_state(self, command: bytes, words: list):
+        """track the modal state after command"""
+        if command in MOVES or command in (b'G2', b'G3'):
+            for letter, value in words:
+                if letter == b'F':
+                    self.feedrate = (command, value)
+                elif letter == b'E':
+                    self.extruder = value if self.relative_e is False else None
+                elif letter in AXES and command in MOVES and self.relative is False:
+                    self.position[letter] = value
+                elif letter in AXES:
+                    self.position.pop(letter, None)
+        elif command == b'G90':
+            self.relative = False
+            # G90 resets the extruder mode too on some firmware versions
+            self.relative_e = self.extruder = None
+        elif command == b'G91':
+            self.relative = self.relative_e = True
+            self.position.clear()
+        elif command in (b'M82', b'M83'):
+            self.relative_e = command == b'M83'
+            self.extruder = None
+        elif command == b'G92':
+            if not words:
+                self.position.clear()
+                self.extruder = None
+            for letter, value in words:
+                if letter in AXES:
+                    self.position[letter] = value
+                elif letter == b'E':
+                    self.extruder = value if self.relative_e is False else None
+        elif command not in PASSIVE_COMMANDS:
+            # homing, tool changes and anything else unknown
+            self._reset_state()
+
+    def _drop_modal(self, command: bytes, words: list) -> list:
+        """remove words that repeat the current state from a move"""
+        kept = []
+        for letter, value in words:
+            if letter == b'F' and (command, value) == self.feedrate:
+                continue
+            if letter in AXES and self.relative is False and self.position.get(letter) == value:
+                continue
+            kept.append((letter, value))
+
+        return kept
+
+    def _mergeable(self, command: bytes, words: list) -> bool:
+        """a G1 move in the XY plane from a known position"""
+        letters = {letter for letter, _ in words}
+        return (self.tolerance is not None and command == b'G1' and self.relative is False
+                and letters & {b'X', b'Y'} and letters <= {b'X', b'Y', b'E'}
+                and (b'E' not in letters or self.relative_e is not None)
+                and b'X' in self.position and b'Y' in self.position)
+
+    def _fits(self, start, points, end, rates) -> bool:
+        """all points within tolerance of the line from start to end, in order, and all
+        extrusion rates alike"""
+        dx, dy = end[0] - start[0], end[1] - start[1]
+        length = math.hypot(dx, dy)
+        if length == 0:
+            return False
+
+        for x, y in points:
+            along = ((x - start[0]) * dx + (y - start[1]) * dy) / length
+            across = abs((x - start[0]) * dy - (y - start[1]) * dx) / length
+            if across > self.tolerance or not 0 < along < length:
+                return False
+
+        low, high = min(rates), max(rates)
+        return high - low <= EXTRUSION_TOLERANCE * max(abs(high), abs(low))
+
+    def _merge(self, words: list) -> list:
+        """extend the pending run of moves with this one if the run stays straight, else
+        release the run and start a new one.  returns the lines released"""
+        values = dict(words)
+        start = (float(self.position[b'X']), float(self.position[b'Y']))
+        end = (float(values.get(b'X', self.position[b'X'])),
+               float(values.get(b'Y', self.position[b'Y'])))
+        length = math.hypot(end[0] - start[0], end[1] - start[1])
+        e = values.get(b'E')
+        if e is None:
+            delta = 0.0
+        elif self.relative_e:
+            delta = float(e)
+        else:
+            delta = None if self.extruder is None else float(e) - float(self.extruder)
+        move = {'words': words, 'start': start, 'end': end, 'e': e, 'delta': delta,
+                'length': length}
+
+        out = []
+        if self.pending:
+            run = self.pending + [move]
+            if (length and delta is not None
+                    and all((m['e'] is None) == (e is None) for m in run)
+                    and self._fits(run[0]['start'], [m['end'] for m in self.pending], end,
+                                   [m['delta'] / m['length'] for m in run])):
+                self.pending.append(move)
+                return out
+            out += self.flush_pending()
+
+        if length and delta is not None:
+            self.pending = [move]
+        else:
+            out.append(self._format(b'G1', words))
+
+        return out
+
+    def _release(self) -> bytes:
+        """a single move for the pending run, from its start to the current position"""
+        run, self.pending = self.pending, []
+        if len(run) == 1:
+            return self._format(b'G1', run[0]['words'])
+
+        self.merged += len(run) - 1
+        words = [(b'X', self.position[b'X']), (b'Y', self.position[b'Y'])]
+        if run[-1]['e'] is not None:
+            if self.relative_e:
+                places = max(decimals(m['e']) for m in run)
+                total = sum(float(m['e']) for m in run)
+                words.append((b'E', format_number(b'%.*f' % (places, total))))
+            else:
+                words.append((b'E', run[-1]['e']))
+
+        return self._format(b'G1', words)
+
+    @staticmethod
+    def _format(command: bytes, words: list) -> bytes:
+        return b' '.join([command] + [letter + value for letter, value in words])
+
+    def feed(self, line: bytes) -> list:
+        """minify one line, without its line ending.  returns the lines to send, there can be
+        none if the line is dropped or held back for merging, or several when held back
+        lines are released"""
+        self.bytes_in += len(line) + 1
+        line = strip_comments(line)
+        if not line:
+            return []
+
+        if command_word(line) in STRING_COMMANDS:
+            return self._count(self.flush_pending() + [line])
+
+        words = parse_words(line)
+        if not words:
+            # pass through as is, without assuming anything about what it does
+            out = self.flush_pending() + [line]
+            self._reset_state()
+            return self._count(out)
+
+        command = words[0][0] + words[0][1]
+        words = words[1:]
+        if command in MOVES:
+            words = self._drop_modal(command, words)
+            if not words:
+                return []
+
+        out = []
+        if command in MOVES and self._mergeable(command, words):
+            out += self._merge(words)
+        else:
+            out += self.flush_pending()
+            out.append(self._format(command, words))
+
+        self._update_state(command, words)
+
+        return self._count(out)
+
+    def flush_pending(self) -> list:
+        return [self._release()] if self.pending else []
+
+    def flush(self) -> list:
+        """release held back lines at the end of the file"""
+        return self._count(self.flush_pending())
+
+    def _count(self, lines: list) -> list:
+        self.bytes_out += sum(len(line) + 1 for line in lines)
+        return lines
+
+    def __call__(self, chunks):
+        """minify a stream of chunks into a stream of chunks of about block_size"""
+        block = bytearray()
+        for line in iter_lines(chunks):
+            for out in self.feed(line):
+                block += out + b'\n'
+            if len(block) >= self.block_size:
+                yield bytes(block)
+                block.clear()
+
+        for out in self.flush():
+            block += out + b'\n'
+        if block:
+            yield bytes(block)
+
+
+def minify(data: bytes, tolerance: float = None) -> bytes:
+    """minify a whole gcode file in memory"""
+    return b''.join(Minifier(tolerance)([data]))
@@ -1,49 +1,151 @@
 #! /usr/bin/env python3
 
+import os
 import sys
-import time
+import logging
+import functools
 from argparse import ArgumentParser
-from client import MarlinClient
+from estimate import Estimator
+from gcode import Minifier
+from metrics import Metrics
+from record import RecordingPort
+from server import UploadServer
+from session import SessionManager
+from tune import TuningProfiles
+from upload import HashIndex
 
 VERSION = 'V1'
 DEFAULT_BAUD = 115200
 DEFAULT_PORT = 'mock'
+DEFAULT_MODE = 'line'
+# seconds a write may block on a printer that stopped reading before it fails
+WRITE_TIMEOUT = 10.0
 
 
 def parse_args(argv):
     parser = ArgumentParser(prog='marser', description='Marlin upload server')
-    parser.add_argument('-p', '--port', default=DEFAULT_PORT, help=f'serial device ({DEFAULT_PORT})')
+    parser.add_argument('-p', '--port', action='append',
+                        help=f'serial device, repeat for each printer ({DEFAULT_PORT})')
     parser.add_argument('-b', '--baud', default=DEFAULT_BAUD, help='baud rate')
+    parser.add_argument('-m', '--mode', default=DEFAULT_MODE, choices=('raw', 'line', 'binary'),
+                        help=f'upload mode ({DEFAULT_MODE})')
+    parser.add_argument('-q', '--backlog', default=100, type=int,
+                        help='files queued before the watcher waits for a free printer')
+    parser.add_argument('-z', '--minify', action='store_true',
+                        help='strip comments and redundant words before uploading')
+    parser.add_argument('-t', '--tolerance', type=float, default=None,
+                        help='with --minify merge collinear moves within this many mm')
+    parser.add_argument('-i', '--index', default=None,
+                        help='hash index file, skip files a printer has and resume uploads')
+    parser.add_argument('-e', '--estimates', default=None,
+                        help='estimate print times, cached in this file')
+    parser.add_argument('--metrics', default=None,
+                        help='write client metrics to this file, json if it ends in .json')
     parser.add_argument('-x', '--reset', action='store_true', help='Reset target and exit')
+    parser.add_argument('--farm', type=int, default=0,
+                        help='upload to this many simulated printers instead of --port')
+    parser.add_argument('--reset-on-connect', action='store_true',
+                        help='reset the printers when connecting instead of resuming')
+    parser.add_argument('--check-interval', type=float, default=30.0,
+                        help='ping printers idle for this many seconds before a job')
+    parser.add_argument('--tune', default=None,
+                        help='adapt window, packet size and baud to the link, '
+                             'remembered per port in this file')
+    parser.add_argument('--record', default=None,
+                        help='record the serial sessions to files in this directory')
     parser.add_argument('--version', action='version', version=VERSION)
     parser.add_argument('watchdir', default=None, action='store', help='upload directory')
 
-    return parser.parse_args(args=argv)
+    args = parser.parse_args(args=argv)
+    args.port = args.port or [DEFAULT_PORT]
+    if args.tolerance is not None and not args.minify:
+        parser.error('--tolerance needs --minify')
 
+    return args
 
-def main(argv):
-    args = parse_args(argv)
-
-    client = MarlinClient()
 
-    if args.port == 'mock':
+def open_port(device: str, baud, reset: bool = True):
+    """open a serial port.  without reset DTR is left deasserted so boards that reset on DTR
+    keep running, where the platform allows it"""
+    if device == 'mock':
         import mock
-        port = mock.MarlinHost()
-    else:
-        import serial
+        return mock.MarlinHost()
 
-        port = serial.Serial(args.port, baudrate=args.baud, bytesize=8)
+    import serial
 
-    client.connect(port)
-    print('connected...')
+    port = serial.Serial(baudrate=baud, bytesize=8, write_timeout=WRITE_TIMEOUT)
+    port.port = device
+    port.dtr = reset
+    port.open()
 
-    print(client.firmware_info())
+    return port
 
-    filename = 'TEST.GCO'
-    with open(filename, 'rb') as f:
-        gcode = f.read()
 
-    print(client.save_file(filename, gcode))
+def main(argv):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    farm = None
+    if args.farm:
+        # the simulator needs ptys, only load it when asked for
+        from farm import Farm
+        farm = Farm(args.farm)
+        farm.start()
+        args.port = farm.names
+
+    profiles = TuningProfiles(args.tune) if args.tune else None
+
+    def baud(device):
+        return int(profiles.baud(device, args.baud) if profiles else args.baud)
+
+    def opener(device, reset, baud=baud):
+        if farm:
+            port = farm.port(device, write_timeout=WRITE_TIMEOUT)
+        else:
+            port = open_port(device, baud(device), reset)
+        if args.record:
+            os.makedirs(args.record, exist_ok=True)
+            path = os.path.join(args.record, f'{os.path.basename(device)}.rec')
+            port = RecordingPort(port, path)
+        return port
+
+    # a printer that is not at the tuned rate any more, after a reboot, is at --baud
+    fallback = functools.partial(opener, baud=lambda device: int(args.baud)) if profiles else None
+    sessions = SessionManager(opener, check_interval=args.check_interval,
+                              reset=args.reset_on_connect, fallback=fallback)
+    for index, device in enumerate(args.port):
+        sessions.add(f'{device}{index}' if device == 'mock' else device, device)
+
+    if args.reset:
+        sessions.reset_all()
+        sessions.close()
+        if farm:
+            farm.stop()
+        return
+
+    for name, client in sessions.clients().items():
+        if args.metrics:
+            client.metrics = Metrics(name)
+        if profiles:
+            device = sessions.sessions[name].device
+            client.tuner = profiles.tuner(device, getattr(client.port, 'baudrate', None))
+        print(f'{name} connected...')
+        print(client.firmware_info())
+
+    preprocess = functools.partial(Minifier, args.tolerance) if args.minify else None
+    index = HashIndex(args.index) if args.index else None
+    estimator = Estimator(args.estimates) if args.estimates else None
+    server = UploadServer(args.watchdir, None, backlog=args.backlog, mode=args.mode,
+                          preprocess=preprocess, index=index, metrics_path=args.metrics,
+                          sessions=sessions, estimator=estimator)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+    finally:
+        sessions.close()
+        if farm:
+            farm.stop()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,212 @@
+"""
+Client instrumentation.  A Metrics object attached to a MarlinClient counts the commands
+sent, the bytes going each way, filtered lines and retries, and keeps a latency histogram per
+command code, from sending a command to the reply that completes it.  Hooks let other code
+watch the same events as they happen.  A client without metrics only pays for an attribute
+check.
+
+Metrics export as JSON or in the Prometheus text format, export_prometheus combines the
+metrics of several printers into one page labelled by printer.
+"""
+
+from bisect import bisect_left
+from collections import Counter
+
+# upper bounds of the latency histogram buckets in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+EVENTS = ('command', 'reply', 'bytes')
+PREFIX = 'marser'
+
+
+def command_code(line: bytes) -> str:
+    """the command word of a command line, G1 for b'N12 G1 X10*91'"""
+    words = line.split(None, 2)
+    if words and words[0][:1] == b'N' and len(words) > 1:
+        words = words[1:]
+
+    return words[0].split(b'*')[0].upper().decode(errors='replace') if words else ''
+
+
+class Histogram:
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        # the last count is for values above every bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> list:
+        """(upper bound, count of values up to it) pairs, the last bound is inf"""
+        total = 0
+        out = []
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            out.append((bound, total))
+
+        return out
+
+    def quantile(self, q: float) -> float:
+        """upper bound of the bucket holding the q quantile"""
+        rank = q * self.count
+        for bound, total in self.cumulative():
+            if total >= rank:
+                return bound
+
+        return float('inf')
+
+    def copy(self) -> 'Histogram':
+        histogram = Histogram(self.buckets)
+        histogram.counts = list(self.counts)
+        histogram.sum = self.sum
+        histogram.count = self.count
+
+        return histogram
+
+
+class Metrics:
+    """counters, latency histograms and hooks of one printer connection"""
+
+    def __init__(self, printer: str = ''):
+        self.printer = printer
+        self.hooks = {event: [] for event in EVENTS}
+        self.commands = Counter()
+        self.latency = dict()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.filtered = 0
+        self.retries = Counter()
+
+    def add_hook(self, event: str, hook):
+        """call hook on event.  'command' hooks get the command code and the line sent,
+        'reply' hooks the command code, the reply and the latency in seconds and 'bytes' hooks
+        the direction, 'sent' or 'received', and the number of bytes"""
+        self.hooks[event].append(hook)
+
+    def remove_hook(self, event: str, hook):
+        self.hooks[event].remove(hook)
+
+    def command_sent(self, code: str, line: bytes):
+        self.commands[code] += 1
+        for hook in self.hooks['command']:
+            hook(code, line)
+
+    def reply_received(self, code: str, reply: bytes, latency: float):
+        histogram = self.latency.get(code)
+        if histogram is None:
+            histogram = self.latency[code] = Histogram()
+        histogram.observe(latency)
+        for hook in self.hooks['reply']:
+            hook(code, reply, latency)
+
+    def sent(self, count: int):
+        self.bytes_sent += count
+        for hook in self.hooks['bytes']:
+            hook('sent', count)
+
+    def received(self, count: int):
+        self.bytes_received += count
+        for hook in self.hooks['bytes']:
+            hook('received', count)
+
+    def line_filtered(self):
+        self.filtered += 1
+
+    def retry(self, kind: str):
+        """count a retry: 'resend' requested by the firmware, 'timeout' without a reply or
+        'packet' for a binary transfer packet"""
+        self.retries[kind] += 1
+
+    def snapshot(self) -> 'Metrics':
+        """a copy of the counters and histograms without the hooks.  metrics are updated
+        without a lock, only the thread using the client may take one"""
+        copy = Metrics(self.printer)
+        copy.commands = Counter(self.commands)
+        copy.latency = {code: histogram.copy() for code, histogram in self.latency.items()}
+        copy.bytes_sent = self.bytes_sent
+        copy.bytes_received = self.bytes_received
+        copy.filtered = self.filtered
+        copy.retries = Counter(self.retries)
+
+        return copy
+
+    def to_dict(self) -> dict:
+        return {
+            'printer': self.printer,
+            'commands': dict(self.commands),
+            'latency': {code: {'count': h.count, 'sum': h.sum,
+                               'buckets': [[bound, total] for bound, total in h.cumulative()
+                                           if bound != float('inf')]}
+                        for code, h in self.latency.items()},
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+            'filtered': self.filtered,
+            'retries': dict(self.retries),
+        }
+
+    def to_prometheus(self) -> str:
+        return export_prometheus([self])
+
+
+def _labels(**labels) -> str:
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in labels.items()) + '}'
+
+
+def _bound(value: float) -> str:
+    return '+Inf' if value == float('inf') else repr(value)
+
+
+def export_prometheus(metrics) -> str:
+    """the metrics of any number of printers in the Prometheus text exposition format"""
+    metrics = list(metrics)
+    lines = []
+
+    def family(name, kind, text):
+        lines.append(f'# HELP {PREFIX}_{name} {text}')
+        lines.append(f'# TYPE {PREFIX}_{name} {kind}')
+
+    def sample(name, value, **labels):
+        lines.append(f'{PREFIX}_{name}{_labels(**labels)} {value}')
+
+    family('command_latency_seconds', 'histogram', 'Time from sending a command to its reply')
+    for m in metrics:
+        for code, histogram in sorted(m.latency.items()):
+            for bound, total in histogram.cumulative():
+                sample('command_latency_seconds_bucket', total, printer=m.printer,
+                       command=code, le=_bound(bound))
+            sample('command_latency_seconds_sum', repr(histogram.sum), printer=m.printer,
+                   command=code)
+            sample('command_latency_seconds_count', histogram.count, printer=m.printer,
+                   command=code)
+
+    family('commands_total', 'counter', 'Commands sent')
+    for m in metrics:
+        for code, count in sorted(m.commands.items()):
+            sample('commands_total', count, printer=m.printer, command=code)
+
+    family('bytes_sent_total', 'counter', 'Bytes written to the printer')
+    for m in metrics:
+        sample('bytes_sent_total', m.bytes_sent, printer=m.printer)
+
+    family('bytes_received_total', 'counter', 'Bytes read from the printer')
+    for m in metrics:
+        sample('bytes_received_total', m.bytes_received, printer=m.printer)
+
+    family('filtered_lines_total', 'counter', 'Status lines dropped from replies')
+    for m in metrics:
+        sample('filtered_lines_total', m.filtered, printer=m.printer)
+
+    family('retries_total', 'counter', 'Lines and packets sent again')
+    for m in metrics:
+        for kind, count in sorted(m.retries.items()):
+            sample('retries_total', count, printer=m.printer, kind=kind)
+
+    return '\n'.join(lines) + '\n'
@@ -6,75 +6,233 @@ Upload a gcode file to a Marlin host and start a print job
 Mock Marlin interface for testing.  Implements the serial port protocol that can be wrapped
 in a Comm object.
 
-Attempting to create a state machine that runs on every call to the serial port read API and
-reads and writes to and from the input and output queue until the state machine blocks on a
-serial read for the next icsp command byte.  At that point the inbound request can be
-satisfied from one of the two queues.
-
-How to do that?  Perhaps this is an example of coroutine programming with yield?  That might simplify the handoff
-in and out of the state machine.  Not sure how to yield out of the state machine without creating a call chain that
-goes deeper and deeper.
-
-todo:
-    add bed and ex temp commands for preheat
-
+The mock is event driven: MarlinHost hands every write to MarlinProc which processes the
+complete lines (or packets) it has received and queues the replies.  Reads only release
+asynchronous output, replies held back by simulated command latency, and an unterminated
+trailing command.
+
+The heaters follow a first order thermal model on the proc's clock so heat-up can be tested
+offline, in virtual time if the clock is a VirtualClock.  SD prints run on the same clock,
+each move taking the time gcode.Motion estimates for it, so progress reports give the real
+position in the file.
+
+The sd card is a dict of file name to bytearray in memory, or a DiskSdCard over a directory
+for cards holding more than fits in memory.
 """
 
-import re
+import os
 import time
+import mmap
+import asyncio
+import zlib
+import math
 import random
 import logging
+from array import array
+from bisect import bisect_right
+from collections import deque
+from collections.abc import MutableMapping
+from itertools import accumulate
+
+import gcode
+import protocol
+from clock import Clock
 
 
 class Buffer:
+    """byte queue backed by a bytearray with a read offset.  writes append in amortized O(1)
+    and reads advance the offset instead of re-slicing the remaining data.  consumed space is
+    reclaimed once it makes up more than half of the underlying storage"""
+
     def __init__(self, data=b''):
-        self.buf = data
+        self.buf = bytearray(data)
+        self.pos = 0
 
     def __len__(self):
-        return len(self.buf)
+        return len(self.buf) - self.pos
+
+    def _take(self, end: int) -> bytes:
+        ret = bytes(memoryview(self.buf)[self.pos:end])
+        self.pos = end
+        if self.pos == len(self.buf):
+            self.reset()
+        elif self.pos > len(self.buf) // 2:
+            del self.buf[:self.pos]
+            self.pos = 0
+
+        return ret
 
     def reset(self):
-        self.buf = bytes()
+        self.buf = bytearray()
+        self.pos = 0
 
     def write(self, data: bytes):
         self.buf += data
 
     def read(self, num_bytes: int):
         """read data"""
-        if len(self.buf) < num_bytes:
-            logging.info(f'{self.buf} < {num_bytes}')
+        if len(self) < num_bytes:
+            logging.info(f'{len(self)} < {num_bytes}')
 
-        ret, self.buf = self.buf[:num_bytes], self.buf[num_bytes:]
-        logging.debug(f'read: {num_bytes} {ret} buf: {self.buf}')
+        ret = self._take(min(self.pos + num_bytes, len(self.buf)))
+        logging.debug(f'read: {num_bytes} {ret} buf: {len(self)}')
 
         return ret
 
     def readline(self):
-        if len(self.buf) < 1:
-            logging.info(f'readline: buf: {self.buf}')
+        if len(self) < 1:
+            logging.info('readline: buf empty')
 
-        nl = self.buf.find(b'\n')
+        nl = self.buf.find(b'\n', self.pos)
         if nl < 0:
-            ret, self.buf = self.buf, bytes()
-        else:
-            ret, self.buf = self.buf[: nl + 1], self.buf[nl + 1:]
+            return self._take(len(self.buf))
 
-        return ret
+        return self._take(nl + 1)
+
+    @property
+    def in_waiting(self) -> int:
+        return len(self)
+
+    def has_line(self) -> bool:
+        return self.buf.find(b'\n', self.pos) >= 0
+
+    def value(self):
+        return bytes(memoryview(self.buf)[self.pos:])
+
+
+class WireBuffer(Buffer):
+    """receiving end of a simulated serial line.  written bytes are sent back to back, each
+    taking bits / baud seconds (10 bits for 8N1), and arrive latency seconds later.  at most
+    rx_size bytes are held.  bytes that arrive while the buffer is full wait for room if the
+    reader is draining it, and are dropped if stalled() says it is not"""
+
+    def __init__(self, clock, baud: int, latency: float = 0.0, rx_size: int = None,
+                 bits: int = 10, data: bytes = b''):
+        Buffer.__init__(self, data)
+        self.clock = clock
+        self.byte_time = bits / baud
+        self.latency = latency
+        self.rx_size = rx_size
+        self.transit = deque()
+        self.tx_free = 0.0
+        self.dropped = 0
+        self.stalled = lambda: True
+
+    def _deliver(self):
+        """move the bytes that have arrived by now into the buffer"""
+        now = self.clock.time()
+        while self.transit:
+            item = self.transit[0]
+            start, data, done = item
+            end = min(len(data), int((now - start) / self.byte_time + 1e-9))
+            if end <= done:
+                break
+
+            if self.rx_size is not None:
+                room = self.rx_size - (len(self.buf) - self.pos)
+                if end - done > room:
+                    if self.stalled():
+                        self.dropped += end - done - room
+                        self.buf += data[done:done + room]
+                        done = end
+                    end = done + room
+
+            self.buf += data[done:end]
+            if end < len(data):
+                item[2] = end
+                break
+            self.transit.popleft()
+
+    def next_arrival(self):
+        """return the time the next write in transit has fully arrived, or the receive buffer
+        is full if that is sooner, or None if nothing is in transit"""
+        if not self.transit:
+            return None
+
+        start, data, done = self.transit[0]
+        end = len(data)
+        if self.rx_size is not None:
+            end = min(end, done + max(self.rx_size - (len(self.buf) - self.pos), 1))
+
+        return start + end * self.byte_time
+
+    def discard(self):
+        """drop everything still in transit"""
+        self.transit.clear()
+
+    def __len__(self):
+        self._deliver()
+        return Buffer.__len__(self)
+
+    def write(self, data: bytes):
+        if data:
+            start = max(self.clock.time(), self.tx_free)
+            self.tx_free = start + len(data) * self.byte_time
+            self.transit.append([start + self.latency, data, 0])
+
+    def read(self, num_bytes: int):
+        self._deliver()
+        return Buffer.read(self, num_bytes)
+
+    def readline(self):
+        self._deliver()
+        return Buffer.readline(self)
+
+    def has_line(self) -> bool:
+        self._deliver()
+        return Buffer.has_line(self)
 
     def value(self):
-        return self.buf
+        self._deliver()
+        return Buffer.value(self)
 
 
 class Port:
     """implements a pySerial serial.Serial object that can be connected to a mock host for
     simulation and testing.  can be configured to introduce noise into the communications for
-    error recovery testing"""
+    error recovery testing and to simulate the timing of a serial line"""
 
-    def __init__(self):
+    def __init__(self, clock=None):
         self._dtr = False
         self.inq = Buffer()
         self.outq = Buffer()
         self.error_prob = {'write': 0.0, 'read': 0.0}
+        self.timeout = None
+        self.clock = clock or Clock()
+        self.wire = False
+
+    def set_wire(self, baud: int, latency: float = 0.0, rx_size: int = None, clock=None):
+        """simulate a serial line at baud in both directions.  rx_size limits the receive
+        buffer at the far end.  reads then wait up to timeout for data to arrive"""
+        self.clock = clock or self.clock
+        self.inq = WireBuffer(self.clock, baud, latency, data=self.inq.value())
+        self.outq = WireBuffer(self.clock, baud, latency, rx_size, data=self.outq.value())
+        self.wire = True
+
+    def _poll(self):
+        """hook for a simulated device to run before data is read"""
+        pass
+
+    def _next_event(self):
+        """return the time something next happens on the line or None"""
+        return self.inq.next_arrival()
+
+    def _wait(self, ready):
+        """on a simulated line wait for ready() to be true or for the timeout to expire"""
+        self._poll()
+        if not self.wire:
+            return
+
+        deadline = None if self.timeout is None else self.clock.time() + self.timeout
+        while not ready():
+            now = self.clock.time()
+            wake = self._next_event()
+            if deadline is not None:
+                wake = deadline if wake is None else min(wake, deadline)
+            if wake is None or (deadline is not None and now >= deadline):
+                break
+            self.clock.sleep(max(wake - now, 1e-6))
+            self._poll()
 
     def _add_noise(self, data: bytes, op: str) -> bytes:
         """return data passed in with simulated transmission errors"""
@@ -130,6 +288,7 @@ class Port:
 
     @property
     def in_waiting(self):
+        self._poll()
         return len(self.inq)
 
     def reset_input_buffer(self):
@@ -137,18 +296,22 @@ class Port:
 
     def reset_output_buffer(self):
         self.outq.reset()
+        if self.wire:
+            self.outq.discard()
 
     def write(self, data: bytes):
         self.outq.write(self._add_noise(data, 'write'))
 
-    def read(self, num_bytes: int):
+    def read(self, num_bytes: int = 1):
+        self._wait(lambda: len(self.inq) >= num_bytes)
         return self._add_noise(self.inq.read(num_bytes), 'read')
 
     def readline(self):
+        self._wait(self.inq.has_line)
         return self._add_noise(self.inq.readline(), 'read')
 
     def send_break(self, duration: int):
-        time.sleep(duration)
+        self.clock.sleep(duration)
         self._clear()
 
     def open(self):
@@ -163,16 +326,17 @@ class Gcode:
 
 
 class Timer():
-    def __init__(self, interval: float):
+    def __init__(self, interval: float, clock=None):
         self.interval = interval
-        self.start_time = time.time()
+        self.clock = clock or Clock()
+        self.start_time = self.clock.time()
         self.reset()
 
     def reset(self):
-        self.target = time.time() + self.interval
+        self.target = self.clock.time() + self.interval
 
     def expired(self):
-        return time.time() > self.target
+        return self.clock.time() > self.target
 
     def tick(self):
         if self.expired():
@@ -186,80 +350,436 @@ class MarlinError(Exception):
     pass
 
 
+class SdFile:
+    """a file on a DiskSdCard.  appends go through a buffered file handle, reads through an
+    mmap of the file that is mapped again once it has grown"""
+
+    def __init__(self, card, name: str, size: int):
+        self.card = card
+        self.path = os.path.join(card.path, name)
+        self.size = size
+        self.writer = None
+        self.map = None
+
+    def __len__(self):
+        return self.size
+
+    def __iadd__(self, data: bytes):
+        self.card._reserve(len(data))
+        self.card._writing(self)
+        if self.writer is None:
+            self.writer = open(self.path, 'ab')
+        self.writer.write(data)
+        self.size += len(data)
+
+        return self
+
+    def _view(self):
+        if self.writer:
+            self.writer.flush()
+        if self.map is None or len(self.map) != self.size:
+            if not self.size:
+                return b''
+            with open(self.path, 'rb') as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        return self.map
+
+    def __getitem__(self, index):
+        return self._view()[index]
+
+    def __delitem__(self, index):
+        """truncate the file, del file[offset:]"""
+        if not isinstance(index, slice) or index.stop is not None or index.step is not None:
+            raise TypeError('only the end of a file can be deleted')
+        offset = min(index.start or 0, self.size)
+        self.close()
+        os.truncate(self.path, offset)
+        self.card.used -= self.size - offset
+        self.size = offset
+
+    def find(self, sub: bytes, *args) -> int:
+        return self._view().find(sub, *args)
+
+    def __bytes__(self):
+        return self._view()[:]
+
+    def __eq__(self, other):
+        return bytes(self) == other
+
+    def close(self):
+        """close the writer and drop the mapping"""
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+        self.map = None
+
+
+class DiskSdCard(MutableMapping):
+    """sd card files in a directory, for cards holding more than fits in memory.  a drop in
+    for the dict of MarlinProc.files whose files are SdFiles.  the sizes are kept in memory
+    so listing the card does not touch the disk.  capacity is in bytes, a write that does not
+    fit fails like one to a full card"""
+
+    def __init__(self, path: str, capacity: int = None):
+        self.path = path
+        self.capacity = capacity
+        os.makedirs(path, exist_ok=True)
+        self.files = {name: SdFile(self, name, os.path.getsize(os.path.join(path, name)))
+                      for name in sorted(os.listdir(path))
+                      if os.path.isfile(os.path.join(path, name))}
+        self.used = sum(len(f) for f in self.files.values())
+        # the file being written, only one writer is kept open
+        self.writer = None
+
+    def _reserve(self, count: int):
+        if self.capacity is not None and self.used + count > self.capacity:
+            raise MarlinError('error writing to file')
+        self.used += count
+
+    def _writing(self, f: SdFile):
+        if self.writer is not f:
+            if self.writer and self.writer.writer:
+                self.writer.writer.close()
+                self.writer.writer = None
+            self.writer = f
+
+    def __getitem__(self, name: str) -> SdFile:
+        return self.files[name]
+
+    def __setitem__(self, name: str, data):
+        if not name or name in ('.', '..') or '/' in name or os.sep in name:
+            raise MarlinError(f'open failed, File: {name}.')
+        if name in self.files:
+            # a print still reading the old file sees it end
+            del self[name]
+        f = self.files[name] = SdFile(self, name, 0)
+        open(f.path, 'wb').close()
+        f += data
+
+    def __delitem__(self, name: str):
+        f = self.files.pop(name)
+        f.close()
+        if self.writer is f:
+            self.writer = None
+        os.unlink(f.path)
+        self.used -= len(f)
+        # anything still holding the file finds it empty
+        f.size = 0
+
+    def __iter__(self):
+        return iter(self.files)
+
+    def __len__(self):
+        return len(self.files)
+
+    def free(self):
+        return None if self.capacity is None else self.capacity - self.used
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.writer = None
+
+
+class SdPrint:
+    """a print from the sd card executed on a clock.  the file is parsed and timed by
+    gcode.Motion a block at a time as the print reaches it, so finding the byte being printed
+    is a bisect and a long file is only worked through as far as the print has got"""
+
+    BLOCK_SIZE = 64 * 1024
+
+    def __init__(self, data, clock, acceleration: float = gcode.DEFAULT_ACCELERATION,
+                 pos: int = 0, elapsed: float = 0.0):
+        self.data = data
+        self.size = len(data)
+        self.clock = clock
+        self.motion = gcode.Motion(acceleration)
+        # print time spent before the last start, and the clock time of that start
+        self.elapsed = elapsed
+        self.started = None
+        # the block being printed: byte offset after each line and the print time when the
+        # line is done
+        self.loaded = self.block_start = pos
+        self.ends = array('L')
+        self.times = array('d')
+        self.block_time = elapsed
+
+    def start(self):
+        self.started = self.clock.time()
+
+    def pause(self):
+        self.elapsed = self.print_time()
+        self.started = None
+
+    @property
+    def paused(self) -> bool:
+        return self.started is None
+
+    def print_time(self) -> float:
+        if self.started is None:
+            return self.elapsed
+
+        return self.elapsed + self.clock.time() - self.started
+
+    def _load(self):
+        """parse and time the next block.  a file cut short under the print ends it where the
+        file now does"""
+        self.size = min(self.size, len(self.data))
+        start = self.loaded
+        if start >= self.size:
+            return
+        end = self.data.find(b'\n', start + self.BLOCK_SIZE - 1)
+        end = self.size if end < 0 else end + 1
+        chunk = bytes(self.data[start:end])
+        lines = chunk.split(b'\n')
+        if lines[-1] == b'':
+            lines.pop()
+
+        durations = self.motion.times(gcode.parse(chunk))
+        if self.times:
+            self.block_time = self.times[-1]
+        self.block_start = start
+        self.ends = array('L', accumulate((len(line) + 1 for line in lines), initial=start))[1:]
+        self.ends[-1] = end
+        self.times = array('d', accumulate(durations, initial=self.block_time))[1:]
+        self.loaded = end
+
+    def position(self) -> int:
+        """offset of the byte after the last line done"""
+        now = self.print_time()
+        while (not self.times or self.times[-1] <= now) and self.loaded < self.size:
+            self._load()
+
+        index = min(bisect_right(self.times, now), len(self.ends))
+        return self.ends[index - 1] if index else self.block_start
+
+    def done(self) -> bool:
+        return self.position() >= self.size
+
+    def next_event(self):
+        """clock time the block being printed is done, so the next one gets loaded in time,
+        or None while paused"""
+        if self.started is None or not self.times:
+            return None
+
+        return self.started + self.times[-1] - self.elapsed
+
+
 class MarlinProc:
     """
     ;   Commands:
     ;
     ;   Gnnn
+    ;   G0/G1: linear move [X<pos>] [Y<pos>] [Z<pos>] [E<pos>] [F<rate>]
     ;
     ;   M20: list sd card:
     ;   M23: select sd file: filename
-    ;   M24: start sd print: [S<pos>] [T<time>]
+    ;   M24: start sd print: [S<pos>] [T<time>]  (runs the file on the clock, resumes a
+    ;        paused print)
     ;   M25:   pause sd print:
-    ;   M27:   report sd print status: [C] [S<seconds>]
-    ;   M28:   start sd write: [B1] filename
+    ;   M27:   report sd print status: [C] [S<seconds>]  (byte position, C the file name, S
+    ;          auto report interval)
+    ;   M28:   start sd write: [B1] [S<offset>] filename  (B1 binary transfer if capable,
+    ;          S resume after the first offset bytes if SD_RESUME capable, refused on
+    ;          the file being printed)
     ;   M29:   stop sd write:
     ;   M30:   delete sd file: filename
     ;   M31:   print time:
+    ;   M110:  set line number: [N<line>]
     ;   M104:  set hotend temperature [S<temp>]  [T<index>]  [F<flag>]
     ;   M105:  report_temperatures [T<index>]
     ;   M115:  get firmware info:
     ;   M140:  set bed temperature [S<temp>]
     :   M155:  temperature auto report [S<sec>]
+    ;   M575:  set baud rate: B<baud>  (if baud_gcode is set, as BAUD_RATE_GCODE)
     """
+    # the rate the firmware is built for, it starts at it after every reboot
+    BAUD_RATE = 115200
+    BAUD_RATES = (2400, 9600, 19200, 38400, 57600, 115200, 250000, 500000, 1000000)
 
-    def __init__(self):
+    def __init__(self, clock=None):
         self.firmware = 'MarlinProc V1.0'
-        self.clock = time.time()
+        self.clock = clock or Clock()
+        self.start_time = self.clock.time()
         self.temp_timer = None
+        self.auto_report_interval = 0
         self.print_timer = None
+        self.sd_status_timer = None
+        self.sd_print = None
+        # mm/s^2, timing of the moves of an sd print
+        self.acceleration = gcode.DEFAULT_ACCELERATION
         self.hotend_target = 0
         self.bed_target = 0
+        # first order thermal model, heaters approach their target or the ambient temperature
+        # exponentially with these time constants in seconds
+        self.ambient = 20.0
+        self.hotend_temp = self.bed_temp = self.ambient
+        self.hotend_tau = 25.0
+        self.bed_tau = 90.0
+        self.thermal_clock = None
+        self.thermal_time = 0.0
         self.sd_selected_filename = None
+        # the file the last M23 named, M28 without a filename writes to it even if it failed
+        # to open
+        self.sd_open_filename = None
         self.sd_write_filename = None
+        self.sd_write_numbered = False
         self.files = dict()
+        self.last_line = 0
+        self.capabilities = dict()
+        self.binary = None
+        self.binary_sequence = 0
+        self.decompressor = None
+        # command buffer and planner sizes (BUFSIZE and BLOCK_BUFFER_SIZE)
+        self.bufsize = 4
+        self.block_buffer_size = 16
+        self.advanced_ok = False
+        self.cmdq = deque()
+        self.planner = 0
+        # simulated command latency in seconds by command, replies are held back until due
+        self.latency = dict()
+        self.default_latency = 0.0
+        self.delayed = deque()
+        self.busy_until = 0.0
+        self.reboots = 0
+        self.baud = self.BAUD_RATE
+        # M575 changes the baud rate, off in Marlin's default configuration.  the new rate
+        # takes effect once the reply is out
+        self.baud_gcode = False
+        self.next_baud = None
+
+        self.cmd_map = {
+            'G0': self._linear_move,
+            'G1': self._linear_move,
+            'M20': self._list_sd_card,
+            'M23': self._select_sd_file,
+            'M24': self._start_sd_print,
+            'M25': self._pause_sd_print,
+            'M27': self._report_sd_print_status,
+            'M28': self._start_sd_write,
+            'M29': self._stop_sd_write,
+            'M30': self._delete_sd_file,
+            'M31': self._print_time,
+            'M110': self._set_line_number,
+            'M104': self._set_hotend_temperature,
+            'M105': self._report_temperatures,
+            'M115': self._firmware_info,
+            'M140': self._set_bed_temperature,
+            'M155': self._set_auto_report,
+            'M575': self._set_baud_rate,
+        }
 
     def reset(self):
         """reset ICSP host"""
-        self.clock = time.time()
+        self.start_time = self.clock.time()
+
+    def set_clock(self, clock):
+        """move to another clock.  the times of pending events carry over so they happen the
+        same time from now on the new clock"""
+        shift = clock.time() - self.clock.time()
+        self.start_time += shift
+        self.busy_until = self.busy_until and self.busy_until + shift
+        self.delayed = deque((due + shift, response) for due, response in self.delayed)
+        for timer in (self.temp_timer, self.print_timer, self.sd_status_timer):
+            if timer:
+                timer.clock = clock
+                timer.start_time += shift
+                timer.target += shift
+        if self.sd_print:
+            self.sd_print.clock = clock
+            if self.sd_print.started is not None:
+                self.sd_print.started += shift
+        self.clock = clock
+
+    def _timer(self, interval: float) -> Timer:
+        return Timer(interval, self.clock)
+
+    def reboot(self):
+        """restart the firmware as a board reset does.  the sd card and the configuration
+        survive, everything else starts over"""
+        self.reset()
+        self._update_temperatures()
+        self.temp_timer = self.print_timer = self.sd_status_timer = None
+        self.sd_print = None
+        self.auto_report_interval = 0
+        self.hotend_target = self.bed_target = 0
+        self.sd_selected_filename = self.sd_open_filename = self.sd_write_filename = None
+        self.sd_write_numbered = False
+        self.binary = self.decompressor = None
+        self.last_line = 0
+        self.cmdq.clear()
+        self.planner = 0
+        self.delayed.clear()
+        self.busy_until = 0.0
+        self.baud = self.BAUD_RATE
+        self.next_baud = None
+        self.reboots += 1
 
     def _decode(self, g: bytes):
         """decode gcode commands"""
-        tokens = g.decode().strip().split()
-
-        args = dict()
-        for token in tokens[1:]:
-            # determine if this is a register spec
-            m = re.fullmatch(r'([a-zA-Z])([0-9-.]*)', token)
-            if m:
-                reg, value = m.groups()
-                args[reg] = value
-            else:
-                args['@'] = token
+        return gcode.tokenize(g)
+
+    def _progress_report(self):
+        """percent done and, once there is something to go by, the time remaining at the
+        rate so far"""
+        pos, size = self.sd_print.position(), self.sd_print.size
+        report = f'NORMAL MODE: Percent done: {100 * pos // size if size else 100}'
+        if pos:
+            remaining = self.sd_print.print_time() * (size - pos) / pos
+            report += f'; print time remaining in mins: {int(remaining // 60)}'
 
-        return tokens[0].upper(), args
+        return report + '\n'
 
     def _tick(self):
-        # todo: add unit test
         # if enough time has passed generate some async output
         response = ''
+        if self.sd_print and not self.sd_print.paused and self.sd_print.done():
+            self.sd_print = self.print_timer = None
+            response += 'Done printing file\n'
         if self.print_timer and self.print_timer.tick():
-            response += 'NORMAL MODE: Percent done: 90; print time remaining in mins: 24\n'
+            response += self._progress_report()
+        if self.sd_status_timer and self.sd_status_timer.tick():
+            response += self._sd_status()
         if self.temp_timer and self.temp_timer.tick():
-            response += 'T:20 B:20\n'
+            response += self._temp_report()
 
         return response
 
+    def _update_temperatures(self):
+        """advance the thermal model to the current time"""
+        now = self.clock.time()
+        if self.thermal_clock is not self.clock:
+            self.thermal_clock, self.thermal_time = self.clock, now
+        dt, self.thermal_time = now - self.thermal_time, now
+
+        def approach(temp, target, tau):
+            goal = target if target > 0 else self.ambient
+            return goal + (temp - goal) * math.exp(-dt / tau)
+
+        self.hotend_temp = approach(self.hotend_temp, self.hotend_target, self.hotend_tau)
+        self.bed_temp = approach(self.bed_temp, self.bed_target, self.bed_tau)
+
     def _temp_report(self):
-        return 'T:20 E:0 B:20\n'
+        """temperatures with their targets while heating"""
+        self._update_temperatures()
+        hotend = f'T:{round(self.hotend_temp, 1):g}'
+        if self.hotend_target > 0:
+            hotend += f' /{self.hotend_target}'
+        bed = f'B:{round(self.bed_temp, 1):g}'
+        if self.bed_target > 0:
+            bed += f' /{self.bed_target}'
+
+        return f'{hotend} E:0 {bed}\n'
 
     def _sd_append(self, filename, gcode):
-        self.files[filename] += gcode
+        """append to a file, bytearray extends in place in amortized O(1) and an SdFile
+        appends to its file"""
+        data = self.files[filename]
+        data += gcode
 
     def _list_sd_card(self, args=None):
-        items = ''
-        for filename, data in self.files.items():
-            items += f'{filename} {len(data)}\n'
+        items = ''.join(f'{filename} {len(data)}\n' for filename, data in self.files.items())
 
         return 'Begin file list\n' + items + 'End file list\n'
 
@@ -269,61 +789,192 @@ class MarlinProc:
         except KeyError:
             raise MarlinError('no filename')
 
-        self.sd_selected_filename = filename
-
+        self.sd_open_filename = filename
         if filename not in self.files:
+            # the firmware closes the selected file before opening another
+            self.sd_selected_filename = None
             raise MarlinError(f'Open failed, File: {filename}.\n')
+        self.sd_selected_filename = filename
 
         return ""
 
     def _start_sd_print(self, args):
-        if self.sd_selected_filename:
-            self.print_timer = Timer(2)
-        else:
+        """start printing the selected file, at byte S and print time T seconds if given, or
+        resume a paused print"""
+        if not self.sd_selected_filename or self.sd_selected_filename not in self.files:
             raise MarlinError('no file selected')
 
+        if not (self.sd_print and self.sd_print.paused and 'S' not in args):
+            self.sd_print = SdPrint(self.files[self.sd_selected_filename], self.clock,
+                                    self.acceleration, pos=int(args.get('S') or 0),
+                                    elapsed=float(args.get('T') or 0))
+            self.start_time = self.clock.time()
+        self.sd_print.start()
+        self.print_timer = self._timer(2)
+
         return ""
 
+    def _pause_sd_print(self, args=None):
+        if self.sd_print:
+            self.sd_print.pause()
+            self.print_timer = None
+
+        return ""
+
+    def _sd_status(self):
+        if not self.sd_print:
+            return 'Not SD printing\n'
+
+        return f'SD printing byte {self.sd_print.position()}/{self.sd_print.size}\n'
+
     def _report_sd_print_status(self, args):
         if 'S' in args:
-            self.sd_status_interval = int(args['S'])
-        elif not self.sd_selected_filename:
+            self.sd_status_interval = int(args['S'] or 0)
+            self.sd_status_timer = self._timer(self.sd_status_interval) \
+                if self.sd_status_interval else None
+            return ""
+        if 'C' in args:
+            return f'Current file: {self.sd_selected_filename}\n'
+        if not self.sd_selected_filename:
             raise MarlinError('Not SD printing')
 
-        return 'printing byte 123/12345\n'
+        return self._sd_status()
 
     def _start_sd_write(self, args):
         if '@' in args:
             self.sd_write_filename = args['@']
-        elif self.sd_selected_filename:
-            self.sd_write_filename = self.sd_selected_filename
+        elif self.sd_open_filename:
+            self.sd_write_filename = self.sd_open_filename
         else:
             raise MarlinError('no filename')
 
-        self.files[self.sd_write_filename] = b''
+        # the print would read the file as it is rewritten
+        data = self.files.get(self.sd_write_filename)
+        if self.sd_print and data is not None and self.sd_print.data is data:
+            filename, self.sd_write_filename = self.sd_write_filename, None
+            raise MarlinError(f'Cannot write while printing, File: {filename}.')
+
+        if 'S' in args and self.capabilities.get('SD_RESUME'):
+            # resume an interrupted write, keep the first S bytes and append after them
+            offset = int(args['S'] or 0)
+            if data is None or offset > len(data):
+                filename, self.sd_write_filename = self.sd_write_filename, None
+                raise MarlinError(f'Resume failed, File: {filename}.')
+            del data[offset:]
+        else:
+            self.files[self.sd_write_filename] = bytearray()
+        self.sd_write_numbered = False
+
+        # switch to binary transfer if requested and supported
+        if args.get('B') == '1' and self.capabilities.get(protocol.BINARY_CAPABILITY):
+            self.binary = protocol.PacketParser()
+            self.binary_sequence = 0
+            self.decompressor = zlib.decompressobj()
 
         return "Writing to file: " + self.sd_write_filename + '\n'
 
     def _stop_sd_write(self, args=None):
+        data = self.files.get(self.sd_write_filename)
+        if isinstance(data, SdFile):
+            data.close()
         self.sd_write_filename = None
+        self.binary = None
 
         return 'Done saving file.\n'
 
+    def _receive_binary(self, data: bytes) -> bytes:
+        """binary transfer state machine.  consume packets from data and return the replies"""
+        response = b''
+        for packet in self.binary.feed(data):
+            expected = self.binary_sequence
+            if packet is None:
+                response += b'rs%d\n' % expected
+                continue
+
+            sequence, packet_type, payload = packet
+            if packet_type == protocol.PACKET_QUERY:
+                # a query restarts the sequence
+                expected = sequence
+            if sequence != expected:
+                if sequence == (expected - 1) & 0xff:
+                    # duplicate of a packet whose ok was lost
+                    response += b'ok%d\n' % sequence
+                else:
+                    response += b'rs%d\n' % expected
+                continue
+
+            if packet_type == protocol.PACKET_QUERY:
+                self.binary_sequence = (sequence + 1) & 0xff
+                response += b'ss%d,%d,zlib\n' % (sequence, protocol.MAX_PAYLOAD)
+                continue
+            try:
+                if packet_type == protocol.PACKET_WRITE:
+                    self._sd_append(self.sd_write_filename, payload)
+                elif packet_type == protocol.PACKET_WRITE_COMPRESSED:
+                    self._sd_append(self.sd_write_filename,
+                                    self.decompressor.decompress(payload))
+                elif packet_type == protocol.PACKET_CLOSE:
+                    self._sd_append(self.sd_write_filename, self.decompressor.flush())
+            except MarlinError as e:
+                # the transfer is abandoned, the packet is never acknowledged
+                self._stop_sd_write()
+                response += f'Error:{e}\n'.encode()
+                break
+            self.binary_sequence = (sequence + 1) & 0xff
+            if packet_type == protocol.PACKET_CLOSE:
+                self._stop_sd_write()
+                response += b'ok%d\n' % sequence
+                break
+            response += b'ok%d\n' % sequence
+
+        return response
+
     def _delete_sd_file(self, args):
         try:
             filename = args['@']
         except KeyError:
             raise MarlinError('Deletion failed, File:')
 
-        try:
-            del self.files[filename]
-        except KeyError:
+        data = self.files.get(filename)
+        if data is None:
             raise MarlinError(f'Deletion failed, File: {filename}')
+        # deleting the file being printed closes it, which ends the print
+        if self.sd_print and self.sd_print.data is data:
+            self.sd_print = self.print_timer = None
+        if self.sd_selected_filename == filename:
+            self.sd_selected_filename = None
+        del self.files[filename]
 
         return f'File deleted:{filename}\n'
 
+    def _check_line(self, g: bytes) -> bytes:
+        """validate the line number and checksum of a numbered line and return the bare
+        command"""
+        # the rest of a long line is lost, a comment is skipped
+        g = g.rstrip(b'\r\n')[:protocol.MAX_CMD_SIZE - 1].split(b';', 1)[0]
+        try:
+            number, command, cs = protocol.parse_numbered(g)
+        except ValueError:
+            raise MarlinError('Line Number is not Last Line Number+1')
+
+        if cs is None:
+            raise MarlinError('No Checksum with line number')
+        if number != self.last_line + 1 and not command.startswith(b'M110'):
+            raise MarlinError('Line Number is not Last Line Number+1')
+        if cs != protocol.checksum(g[:g.rfind(b'*')]):
+            raise MarlinError('checksum mismatch')
+
+        self.last_line = number
+
+        return command + b'\n'
+
+    def _set_line_number(self, args):
+        self.last_line = int(args.get('N') or 0)
+
+        return ""
+
     def _print_time(self, args=None):
-        delta = time.time() - self.clock
+        delta = self.clock.time() - self.start_time
         hours = int(delta / 3600)
         minutes = int(delta / 60)
         seconds = int(delta % 60)
@@ -331,12 +982,13 @@ class MarlinProc:
         return f"echo:{minutes} min, {seconds} sec\n"
 
     def _set_hotend_temperature(self, args):
+        self._update_temperatures()
         try:
             self.hotend_target = int(args['S'])
             if self.hotend_target > 0:
                 if not self.temp_timer:
-                    self.temp_timer = Timer(2)
-            elif self.bed_target <= 0:
+                    self.temp_timer = self._timer(2)
+            elif self.bed_target <= 0 and not self.auto_report_interval:
                 self.temp_timer = None
         except KeyError:
             raise MarlinError('no temperature')
@@ -347,71 +999,184 @@ class MarlinProc:
         return self._temp_report()
 
     def _set_bed_temperature(self, args):
+        self._update_temperatures()
         try:
             self.bed_target = int(args['S'])
             if self.bed_target > 0:
                 if not self.temp_timer:
-                    self.temp_timer = Timer(2)
-            elif self.hotend_target <= 0:
+                    self.temp_timer = self._timer(2)
+            elif self.hotend_target <= 0 and not self.auto_report_interval:
                 self.temp_timer = None
         except KeyError:
             raise MarlinError('no temperature')
 
         return ""
 
+    def _set_auto_report(self, args):
+        try:
+            self.auto_report_interval = int(args['S'])
+        except (KeyError, ValueError):
+            raise MarlinError('no interval')
+
+        if self.auto_report_interval > 0:
+            self.temp_timer = self._timer(self.auto_report_interval)
+        elif self.hotend_target <= 0 and self.bed_target <= 0:
+            self.temp_timer = None
+
+        return ""
+
+    def _set_baud_rate(self, args):
+        """confirm, the rate changes after the reply"""
+        if not self.baud_gcode:
+            raise MarlinError('Unknown command: M575')
+        try:
+            baud = int(args['B'])
+        except (KeyError, ValueError):
+            baud = None
+        if baud not in self.BAUD_RATES:
+            raise MarlinError('?(B)aud rate implausible.')
+        self.next_baud = baud
+
+        return f'echo: Serial 0 baud rate set to {baud}\n'
+
+    def _linear_move(self, args):
+        self.planner = min(self.planner + 1, self.block_buffer_size)
+
+        return ""
+
+    def _ok(self, numbered: bool = False) -> bytes:
+        """acknowledge a command.  with advanced ok include the line number and the free
+        planner and command buffer slots"""
+        if not self.advanced_ok:
+            return b'ok\n'
+
+        line = b' N%d' % self.last_line if numbered else b''
+        planner = self.block_buffer_size - self.planner
+        buffer = self.bufsize - len(self.cmdq)
+
+        return b'ok%s P%d B%d\n' % (line, planner, buffer)
+
     def _firmware_info(self, args):
-        return f'FIRMWARE NAME:{self.firmware}\n'
+        caps = ''.join(f'Cap:{name}:{value}\n' for name, value in self.capabilities.items())
+
+        return f'FIRMWARE NAME:{self.firmware}\n' + caps
+
+    def _respond(self, port, response: bytes, cmd: str = None):
+        """send a reply, delayed by the latency of cmd and behind any reply still held back"""
+        delay = self.latency.get(cmd, self.default_latency) if cmd else 0.0
+        if delay or self.delayed:
+            self.busy_until = max(self.busy_until, self.clock.time()) + delay
+            self.delayed.append((self.busy_until, response))
+        else:
+            port.write(response)
+
+    def _release(self, port):
+        """send delayed replies that are due"""
+        now = self.clock.time()
+        while self.delayed and self.delayed[0][0] <= now:
+            port.write(self.delayed.popleft()[1])
 
-    def run(self, port):
-        """process anything in the input buffer and produce output in the out buffer"""
+    def next_event(self):
+        """return the time a delayed reply is due or a timer expires, or None"""
+        timers = (self.temp_timer, self.print_timer, self.sd_status_timer)
+        events = [timer.target for timer in timers if timer]
+        if self.delayed:
+            events.append(self.delayed[0][0])
+        if self.sd_print and self.sd_print.next_event() is not None:
+            events.append(self.sd_print.next_event())
+
+        return min(events) if events else None
+
+    def stalled(self) -> bool:
+        """true while the command buffer is full and a command is executing"""
+        return len(self.cmdq) >= self.bufsize and self.busy_until > self.clock.time()
+
+    def run(self, port, partial: bool = True):
+        """process anything in the input buffer and produce output in the out buffer.  an
+        unterminated trailing line is only processed if partial is set"""
+
+        if self.next_baud:
+            self.baud, self.next_baud = self.next_baud, None
 
         # generate asynchronous output
         response = self._tick() or ""
         port.write(response.encode())
+        self._release(port)
         # todo: process reports into state variables
 
-        cmd_map = {
-            'M20': self._list_sd_card,
-            'M23': self._select_sd_file,
-            'M24': self._start_sd_print,
-            'M27': self._report_sd_print_status,
-            'M28': self._start_sd_write,
-            'M29': self._stop_sd_write,
-            'M30': self._delete_sd_file,
-            'M31': self._print_time,
-            'M104': self._set_hotend_temperature,
-            'M105': self._report_temperatures,
-            'M115': self._firmware_info,
-            'M140': self._set_bed_temperature,
-        }
+        # moves queued since the last call have been executed
+        self.planner = 0
 
         # process input buffer
-        while port.in_waiting:
-            time.sleep(0.002)
+        while True:
+            # binary transfer in progress, anything buffered as commands is packet data
+            if self.binary:
+                data = b''.join(self.cmdq) + port.read(port.in_waiting)
+                self.cmdq.clear()
+                if not data:
+                    break
+                self._respond(port, self._receive_binary(data))
+                continue
+
+            # fill the command buffer, the rest waits in the serial buffer
+            while port.in_waiting and len(self.cmdq) < self.bufsize:
+                if not partial and not port.inq.has_line():
+                    break
+                self.cmdq.append(port.readline())
+
+            # still busy with the last command, input waits in the buffers
+            self._release(port)
+            if not self.cmdq or self.busy_until > self.clock.time():
+                break
 
             # command
-            g = port.readline()
+            g = self.cmdq.popleft()
+
+            # validate numbered lines and reject checksummed lines without a number
+            numbered = g.startswith(b'N')
+            if numbered or b'*' in g and b'*' in g.split(b';', 1)[0]:
+                try:
+                    if not numbered:
+                        raise MarlinError('No Line Number with checksum')
+                    g = self._check_line(g)
+                except MarlinError as e:
+                    self._respond(port, f'Error:{e}, Last Line: {self.last_line}\n'
+                                  f'Resend: {self.last_line + 1}\n'.encode() + self._ok())
+                    continue
+
+            if not g.strip() and not self.sd_write_filename:
+                continue
 
             # decode
             cmd, args = self._decode(g)
 
             # are we writing to the sd card
             if self.sd_write_filename and cmd != 'M29':
-                self._sd_append(self.sd_write_filename, g)
+                # once the host numbers its lines an unnumbered one is a corrupted fragment
+                if numbered:
+                    self.sd_write_numbered = True
+                elif self.sd_write_numbered:
+                    continue
+                try:
+                    self._sd_append(self.sd_write_filename, g)
+                except MarlinError as e:
+                    self._respond(port, f'Error:{e}\n'.encode())
+                if numbered:
+                    self._respond(port, self._ok(numbered))
             else:
                 # dispatch
                 try:
                     if cmd == 'M29':
                         response = self._stop_sd_write()
-                        port.write(response.encode())
+                        self._respond(port, response.encode(), cmd)
                         continue
                     else:
-                        response = cmd_map[cmd](args)
+                        response = self.cmd_map[cmd](args)
                 except KeyError:
                     response = f'Unknown command: {cmd}\n'
                 except MarlinError as e:
                     response = f'{e}\n'
-                port.write(response.encode() + b'ok\n')
+                self._respond(port, response.encode() + self._ok(numbered), cmd)
 
     def get_file(self, filename):
         return self.files[filename]
@@ -423,33 +1188,117 @@ class MarlinProc:
 
 
 class MarlinHost(Port):
+    BANNER = b'start\necho:SD card ok\r\n'
+
+    def __init__(self, clock=None):
+        Port.__init__(self, clock)
+        # opening the port has just reset the board
+        self._dtr = True
+        self.proc = MarlinProc(self.clock)
+        self.inq = Buffer(self.BANNER)
+        self.host_port = self.get_host_port()
+        # the rate the host opened the port at.  what the host writes at another rate than
+        # the firmware's is lost, what the firmware writes arrives garbled
+        self.baudrate = self.proc.baud
 
-    def __init__(self):
-        Port.__init__(self)
-        self.proc = MarlinProc()
-        self.inq = Buffer(b'start\necho:SD card ok\r\n')
+    def get_host_port(self):
+        host_port = Port.get_host_port(self)
+        host_port._add_noise = self._garble
 
-    def _run(self):
-        self.proc.run(self.get_host_port())
+        return host_port
 
-    @property
-    def in_waiting(self) -> int:
-        """intercept incoming call so Proc can process its input buffer first"""
-        self._run()
-        return super().in_waiting
+    def _garble(self, data: bytes, op: str) -> bytes:
+        if op == 'write' and self.baudrate != self.proc.baud:
+            return bytes(len(data))
 
-    def read(self, num_bytes: int = 1) -> bytes:
-        """intercept incoming call so Proc can process its input buffer first"""
-        self._run()
-        return super().read(num_bytes)
+        return data
+
+    def _set_dtr(self, state: bool):
+        """like most boards asserting DTR resets the firmware, anything in transit is lost"""
+        if state and not self._dtr:
+            self.proc.reboot()
+            self.reset_output_buffer()
+            self.inq.reset()
+            self.host_port.write(self.BANNER)
+        self._dtr = state
+
+    dtr = property(Port.dtr.fget, _set_dtr)
+
+    def set_wire(self, baud: int, latency: float = 0.0, rx_size: int = 128, clock=None):
+        """simulate the serial line to the printer, by default with Marlin's 128 byte
+        receive buffer.  the firmware runs on the same clock as the line"""
+        super().set_wire(baud, latency, rx_size, clock)
+        self.outq.stalled = self.proc.stalled
+        self.proc.set_clock(self.clock)
+        self.host_port = self.get_host_port()
+
+    def _poll(self):
+        """run Proc before data is read so it can process input that has arrived and deliver
+        pending output.  without a simulated line an unterminated command is processed too"""
+        self.proc.run(self.host_port, partial=not self.wire)
+
+    def _next_event(self):
+        events = (self.inq.next_arrival(), self.outq.next_arrival(), self.proc.next_event())
+        events = [event for event in events if event is not None]
+
+        return min(events) if events else None
+
+    def write(self, data: bytes):
+        """process complete commands as soon as they arrive"""
+        if self.baudrate != self.proc.baud:
+            return
+        super().write(data)
+        self.proc.run(self.host_port, partial=False)
 
-    def readline(self) -> bytes:
-        """intercept incoming call so Proc can process its input buffer first"""
-        self._run()
-        return super().readline()
+
+class AsyncStream:
+    """adapt a serial port object such as MarlinHost to the asyncio StreamReader and
+    StreamWriter API.  reads poll the port and yield to the event loop while it is idle"""
+
+    def __init__(self, port, interval: float = 0.001):
+        self.port = port
+        self.interval = interval
+        self.closed = False
+        self._line = b''
+
+    async def readline(self) -> bytes:
+        # always yield so a chatty port cannot starve the other tasks
+        await asyncio.sleep(0)
+        while not self.closed:
+            self._line += self.port.readline()
+            if self._line.endswith(b'\n'):
+                line, self._line = self._line, b''
+                return line
+            await asyncio.sleep(self.interval)
+
+        return b''
+
+    async def read(self, num_bytes: int = 1) -> bytes:
+        await asyncio.sleep(0)
+        while not self.closed:
+            data = self.port.read(num_bytes)
+            if data:
+                return data
+            await asyncio.sleep(self.interval)
+
+        return b''
 
     def write(self, data: bytes):
-        return super().write(data)
+        self.port.write(data)
+
+    async def drain(self):
+        await asyncio.sleep(0)
+
+    def close(self):
+        self.closed = True
+        self.port.close()
+
+
+def open_connection(port=None):
+    """return a (reader, writer) pair for a mock host like asyncio.open_connection"""
+    stream = AsyncStream(port or MarlinHost())
+
+    return stream, stream
 
 
 def main():
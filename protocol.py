@@ -0,0 +1,166 @@
+"""
+Marlin serial protocol helpers shared by the client and the mock host.
+
+Line protocol: a command can be prefixed with a line number and suffixed with a checksum so
+the firmware can detect corrupted or dropped lines and ask for them to be sent again:
+
+    N<number> <command>*<checksum>
+
+The checksum is the XOR of every byte before the '*'.  The firmware answers a bad line with
+an error, a 'Resend: <number>' request and an 'ok'.  It drops everything from a ';' on before
+it looks for the checksum, takes the last '*' as its start and keeps no more than
+MAX_CMD_SIZE - 1 bytes of a line, so comments have to go and lines have to be short.
+
+Binary file transfer: after 'M28 B1 <filename>' the firmware switches to a framed binary mode
+until the file is closed.  This framing is our own and not wire compatible with Marlin's
+BINARY_FILE_TRANSFER, so firmware that speaks it reports the private capability
+BINARY_CAPABILITY instead.  Every packet is
+
+    sync (b5 ad) | sequence u8 | type u8 | length u16 | header crc u16 | payload | payload crc u16
+
+with little endian integers and CRC-16/CCITT checksums.  The receiver answers each packet with
+'ok<sequence>', asks for the expected packet again with 'rs<sequence>' and answers a query with
+'ss<sequence>,<max payload>,<compression>'.  Packets are sent one at a time.
+"""
+
+import re
+import struct
+from binascii import crc_hqx
+
+DIGITS = re.compile(rb'\d+')
+# the firmware's line buffer, including the terminating null
+MAX_CMD_SIZE = 96
+
+
+def checksum(data: bytes) -> int:
+    """XOR of all bytes in data"""
+    cs = 0
+    for b in data:
+        cs ^= b
+
+    return cs
+
+
+def number_line(number: int, command: bytes) -> bytes:
+    """return command framed with a line number and checksum ready to send"""
+    line = b'N%d %s' % (number, command)
+
+    return b'%s*%d\n' % (line, checksum(line))
+
+
+def parse_numbered(line: bytes):
+    """split a numbered line into (number, command, checksum) the way the firmware does, a ';'
+    comment is dropped and the last '*' starts the checksum.  checksum is None when the line
+    has none.  raises ValueError if the line number cannot be parsed"""
+    line = line.rstrip(b'\r\n').split(b';', 1)[0]
+    star = line.rfind(b'*')
+    if star < 0:
+        body, cs = line, None
+    else:
+        # like atoi only the leading digits count
+        body = line[:star]
+        digits = DIGITS.match(line, star + 1)
+        cs = int(digits.group()) if digits else -1
+
+    number, _, command = body.partition(b' ')
+    number = int(number[1:])
+
+    return number, command, cs
+
+
+def parse_resend(line: bytes) -> int:
+    """return the line number of a 'Resend: <n>' reply.  raises ValueError if malformed"""
+    return int(line.split(b':', 1)[1])
+
+
+# the kinds of line the firmware sends by prefix, checked in order.  ok and done end a reply,
+# an error and resend request are part of the reply they come in, the rest are reports the
+# firmware sends on its own and notices that say nothing about the command
+LINE_KINDS = (
+    ('ok', (b'ok',)),
+    ('error', (b'Error:',)),
+    ('resend', (b'Resend:',)),
+    ('done', (b'Done saving file.',)),
+    ('temperature', (b'T:', b' T:')),
+    ('progress', (b'NORMAL MODE:', b'SD printing byte')),
+    ('busy', (b'echo:busy:',)),
+    ('notice', (b'echo:Now fresh file:', b'Done printing file')),
+)
+LINE_PREFIXES = tuple(prefix for _, prefixes in LINE_KINDS for prefix in prefixes)
+REPORTS = ('temperature', 'progress', 'busy')
+
+
+def classify(line: bytes):
+    """the kind of a line from LINE_KINDS, None for the plain text of a reply"""
+    # most lines are ok or reply text, one prefix check settles the latter
+    if not line.startswith(LINE_PREFIXES):
+        return None
+    for kind, prefixes in LINE_KINDS:
+        if line.startswith(prefixes):
+            return kind
+
+
+SYNC = b'\xb5\xad'
+HEADER = struct.Struct('<BBH')
+CRC = struct.Struct('<H')
+HEADER_SIZE = len(SYNC) + HEADER.size + CRC.size
+
+PACKET_QUERY = 0
+PACKET_WRITE = 1
+PACKET_WRITE_COMPRESSED = 2
+PACKET_CLOSE = 3
+
+MAX_PAYLOAD = 512
+BINARY_CAPABILITY = 'MARSER_BINARY'
+
+
+def encode_packet(sequence: int, packet_type: int, payload: bytes = b'') -> bytes:
+    """frame payload as a binary transfer packet"""
+    header = HEADER.pack(sequence & 0xff, packet_type, len(payload))
+
+    return (SYNC + header + CRC.pack(crc_hqx(header, 0)) +
+            payload + CRC.pack(crc_hqx(payload, 0)))
+
+
+class PacketParser:
+    """reassemble packets from a byte stream.  feed returns a list of (sequence, type, payload)
+    tuples, with None in place of a packet that failed its payload checksum"""
+
+    def __init__(self):
+        self.buf = bytearray()
+
+    def feed(self, data: bytes):
+        self.buf += data
+        packets = []
+
+        while True:
+            start = self.buf.find(SYNC)
+            if start < 0:
+                # keep a trailing sync byte, the rest is line noise
+                del self.buf[:max(len(self.buf) - 1, 0)]
+                break
+            del self.buf[:start]
+            if len(self.buf) < HEADER_SIZE:
+                break
+
+            header = bytes(self.buf[2:2 + HEADER.size])
+            (header_crc, ) = CRC.unpack_from(self.buf, 2 + HEADER.size)
+            if header_crc != crc_hqx(header, 0):
+                # corrupt header, look for the next sync
+                del self.buf[:1]
+                continue
+
+            sequence, packet_type, length = HEADER.unpack(header)
+            end = HEADER_SIZE + length + CRC.size
+            if len(self.buf) < end:
+                break
+
+            payload = bytes(self.buf[HEADER_SIZE:HEADER_SIZE + length])
+            (payload_crc, ) = CRC.unpack_from(self.buf, end - CRC.size)
+            del self.buf[:end]
+            if payload_crc != crc_hqx(payload, 0):
+                packets.append(None)
+            else:
+                packets.append((sequence, packet_type, payload))
+
+        return packets
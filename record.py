@@ -0,0 +1,317 @@
+#! /usr/bin/env python3
+
+"""
+Serial session recorder and replay.  RecordingPort wraps a serial.Serial-like port and logs
+everything written to it and read from it with clock times to an append-only file.
+ReplayPort plays a recording back to a client in place of the printer, at the recorded
+speed or as fast as possible, and reports where the client's writes differ from the
+recorded ones.  A capture of a production incident or a slow upload becomes a test or a
+benchmark that runs without the printer.
+
+File format: MAGIC, then records of
+
+    kind u8 | time f64 | length u32 | data
+
+with little endian numbers.  Every RecordingPort starts a session with an 'o' record
+holding the port name, times are seconds since then.  Every record is flushed to the file
+as it is written so a capture survives a crash of the process recording it, the tail of a
+burst included.  Record kinds:
+
+    o   session opened
+    w   bytes written
+    r   bytes read
+    x   bytes dropped from the input buffer by reset_input_buffer
+    d   DTR set, one byte 0 or 1
+
+Replay delivers the bytes read in the recording in order.  Each chunk waits for the client
+to have written as many bytes as had been written when it arrived and then for as long as
+it took to arrive after the last of those writes, so the firmware's response times are
+kept while the client's own speed is what is measured.
+
+    python record.py capture.rec
+"""
+
+import sys
+import struct
+from argparse import ArgumentParser
+from collections import deque
+
+from clock import Clock
+
+MAGIC = b'MSREC\x01'
+RECORD = struct.Struct('<BdI')
+
+
+class RecordingPort:
+    """record a session on port to the file at path.  other attributes are passed through
+    to port"""
+
+    def __init__(self, port, path: str, clock=None):
+        self.wrapped = port
+        self.clock = clock or Clock()
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+        self.start = self.clock.time()
+        self._record(b'o', str(getattr(port, 'port', '') or '').encode())
+
+    def _record(self, kind: bytes, data: bytes):
+        self.file.write(RECORD.pack(kind[0], self.clock.time() - self.start, len(data)))
+        self.file.write(data)
+        self.file.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.wrapped, name)
+
+    @property
+    def timeout(self):
+        return self.wrapped.timeout
+
+    @timeout.setter
+    def timeout(self, timeout):
+        self.wrapped.timeout = timeout
+
+    @property
+    def baudrate(self):
+        return self.wrapped.baudrate
+
+    @baudrate.setter
+    def baudrate(self, baud: int):
+        self.wrapped.baudrate = baud
+
+    @property
+    def dtr(self):
+        return self.wrapped.dtr
+
+    @dtr.setter
+    def dtr(self, state: bool):
+        self._record(b'd', b'\x01' if state else b'\x00')
+        self.wrapped.dtr = state
+
+    def write(self, data: bytes):
+        self._record(b'w', bytes(data))
+        return self.wrapped.write(data)
+
+    def read(self, num_bytes: int = 1) -> bytes:
+        data = self.wrapped.read(num_bytes)
+        if data:
+            self._record(b'r', data)
+
+        return data
+
+    def readline(self) -> bytes:
+        data = self.wrapped.readline()
+        if data:
+            self._record(b'r', data)
+
+        return data
+
+    def reset_input_buffer(self):
+        data = self.wrapped.read(self.wrapped.in_waiting) if self.wrapped.in_waiting else b''
+        if data:
+            self._record(b'x', data)
+        self.wrapped.reset_input_buffer()
+
+    def flush_recording(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+        self.wrapped.close()
+
+
+def read_recording(path: str):
+    """yield the (kind, time, data) records of a recording, kind as a one letter str"""
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'not a recording: {path}')
+        while header := f.read(RECORD.size):
+            if len(header) < RECORD.size:
+                # cut short by a crash while recording
+                break
+            kind, t, length = RECORD.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                break
+            yield chr(kind), t, data
+
+
+def sessions(path: str) -> list:
+    """the records of a recording split into sessions, without the 'o' records"""
+    out = []
+    for kind, t, data in read_recording(path):
+        if kind == 'o':
+            out.append([])
+        elif out:
+            out[-1].append((kind, t, data))
+
+    return out
+
+
+class ReplayPort:
+    """play back a session of a recording to a client.  speed 1 replays at the recorded
+    speed, 2 twice as fast and None as fast as possible.  a write that differs from the
+    recording is noted in divergences, or raises ValueError if strict"""
+
+    def __init__(self, path: str, session: int = 0, speed: float = 1.0, clock=None,
+                 strict: bool = False):
+        self.clock = clock or Clock()
+        self.speed = speed
+        self.strict = strict
+        self.timeout = None
+        self.dtr = True
+        self.divergences = []
+
+        self.expected = bytearray()
+        # chunks read in the recording as [bytes written before, delay after the last of
+        # those writes, data, due time once the client has written as much, kind]
+        self.chunks = deque()
+        written, last_write = 0, 0.0
+        self.recorded_seconds = 0.0
+        for kind, t, data in sessions(path)[session]:
+            self.recorded_seconds = t
+            if kind == 'w':
+                self.expected += data
+                written, last_write = len(self.expected), t
+            elif kind in 'rx':
+                self.chunks.append([written, t - last_write, data, None, kind])
+
+        self.start = self.clock.time()
+        self.written = 0
+        self.buf = bytearray()
+        self.bytes_delivered = 0
+        self._schedule()
+
+    @property
+    def port(self):
+        return 'replay'
+
+    def _delay(self, seconds: float) -> float:
+        return 0.0 if not self.speed else seconds / self.speed
+
+    def _schedule(self):
+        """set the due time of the chunks the client has now written enough for"""
+        now = self.clock.time()
+        for chunk in self.chunks:
+            if chunk[0] > self.written:
+                break
+            if chunk[3] is None:
+                chunk[3] = now + self._delay(chunk[1])
+
+    def _deliver(self):
+        now = self.clock.time()
+        while self.chunks and self.chunks[0][3] is not None and self.chunks[0][3] <= now:
+            data = self.chunks.popleft()[2]
+            self.buf += data
+            self.bytes_delivered += len(data)
+
+    def _wait(self, ready):
+        deadline = None if self.timeout is None else self.clock.time() + self.timeout
+        while True:
+            self._deliver()
+            if ready():
+                return
+            due = self.chunks[0][3] if self.chunks else None
+            if due is None or deadline is not None and due > deadline:
+                # nothing more arrives in time, as fast as possible does not wait it out
+                if self.speed and deadline is not None:
+                    self.clock.sleep(deadline - self.clock.time())
+                return
+            self.clock.sleep(due - self.clock.time())
+
+    @property
+    def in_waiting(self) -> int:
+        self._deliver()
+        return len(self.buf)
+
+    def read(self, num_bytes: int = 1) -> bytes:
+        self._wait(lambda: len(self.buf) >= num_bytes)
+        data = bytes(self.buf[:num_bytes])
+        del self.buf[:num_bytes]
+
+        return data
+
+    def readline(self) -> bytes:
+        self._wait(lambda: b'\n' in self.buf)
+        end = self.buf.find(b'\n') + 1 or len(self.buf)
+        data = bytes(self.buf[:end])
+        del self.buf[:end]
+
+        return data
+
+    def write(self, data: bytes):
+        expected = bytes(self.expected[self.written:self.written + len(data)])
+        if expected != data:
+            self.divergences.append({'offset': self.written, 'expected': expected,
+                                     'written': bytes(data),
+                                     'time': self.clock.time() - self.start})
+            if self.strict:
+                raise ValueError(f'replay diverged at byte {self.written}: {bytes(data)!r}, '
+                                 f'recorded {expected!r}')
+        self.written += len(data)
+        self._schedule()
+
+    def reset_input_buffer(self):
+        """drop what has arrived and what the recording has dropped here, early or not"""
+        self._deliver()
+        self.buf.clear()
+        while self.chunks and self.chunks[0][4] == 'x' and self.chunks[0][3] is not None:
+            self.bytes_delivered += len(self.chunks.popleft()[2])
+
+    def reset_output_buffer(self):
+        pass
+
+    def close(self):
+        pass
+
+    def report(self) -> dict:
+        """how the replay went: bytes written and expected, bytes delivered and left over,
+        divergences and the replay and recorded durations"""
+        return {
+            'written': self.written,
+            'expected': len(self.expected),
+            'delivered': self.bytes_delivered,
+            'undelivered': sum(len(chunk[2]) for chunk in self.chunks) + len(self.buf),
+            'divergences': len(self.divergences),
+            'seconds': self.clock.time() - self.start,
+            'recorded_seconds': self.recorded_seconds,
+        }
+
+
+def summary(path: str) -> list:
+    """per session the port, duration, bytes each way and records"""
+    out = []
+    for kind, t, data in read_recording(path):
+        if kind == 'o':
+            out.append({'port': data.decode(errors='replace'), 'seconds': 0.0, 'written': 0,
+                        'read': 0, 'dropped': 0, 'records': 0})
+            continue
+        if not out:
+            continue
+        session = out[-1]
+        session['seconds'] = t
+        session['records'] += 1
+        if kind == 'w':
+            session['written'] += len(data)
+        elif kind == 'r':
+            session['read'] += len(data)
+        elif kind == 'x':
+            session['dropped'] += len(data)
+
+    return out
+
+
+def main(argv):
+    parser = ArgumentParser(prog='record', description='summarize serial session recordings')
+    parser.add_argument('recording', nargs='+', help='recording file')
+    args = parser.parse_args(args=argv)
+
+    for path in args.recording:
+        for n, session in enumerate(summary(path)):
+            print(f"{path}[{n}] {session['port']} {session['seconds']:.3f}s "
+                  f"written {session['written']} read {session['read']} "
+                  f"dropped {session['dropped']} records {session['records']}")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,327 @@
+"""
+Upload server.  Watches a directory for gcode files and uploads each one to the next idle
+printer, then moves it into a done or failed subdirectory.
+
+Every printer is served by its own worker thread so a slow link only holds up its own
+uploads.  New files go through a bounded queue, when every printer is busy and the queue is
+full the watcher stops taking files until a worker frees a slot.  With an estimator, files
+have their print time estimated on a thread of their own while the printers upload, and
+the queue hands out the longest print first so a batch finishes sooner across the fleet.
+A printer with no estimated file waiting does not wait for the estimator, it takes the next
+file as it came.
+"""
+
+import os
+import json
+import time
+import queue
+import itertools
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+import threading
+
+from atomic import write_atomic
+from metrics import export_prometheus
+from upload import UploadManager
+
+GCODE_SUFFIXES = ('.g', '.gc', '.gco', '.gcode')
+
+
+def is_gcode(filename: str) -> bool:
+    return filename.lower().endswith(GCODE_SUFFIXES) and not filename.startswith('.')
+
+
+class PollWatcher:
+    """report gcode files in a directory once their size and mtime stop changing"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.last = dict()
+        self.reported = set()
+
+    def poll(self, timeout: float):
+        time.sleep(timeout)
+
+        current = dict()
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                if entry.is_file() and is_gcode(entry.name):
+                    stat = entry.stat()
+                    current[entry.path] = (stat.st_size, stat.st_mtime_ns)
+
+        ready = [path for path, state in current.items()
+                 if self.last.get(path) == state and path not in self.reported]
+        self.reported.intersection_update(current)
+        self.reported.update(ready)
+        self.last = current
+
+        return sorted(ready)
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """report gcode files in a directory when they are closed after writing or moved in.
+    raises OSError if inotify is not available"""
+
+    IN_CLOSE_WRITE = 0x08
+    IN_MOVED_TO = 0x80
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self, path: str):
+        self.path = path
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        try:
+            init, add_watch = libc.inotify_init1, libc.inotify_add_watch
+        except AttributeError:
+            raise OSError('inotify not supported')
+
+        self.fd = init(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        if add_watch(self.fd, os.fsencode(path), self.IN_CLOSE_WRITE | self.IN_MOVED_TO) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), f'inotify_add_watch failed: {path}')
+
+        # files already waiting when the watch started
+        self.existing = sorted(entry.path for entry in os.scandir(path)
+                               if entry.is_file() and is_gcode(entry.name))
+
+    def poll(self, timeout: float):
+        ready, self.existing = self.existing, []
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return ready
+
+        data = os.read(self.fd, 64 * 1024)
+        pos = 0
+        while pos < len(data):
+            _, mask, _, length = self.EVENT.unpack_from(data, pos)
+            pos += self.EVENT.size
+            name = os.fsdecode(data[pos:pos + length].rstrip(b'\0'))
+            pos += length
+            if is_gcode(name):
+                ready.append(os.path.join(self.path, name))
+
+        return ready
+
+    def close(self):
+        os.close(self.fd)
+
+
+def watch(path: str):
+    """return an inotify watcher for path if the platform supports it, else a poll watcher"""
+    try:
+        return InotifyWatcher(path)
+    except OSError as e:
+        logging.info(f'falling back to polling: {e}')
+        return PollWatcher(path)
+
+
+class UploadServer:
+    """upload gcode files dropped into watchdir to a pool of connected MarlinClients"""
+
+    def __init__(self, watchdir: str, clients: dict, backlog: int = 100, mode: str = 'line',
+                 interval: float = 1.0, watcher=None, preprocess=None, index=None,
+                 metrics_path: str = None, sessions=None, estimator=None):
+        self.watchdir = watchdir
+        # with a SessionManager the workers borrow their printer's session for each job so
+        # an idle connection is checked, and recovered if need be, before it is used
+        self.sessions = sessions
+        self.clients = sessions.clients() if sessions else clients
+        self.mode = mode
+        self.interval = interval
+        # called for each upload to get a fresh preprocess stage, gcode.Minifier for example
+        self.preprocess = preprocess
+        # with a HashIndex, files a printer already has are skipped and interrupted uploads
+        # resumed
+        self.managers = {name: UploadManager(client, name, index)
+                         for name, client in self.clients.items()} if index else dict()
+        # with an estimate.Estimator each job's print time is estimated before it is queued
+        # and added up per printer
+        self.estimator = estimator
+        self.watcher = watcher or watch(watchdir)
+        # (-print seconds, arrival, path), files without an estimate in the order they came
+        self.jobs = queue.PriorityQueue(maxsize=backlog)
+        self.unestimated = queue.Queue(maxsize=backlog)
+        self.arrivals = itertools.count()
+        self.queued = set()
+        self.stats = {name: {'uploaded': 0, 'skipped': 0, 'resumed': 0, 'failed': 0,
+                             'bytes': 0, 'saved': 0, 'print_seconds': 0.0}
+                      for name in self.clients}
+        # metrics of the clients that have them are written here after every job, as json if
+        # the name ends in .json and in the prometheus text format otherwise
+        self.metrics_path = metrics_path
+        self.metrics_lock = threading.Lock()
+        # the metrics of each printer as its worker last saw them, a worker only reads the
+        # metrics of its own client while another may be updating theirs
+        self.snapshots = {name: client.metrics.snapshot()
+                          for name, client in self.clients.items() if client.metrics}
+        self.stopping = threading.Event()
+        self.workers = []
+
+        for subdir in ('done', 'failed'):
+            os.makedirs(os.path.join(watchdir, subdir), exist_ok=True)
+
+    def _finish(self, path: str, subdir: str):
+        try:
+            os.replace(path, os.path.join(self.watchdir, subdir, os.path.basename(path)))
+        except OSError as e:
+            logging.error(f'cannot move {path}: {e}')
+        self.queued.discard(path)
+
+    def _upload(self, name: str, client, path: str) -> str:
+        """upload a file, returns 'uploaded', 'skipped' or 'resumed'"""
+        preprocess = self.preprocess() if self.preprocess else None
+        if name in self.managers:
+            result, sent = self.managers[name].upload(path, mode=self.mode,
+                                                      preprocess=preprocess)
+            if result == 'skipped':
+                return result
+            self.stats[name]['bytes'] += sent
+        else:
+            result = 'uploaded'
+            with open(path, 'rb') as f:
+                client.save_file(os.path.basename(path), f, mode=self.mode,
+                                 preprocess=preprocess)
+                self.stats[name]['bytes'] += f.tell()
+
+        if preprocess:
+            self.stats[name]['saved'] += getattr(preprocess, 'saved', 0)
+            logging.info(f'{name}: {path} {getattr(preprocess, "saved", 0)} bytes saved')
+
+        return result
+
+    def _next_job(self):
+        """the next job and the queue it came from, an estimated one if there is one waiting
+        and otherwise a file the estimator has not got to, unestimated"""
+        try:
+            return self.jobs.get_nowait(), self.jobs
+        except queue.Empty:
+            pass
+        try:
+            return (0.0, None, self.unestimated.get_nowait()), self.unestimated
+        except queue.Empty:
+            pass
+
+        return self.jobs.get(timeout=self.interval), self.jobs
+
+    def _worker(self, name: str, client):
+        while not self.stopping.is_set():
+            try:
+                (priority, _, path), jobs = self._next_job()
+            except queue.Empty:
+                continue
+
+            try:
+                if self.sessions:
+                    with self.sessions.session(name) as client:
+                        result = self._upload(name, client, path)
+                else:
+                    result = self._upload(name, client, path)
+            except Exception as e:
+                logging.error(f'{name}: upload of {path} failed: {e}')
+                self.stats[name]['failed'] += 1
+                self._finish(path, 'failed')
+            else:
+                logging.info(f'{name}: {result} {path}')
+                self.stats[name][result] += 1
+                self.stats[name]['print_seconds'] -= priority
+                self._finish(path, 'done')
+            finally:
+                jobs.task_done()
+                self.write_metrics(name, client)
+
+    def write_metrics(self, name: str = None, client=None):
+        """write the metrics of every printer, taking a fresh snapshot of the client of
+        printer name.  called from that printer's worker.  failures are logged, a worker
+        carries on without its metrics"""
+        if not self.metrics_path:
+            return
+
+        try:
+            with self.metrics_lock:
+                if client and client.metrics:
+                    self.snapshots[name] = client.metrics.snapshot()
+                metrics = list(self.snapshots.values())
+                if self.metrics_path.endswith('.json'):
+                    text = json.dumps([m.to_dict() for m in metrics], indent=1)
+                else:
+                    text = export_prometheus(metrics)
+                write_atomic(self.metrics_path, text)
+        except Exception as e:
+            logging.error(f'writing metrics to {self.metrics_path} failed: {e}')
+
+    def _put(self, jobs: queue.Queue, item) -> bool:
+        """put item on a queue, waiting for a free slot while it is full.  False if the
+        server stopped first"""
+        while not self.stopping.is_set():
+            try:
+                jobs.put(item, timeout=self.interval)
+                return True
+            except queue.Full:
+                continue
+
+        return False
+
+    def _job(self, path: str) -> tuple:
+        """the queue entry of a file, estimated if there is an estimator"""
+        seconds = 0.0
+        if self.estimator:
+            try:
+                seconds = self.estimator.estimate(path)['seconds']
+                logging.info(f'{path} prints in about {seconds / 60:.0f} min')
+            except (OSError, ValueError) as e:
+                logging.error(f'cannot estimate {path}: {e}')
+
+        return -seconds, next(self.arrivals), path
+
+    def _enqueue(self, path: str):
+        """queue a file, or hand it to the estimator thread if there is an estimator"""
+        self.queued.add(path)
+        if self.estimator:
+            queued = self._put(self.unestimated, path)
+        else:
+            queued = self._put(self.jobs, self._job(path))
+        if not queued:
+            self.queued.discard(path)
+
+    def _estimate_worker(self):
+        while not self.stopping.is_set():
+            try:
+                path = self.unestimated.get(timeout=self.interval)
+            except queue.Empty:
+                continue
+            if not self._put(self.jobs, self._job(path)):
+                self.queued.discard(path)
+
+    def start(self):
+        for name, client in self.clients.items():
+            worker = threading.Thread(target=self._worker, args=(name, client), name=name,
+                                      daemon=True)
+            worker.start()
+            self.workers.append(worker)
+        if self.estimator:
+            worker = threading.Thread(target=self._estimate_worker, name='estimator',
+                                      daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def stop(self):
+        self.stopping.set()
+
+    def serve_forever(self):
+        self.start()
+        try:
+            while not self.stopping.is_set():
+                for path in self.watcher.poll(self.interval):
+                    if path not in self.queued and os.path.exists(path):
+                        self._enqueue(path)
+        finally:
+            self.stopping.set()
+            for worker in self.workers:
+                worker.join()
+            self.watcher.close()
@@ -0,0 +1,159 @@
+"""
+Session manager.  Keeps a connection to each printer open across jobs so a job does not pay
+for opening the port and waiting out a firmware boot every time.  Workers borrow a session
+for the length of a job, a session idle for longer than the check interval is pinged with
+M105 first.
+
+A session that fails its check is recovered with the cheapest step that works:
+
+    resume      drop stale input, close any file left open, ping
+    reopen      close and open the port without asserting DTR, resume
+    reset       pulse DTR and wait for the firmware to boot
+
+Opening a port without a reset is only possible where the platform and the board allow it,
+otherwise reopen resets the board anyway and reset is the only fallback left.
+"""
+
+import logging
+import threading
+from contextlib import contextmanager
+
+from client import MarlinClient
+from clock import Clock
+
+
+class Session:
+    """a printer connection kept open between jobs"""
+
+    def __init__(self, name: str, device: str):
+        self.name = name
+        self.device = device
+        self.client = None
+        self.lock = threading.Lock()
+        self.last_used = None
+        # the last job failed, the firmware may be left mid upload
+        self.failed = False
+        self.reconnects = 0
+        self.resets = 0
+
+
+class SessionManager:
+    """hand out printer sessions to workers.  opener(device, reset) opens the port to a
+    device, with reset False it avoids resetting the board if it can.  fallback, if given,
+    is an opener to try when connecting through opener fails, one that opens the port at the
+    default baud rate for an opener using a tuned one"""
+
+    def __init__(self, opener, check_interval: float = 30.0, reset: bool = False,
+                 client_factory=MarlinClient, clock=None, fallback=None):
+        self.opener = opener
+        self.fallback = fallback
+        self.check_interval = check_interval
+        # always reset the board when connecting, the original behaviour
+        self.reset = reset
+        self.client_factory = client_factory
+        self.clock = clock or Clock()
+        self.sessions = dict()
+
+    def add(self, name: str, device: str) -> Session:
+        self.sessions[name] = Session(name, device)
+        return self.sessions[name]
+
+    def _connect(self, session: Session):
+        client = session.client or self.client_factory(clock=self.clock)
+        try:
+            self._attach(session, client, self.opener(session.device, self.reset))
+        except (OSError, RuntimeError, ConnectionError) as e:
+            if not self.fallback:
+                raise
+            logging.info(f'{session.name}: {e}, trying the fallback')
+            if client.port:
+                client.port.close()
+            self._attach(session, client, self.fallback(session.device, self.reset))
+        session.client = client
+
+    def _attach(self, session: Session, client: MarlinClient, port):
+        if self.reset:
+            client.connect(port)
+        else:
+            try:
+                client.connect(port, reset=False)
+            except ConnectionError as e:
+                logging.info(f'{session.name}: {e}, resetting')
+                client.reset()
+                session.resets += 1
+
+    def _recover(self, session: Session):
+        client = session.client
+        try:
+            client.resume()
+            logging.info(f'{session.name}: resumed')
+            return
+        except (OSError, ConnectionError) as e:
+            logging.info(f'{session.name}: resume failed: {e}')
+
+        try:
+            client.port.close()
+            client.connect(self.opener(session.device, False), reset=False)
+            logging.info(f'{session.name}: reopened')
+            return
+        except (OSError, ConnectionError) as e:
+            logging.info(f'{session.name}: reopen failed: {e}')
+
+        client.reset()
+        session.resets += 1
+        logging.info(f'{session.name}: reset')
+
+    def check(self, session: Session):
+        """connect a new session and ping one that has been idle, recovering it if it does
+        not answer.  after a failed job a ping is not enough, an upload cut short leaves
+        the firmware writing everything it gets to the file and answering ok"""
+        if session.client is None:
+            self._connect(session)
+        elif session.failed or self.clock.time() - session.last_used >= self.check_interval:
+            if session.failed or not session.client.ping():
+                session.reconnects += 1
+                self._recover(session)
+        session.failed = False
+        session.last_used = self.clock.time()
+
+    @contextmanager
+    def session(self, name: str):
+        """borrow the client of a session for a job, only one job uses a session at a time"""
+        session = self.sessions[name]
+        with session.lock:
+            self.check(session)
+            try:
+                yield session.client
+            except Exception:
+                session.failed = True
+                raise
+            finally:
+                session.last_used = self.clock.time()
+
+    def clients(self) -> dict:
+        """session name to client, connecting the sessions that are not connected yet"""
+        out = dict()
+        for name, session in self.sessions.items():
+            with session.lock:
+                if session.client is None:
+                    self.check(session)
+            out[name] = session.client
+
+        return out
+
+    def reset_all(self):
+        """reset every board"""
+        for session in self.sessions.values():
+            with session.lock:
+                if session.client is None:
+                    self._connect(session)
+                session.client.reset()
+                session.resets += 1
+                session.last_used = self.clock.time()
+
+    def close(self):
+        for session in self.sessions.values():
+            with session.lock:
+                if session.client is not None:
+                    session.client.port.close()
+                    session.client = None
@@ -0,0 +1,34 @@
+"""
+File data as a stream of chunks.  Uploads, the minifier and the estimator take bytes, a
+binary file object or an iterable of chunks alike and read it a block at a time, so memory
+stays at a block whatever the size of the file.
+"""
+
+BLOCK_SIZE = 16 * 1024
+
+
+def iter_chunks(data, block_size: int = BLOCK_SIZE):
+    """yield data in blocks.  data can be bytes, a binary file object or an iterable of
+    chunks, which are passed through as they are"""
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        view = memoryview(data)
+        for start in range(0, len(view), block_size):
+            yield bytes(view[start:start + block_size])
+    elif hasattr(data, 'read'):
+        while chunk := data.read(block_size):
+            yield chunk
+    else:
+        yield from data
+
+
+def iter_lines(chunks):
+    """yield the lines of a stream of chunks without line endings"""
+    rest = b''
+    for chunk in chunks:
+        lines = (rest + chunk).split(b'\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line.rstrip(b'\r')
+
+    if rest:
+        yield rest.rstrip(b'\r')
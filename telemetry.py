@@ -0,0 +1,169 @@
+"""
+Printer telemetry.  Temperature and progress reports, from M105 replies or the periodic M155
+auto reports, are parsed into time series kept in fixed size ring buffers so watching a
+printer for days uses the same memory as watching it for an hour.
+
+Report formats:
+
+    T:201.3 /210.0 B:59.8 /60.0 @:127 B@:0      temperature, the targets are optional
+    NORMAL MODE: Percent done: 90; print time remaining in mins: 24
+    SD printing byte 123/12345
+"""
+
+import re
+import math
+from array import array
+from bisect import bisect_left, bisect_right
+
+from clock import Clock
+
+TEMPERATURE = re.compile(rb'(?<![A-Za-z@])([TB])\d*:\s*(-?[0-9.]+)(?:\s*/\s*(-?[0-9.]+))?')
+PERCENT = re.compile(rb'Percent done: (\d+)(?:; print time remaining in mins: (\d+))?')
+SD_BYTES = re.compile(rb'SD printing byte (\d+)/(\d+)')
+TEMPERATURE_PREFIXES = (b'T:', b' T:', b'ok T:')
+PROGRESS_PREFIXES = (b'NORMAL MODE:', b'SD printing byte')
+SERIES = {b'T': ('hotend', 'hotend_target'), b'B': ('bed', 'bed_target')}
+
+
+class RingBuffer:
+    """fixed size time series of (time, value) samples in two preallocated arrays.  once
+    full each new sample overwrites the oldest"""
+
+    def __init__(self, size: int):
+        self.size = size
+        self.times = array('d', bytes(8 * size))
+        self.values = array('d', bytes(8 * size))
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def append(self, t: float, value: float):
+        index = self.count % self.size
+        self.times[index] = t
+        self.values[index] = value
+        self.count += 1
+
+    def latest(self):
+        """the newest (time, value) sample or None"""
+        if not self.count:
+            return None
+
+        index = (self.count - 1) % self.size
+        return self.times[index], self.values[index]
+
+    def _ordered(self, column: array) -> array:
+        if self.count <= self.size:
+            return column[:self.count]
+
+        index = self.count % self.size
+        return column[index:] + column[:index]
+
+    def samples(self, since: float = None, until: float = None) -> list:
+        """(time, value) samples oldest first, from since up to and including until"""
+        times, values = self._ordered(self.times), self._ordered(self.values)
+        start = 0 if since is None else bisect_left(times, since)
+        end = len(times) if until is None else bisect_right(times, until)
+
+        return list(zip(times[start:end], values[start:end]))
+
+    def query(self, since: float = None, until: float = None, step: float = None) -> list:
+        """samples between since and until.  with step they are downsampled to the mean of
+        each step seconds, timed at the start of the step"""
+        samples = self.samples(since, until)
+        if not step:
+            return samples
+
+        out = []
+        bucket, total, n = None, 0.0, 0
+        for t, value in samples:
+            start = math.floor(t / step) * step
+            if start != bucket:
+                if n:
+                    out.append((bucket, total / n))
+                bucket, total, n = start, 0.0, 0
+            total += value
+            n += 1
+        if n:
+            out.append((bucket, total / n))
+
+        return out
+
+
+def parse_temperature(line: bytes) -> dict:
+    """series name to value for a temperature report, the first hotend only"""
+    values = dict()
+    for m in TEMPERATURE.finditer(line):
+        actual, target = SERIES[m.group(1)]
+        if actual in values:
+            continue
+        values[actual] = float(m.group(2))
+        if m.group(3) is not None:
+            values[target] = float(m.group(3))
+
+    return values
+
+
+def parse_progress(line: bytes) -> dict:
+    """series name to value for a progress report"""
+    m = PERCENT.search(line)
+    if m:
+        values = {'progress': float(m.group(1))}
+        if m.group(2) is not None:
+            values['remaining'] = float(m.group(2)) * 60
+        return values
+
+    m = SD_BYTES.search(line)
+    if m and int(m.group(2)):
+        return {'progress': 100.0 * int(m.group(1)) / int(m.group(2))}
+
+    return dict()
+
+
+class Telemetry:
+    """time series of one printer's reports.  feed it every line the printer sends, lines
+    that are not reports are ignored after a prefix check"""
+
+    SERIES = ('hotend', 'hotend_target', 'bed', 'bed_target', 'progress', 'remaining')
+
+    def __init__(self, size: int = 3600, clock=None):
+        self.clock = clock or Clock()
+        self.series = {name: RingBuffer(size) for name in self.SERIES}
+
+    def record(self, values: dict, t: float = None):
+        t = self.clock.time() if t is None else t
+        for name, value in values.items():
+            self.series[name].append(t, value)
+
+    def feed(self, line: bytes):
+        """record a report line.  returns 'temperature' or 'progress' for a report, None for
+        anything else"""
+        if line.startswith(TEMPERATURE_PREFIXES):
+            self.record(parse_temperature(line))
+            return 'temperature'
+        if line.startswith(PROGRESS_PREFIXES):
+            self.record(parse_progress(line))
+            return 'progress'
+
+        return None
+
+    def latest(self, name: str):
+        """the newest value of a series or None"""
+        sample = self.series[name].latest()
+        return sample and sample[1]
+
+    def at_temperature(self, hotend: float, bed: float, tolerance: float) -> bool:
+        """whether the latest readings are within tolerance of the targets, a target of 0
+        is not waited for"""
+        for name, target in (('hotend', hotend), ('bed', bed)):
+            if target > 0:
+                value = self.latest(name)
+                if value is None or abs(value - target) > tolerance:
+                    return False
+
+        return True
+
+    def query(self, name: str, since: float = None, until: float = None,
+              step: float = None) -> list:
+        """(time, value) samples of a series, see RingBuffer.query"""
+        return self.series[name].query(since, until, step)
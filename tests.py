@@ -1,9 +1,36 @@
 #! /usr/bin/env python3
 
+import io
+import os
+import json
+import itertools
+import math
 import time
+import random
+import socket
+import asyncio
+import threading
 import pytest
-from mock import Buffer, Port, MarlinProc, MarlinError, MarlinHost
-from client import MarlinClient
+import mock
+from mock import Buffer, Port, DiskSdCard, MarlinProc, MarlinError, MarlinHost, Timer
+from client import MarlinClient, AsyncMarlinClient
+from clock import VirtualClock
+from server import PollWatcher, UploadServer, watch
+from gcode import Minifier, minify, format_number, tokenize, parse
+from upload import HashIndex, UploadManager
+from session import SessionManager
+from farm import Farm, FdPort
+from record import RecordingPort, ReplayPort, read_recording, summary
+from tune import LinkTuner, TuningProfiles
+from estimate import Estimator, estimate, iter_blocks
+from telemetry import RingBuffer, Telemetry, parse_temperature, parse_progress
+from metrics import Metrics, Histogram, command_code, export_prometheus
+import main
+import bench
+import gcode
+from protocol import checksum, number_line, parse_numbered
+import protocol
+import tune
 
 
 @pytest.fixture()
@@ -21,6 +48,20 @@ def host():
     return MarlinHost()
 
 
+def add_noise(monkeypatch, client, host, noise: float):
+    """corrupt what the client writes while it transfers file data, the commands that open
+    and close the file have no error recovery"""
+    for name in ('_send_numbered', '_send_binary'):
+        def noisy(*args, send=getattr(type(client), name).__get__(client)):
+            host.error_prob['write'] = noise
+            try:
+                return send(*args)
+            finally:
+                host.error_prob['write'] = 0.0
+
+        monkeypatch.setattr(client, name, noisy)
+
+
 @pytest.fixture()
 def procfile():
     proc = MarlinProc()
@@ -40,11 +81,53 @@ def test_readline(port):
     assert port.readline() == b'hello'
 
 
+def test_buffer():
+    buf = Buffer(b'G0\nG1')
+    assert buf.readline() == b'G0\n'
+    buf.write(b'\nG2\n')
+    assert buf.in_waiting == len(buf) == 6
+    assert buf.read(2) == b'G1'
+    assert buf.value() == b'\nG2\n'
+    assert buf.readline() == b'\n'
+    assert buf.readline() == b'G2\n'
+    assert buf.readline() == b''
+    assert buf.read(5) == b''
+
+    line = b'G1 X10.0 Y10.0 E0.5\n'
+    for _ in range(1000):
+        buf.write(line * 10)
+        for _ in range(10):
+            assert buf.readline() == line
+    assert len(buf) == 0
+
+
 def test_write(port):
     port.write(b'abc')
     assert port.outq.value() == b'abc'
 
 
+def test_wire(port):
+    clock = VirtualClock()
+    port.set_wire(9600, latency=0.01, rx_size=4, clock=clock)
+    host_port = port.get_host_port()
+    port.write(b'abcdefgh')
+    assert host_port.in_waiting == 0
+    clock.sleep(0.01 + 2 * 10 / 9600)
+    assert host_port.read(8) == b'ab'
+    clock.sleep(1)
+    assert host_port.read(8) == b'cdef'
+    assert port.outq.dropped == 2
+
+    # reads wait for data up to the timeout
+    port.timeout = 0.5
+    host_port.write(b'xyz\n')
+    assert port.readline() == b'xyz\n'
+    sent = 0.01 + 2 * 10 / 9600 + 1
+    assert clock.time() == pytest.approx(sent + 0.01 + 4 * 10 / 9600)
+    assert port.readline() == b''
+    assert clock.time() == pytest.approx(sent + 0.01 + 4 * 10 / 9600 + 0.5)
+
+
 def test_dtr(port):
     assert port.dtr is False
     port.dtr = True
@@ -108,6 +191,55 @@ def test_sd_delete(proc):
         proc.get_file(filename)
 
 
+def test_disk_sd_card(tmp_path):
+    clock = VirtualClock()
+    host = MarlinHost(clock=clock)
+    host.proc.files = card = DiskSdCard(str(tmp_path / 'sd'), capacity=10000)
+    host.proc.capabilities.update(SD_RESUME=1)
+    client = MarlinClient(clock=clock)
+    client.connect(host)
+
+    data = b'G1 X0 F600\nG1 X10 F600\n' * 260
+    client.save_file('a.gco', data[:3000])
+    client.save_file('a.gco', data[3000:], offset=3000)
+    client.save_file('b.gco', data[:11], mode='line')
+    assert host.proc.get_file('a.gco') == data and (tmp_path / 'sd' / 'b.gco').stat().st_size == 11
+    assert client.list_sd_card() == {'a.gco': 5980, 'b.gco': 11} and card.free() == 4009
+
+    # prints read the file through a mapping
+    client.start_print('a.gco')
+    clock.sleep(100)
+    pos, size = client.print_status()
+    assert 0 < pos < size == 5980
+    clock.sleep(1000)
+    assert client.print_status() is None
+
+    # the card outlives the printer
+    assert {name: len(f) for name, f in DiskSdCard(str(tmp_path / 'sd')).items()} == \
+        {'a.gco': 5980, 'b.gco': 11}
+
+    # a full card fails the write
+    with pytest.raises(ValueError):
+        client.save_file('c.gco', data)
+    assert len(card['c.gco']) + 5991 <= 10000
+    client.resume()
+    # deleting the file being printed ends the print
+    client.start_print('a.gco')
+    clock.sleep(100)
+    client.delete_sd_file('a.gco')
+    assert client.print_status() is None
+    assert card.used == 11 + len(card['c.gco']) and not (tmp_path / 'sd' / 'a.gco').exists()
+    with pytest.raises(MarlinError):
+        card['../x.gco'] = b''
+
+    # a print of a file overwritten under it comes to an end
+    job = mock.SdPrint(card['b.gco'], clock)
+    job.start()
+    card['b.gco'] = b'G1 X1\n'
+    clock.sleep(100)
+    assert job.done()
+
+
 def test_run(proc):
     filename = 'abc.g'
     port = Port()
@@ -123,6 +255,68 @@ def test_run(proc):
     assert port.outq.value() == b'Unknown command: G12345\nok\n'
 
 
+def test_numbered_lines():
+    assert checksum(b'N1 G29') == 19
+    assert number_line(1, b'G29') == b'N1 G29*19\n'
+    assert parse_numbered(b'N1 G29*19\n') == (1, b'G29', 19)
+    assert parse_numbered(b'N2 G29\n') == (2, b'G29', None)
+    # like the firmware, a comment takes the checksum with it and the last * counts
+    assert parse_numbered(b'N3 G29 ; home*1\n') == (3, b'G29 ', None)
+    assert parse_numbered(b'N4 M117 a*b*7\n') == (4, b'M117 a*b', 7)
+
+
+def test_run_numbered(proc):
+    port = Port()
+    port.inq = Buffer(b'M110 N0\nM28 abc.g\n' + number_line(1, b'G29') + number_line(2, b'G1 X1'))
+    proc.run(port)
+    assert port.outq.value() == b'ok\nWriting to file: abc.g\nok\nok\nok\n'
+    assert proc.get_file('abc.g') == b'G29\nG1 X1\n'
+
+    # bad checksum, missing checksum, out of sequence and missing line number
+    port.reset_output_buffer()
+    port.inq = Buffer(b'N3 G29*0\nN3 G29\n' + number_line(4, b'G29') + b'G29*19\n15\n')
+    proc.run(port)
+    resend = b'Last Line: 2\nResend: 3\nok\n'
+    assert port.outq.value() == (b'Error:checksum mismatch, ' + resend +
+                                 b'Error:No Checksum with line number, ' + resend +
+                                 b'Error:Line Number is not Last Line Number+1, ' + resend +
+                                 b'Error:No Line Number with checksum, ' + resend)
+    assert proc.get_file('abc.g') == b'G29\nG1 X1\n'
+
+
+def test_packets():
+    packet = protocol.encode_packet(1, protocol.PACKET_WRITE, b'G29\n')
+    parser = protocol.PacketParser()
+    assert parser.feed(b'noise' + packet[:5]) == []
+    assert parser.feed(packet[5:]) == [(1, protocol.PACKET_WRITE, b'G29\n')]
+
+    bad = packet[:-3] + b'X' + packet[-2:]
+    assert parser.feed(bad + packet) == [None, (1, protocol.PACKET_WRITE, b'G29\n')]
+
+
+def test_receive_binary(proc):
+    proc.capabilities['MARSER_BINARY'] = 1
+    proc._start_sd_write({'@': 'abc.g', 'B': '1'})
+    assert proc._receive_binary(protocol.encode_packet(0, protocol.PACKET_QUERY)) == b'ss0,512,zlib\n'
+    packet = protocol.encode_packet(1, protocol.PACKET_WRITE, b'G29\n')
+    assert proc._receive_binary(packet) == b'ok1\n'
+    assert proc._receive_binary(packet) == b'ok1\n'
+    assert proc._receive_binary(protocol.encode_packet(3, protocol.PACKET_CLOSE)) == b'rs2\n'
+    assert proc._receive_binary(protocol.encode_packet(2, protocol.PACKET_CLOSE)) == b'ok2\n'
+    assert proc.binary is None
+    assert proc.sd_write_filename is None
+    assert proc.get_file('abc.g') == b'G29\n'
+
+
+def test_advanced_ok(proc):
+    proc.advanced_ok = True
+    port = Port()
+    port.inq = Buffer(b'G1 X1\nG1 X2\nM105\nG1 X3\nG1 X4\nM110 N7\n' + number_line(8, b'G1 X5'))
+    proc.run(port)
+    assert port.outq.value() == (b'ok P15 B1\nok P14 B1\nT:20 E:0 B:20\nok P14 B1\n'
+                                 b'ok P13 B1\nok P12 B2\nok P12 B3\nok N8 P11 B4\n')
+
+
 def test_list_sd_card(proc):
     filename, data = 'abc.g', b'G29\n'
     expected = f'Begin file list\n{filename} {len(data)}\nEnd file list\n'
@@ -138,19 +332,90 @@ def test_sd_print(procfile):
         procfile._select_sd_file({})
     with pytest.raises(MarlinError):
         procfile._select_sd_file({'@': 'missing'})
+    with pytest.raises(MarlinError, match='no file selected'):
+        procfile._start_sd_print({})
     procfile._select_sd_file({'@': filename})
     procfile._start_sd_print({})
 
 
 def test_print_time(procfile):
+    clock = VirtualClock()
+    procfile.set_clock(clock)
     filename = 'abc.g'
     assert procfile._print_time() == f"echo:0 min, 0 sec\n"
     procfile._select_sd_file({'@': filename})
     procfile._start_sd_print({})
-    time.sleep(2)
+    clock.sleep(2)
     assert procfile._print_time() == f"echo:0 min, 2 sec\n"
 
 
+def test_long_print():
+    # a ten hour print runs in virtual time, reports come in the order they fall due
+    clock = VirtualClock()
+    host = MarlinHost(clock)
+    host.set_wire(115200)
+    host.timeout = 60
+    # 3600 moves of 100 mm at 10 mm/s, each 10 s plus 1/300 s to accelerate and brake
+    data = b'G1 F600\n' + b'G1 X100\nG1 X0\n' * 1800
+    total = 3600 * (10 + 10 / 3000)
+    host.proc.save_file('long.g', data)
+    host.reset_input_buffer()
+    host.write(b'M23 long.g\nM24\nM155 S5\n')
+    reports = []
+    while True:
+        line = host.readline()
+        if line == b'Done printing file\n':
+            break
+        if not line.startswith(b'ok'):
+            reports.append((clock.time(), line))
+    assert clock.time() == pytest.approx(total, abs=0.01)
+    host.write(b'M31\n')
+    assert host.readline() == b'echo:600 min, 12 sec\n'
+
+    assert [t for t, _ in reports] == sorted(t for t, _ in reports)
+    assert sum(1 for _, line in reports if line[:1] == b'T') == pytest.approx(total / 5, abs=2)
+    progress = [(t, parse_progress(line)) for t, line in reports if line[:1] == b'N']
+    assert len(progress) == pytest.approx(total / 2, abs=2)
+    for t, values in progress:
+        assert values['progress'] == pytest.approx(100 * t / total, abs=1)
+    assert progress[-1][1]['remaining'] < 60
+
+
+def test_sd_print_execution(host):
+    clock = VirtualClock()
+    host.proc.set_clock(clock)
+    data = b'G28\nG1 F6000 X100 ; 1 s + 1/30 s\nG4 P500\nG4 S2\n'
+    host.proc.save_file('job.g', data)
+    client = MarlinClient(clock=clock)
+    client.connect(host)
+    with pytest.raises(ValueError):
+        client.start_print('missing.g')
+    assert client.print_status() is None
+
+    client.start_print('job.g')
+    assert client.print_status() == (4, len(data))
+    # the file being printed is neither overwritten nor resumed under the print
+    host.proc.capabilities['SD_RESUME'] = 1
+    for offset in (0, 8):
+        with pytest.raises(ValueError, match='while printing'):
+            client.save_file('job.g', b'G1 X1\n', offset=offset)
+    assert host.proc.get_file('job.g') == data and client.print_status() == (4, len(data))
+    clock.sleep(1.1)
+    assert client.print_status() == (data.index(b'G4'), len(data))
+
+    # paused prints stand still, M24 resumes them
+    assert client.command('M25') == b'ok\n'
+    clock.sleep(10)
+    assert client.print_status() == (data.index(b'G4'), len(data))
+    assert client.command('M24') == b'ok\n'
+    clock.sleep(0.5)
+    assert client.print_status() == (data.index(b'G4 S2'), len(data))
+    clock.sleep(2)
+    host.proc.run(host.host_port)
+    assert host.readline() == b'Done printing file\n'
+    assert client.print_status() is None
+
+
 def test_report_sd_print_status(procfile):
     filename = 'abc.g'
     with pytest.raises(MarlinError):
@@ -214,9 +479,52 @@ def test_host(host):
     assert host.readline() == b'End file list\n'
 
 
+def test_host_events(host):
+    host.reset_input_buffer()
+    host.write(b'M105\nM1')
+    assert host.host_port.outq.value() == b'T:20 E:0 B:20\nok\n'
+    host.write(b'05\n')
+    assert host.host_port.outq.value() == b'T:20 E:0 B:20\nok\n' * 2
+
+    # replies are held back by command latency and stay in order
+    clock = VirtualClock()
+    host.proc.set_clock(clock)
+    host.reset_input_buffer()
+    host.proc.latency['M31'] = 0.05
+    host.write(b'M31\nM105\n')
+    assert host.readline() == b''
+    clock.sleep(0.06)
+    assert host.readline() == b'echo:0 min, 0 sec\n'
+    assert host.readline() == b'ok\n'
+    assert host.readline() == b'T:20 E:0 B:20\n'
+
+
+def test_host_wire(host):
+    clock = VirtualClock()
+    host.set_wire(115200, clock=clock)
+    host.timeout = 1
+    assert host.readline() == b'start\n'
+    host.reset_input_buffer()
+
+    # request and reply both take their transmission time
+    host.write(b'M105\n')
+    assert host.readline() == b'T:20 E:0 B:20\n'
+    assert clock.time() == pytest.approx((5 + 17) * 10 / 115200)
+    assert host.readline() == b'ok\n'
+
+    # commands sent faster than the firmware executes them overflow its receive buffer
+    host.proc.default_latency = 0.05
+    host.write(b'G1 X1 Y1\n' * 40)
+    replies = b''
+    while line := host.readline():
+        replies += line
+    assert host.outq.dropped > 0
+    assert replies.count(b'ok\n') < 40
+
+
 def test_client(host):
     filename, data = 'xyz.gco', b'G0\nG1\n'
-    client = MarlinClient()
+    client = MarlinClient(clock=VirtualClock())
     client.connect(host)
 
     assert client.firmware_info().startswith(b'FIRMWARE NAME:')
@@ -233,5 +541,752 @@ def test_client(host):
     assert client.delete_sd_file(filename) is None
 
 
+def test_reply_framing(host, monkeypatch):
+    clock = VirtualClock()
+    host.set_wire(9600, latency=0.01, clock=clock)
+    client = MarlinClient(clock=clock)
+    client.connect(host)
+    busy = []
+    client.add_report_hook('busy', busy.append)
+
+    # the whole reply arrives however slow the line
+    reply = client.firmware_info()
+    assert reply.complete and reply.terminator == 'ok' and reply.endswith(b'\nok\n')
+    assert reply.startswith(b'FIRMWARE NAME:') and reply.lines[-1] == b'ok\n'
+    assert reply.latency == pytest.approx(clock.time() - reply.sent)
+    assert reply.latency > len(reply) * 10 / 9600
+
+    # reports go to the side channels, an error is part of the reply up to the ok
+    host.host_port.write(b'echo:busy: processing\r\nT:20 E:0 B:20\n')
+    reply = client.command('N5 G1*1')
+    assert reply.errors and reply.resend == 1 and reply.endswith(b'ok\n')
+    assert busy == [b'echo:busy: processing\n']
+    assert client.telemetry.latest('hotend') == 20
+
+    # unless the report is the reply, progress reports and notices are not
+    host.host_port.write(b'NORMAL MODE: Percent done: 5; print time remaining in mins: 9\n'
+                         b'Done printing file\n')
+    assert client.command('M27') == b'Not SD printing\nok\n'
+    assert client.command('M29').terminator == 'done'
+    # with no file open there is nothing to close
+    monkeypatch.setattr(host.proc, '_stop_sd_write', lambda args=None: 'ok\n')
+    assert client.command('M29').terminator == 'ok'
+    client.resume()
+
+    # a reply cut short by the port timeout
+    host.proc.busy_until = float('inf')
+    assert not client.command('M105').complete
+
+
+def test_client_numbered(host, monkeypatch):
+    random.seed(1)
+    filename = 'xyz.gco'
+    data = b''.join(b'G1 X%d Y%d\n' % (i, i) for i in range(100))
+    client = MarlinClient(clock=VirtualClock())
+    client.connect(host)
+
+    with pytest.raises(ValueError):
+        client.save_file(filename, data, mode='bogus')
+
+    # comments and blank lines are not sent, the firmware would drop the checksum with them
+    client.save_file('a.g', b'G1 X1 ; note*star\n\n  (move) G1 X2\n', mode='line')
+    assert host.proc.get_file('a.g') == b'G1 X1\nG1 X2\n' and not client.resends
+    with pytest.raises(ValueError, match='too long'):
+        client.save_file('a.g', b'M117 ' + b'x' * 100 + b'\n', mode='line')
+    client.resume()
+
+    add_noise(monkeypatch, client, host, 0.2)
+    client.save_file(filename, data, mode='line', window=4)
+    assert host.proc.get_file(filename) == data
+    assert client.resends > 0
+
+    # a line the firmware keeps rejecting fails the upload
+    add_noise(monkeypatch, client, host, 1.0)
+    with pytest.raises(ValueError, match='rejected'):
+        client.save_file(filename, data, mode='line')
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_client_binary(host, monkeypatch, compress):
+    random.seed(1)
+    filename = 'xyz.gco'
+    data = b''.join(b'G1 X%d Y%d\n' % (i, i) for i in range(1000))
+    client = MarlinClient(clock=VirtualClock())
+    client.connect(host)
+
+    # Marlin's own binary transfer speaks another protocol, fall back to numbered lines
+    host.proc.capabilities['BINARY_FILE_TRANSFER'] = 1
+    client.save_file(filename, data[:90], mode='binary')
+    assert host.proc.get_file(filename) == data[:90]
+
+    host = MarlinHost()
+    host.proc.capabilities['MARSER_BINARY'] = 1
+    client = MarlinClient(clock=VirtualClock())
+    client.connect(host)
+    add_noise(monkeypatch, client, host, 0.2)
+    client.save_file(filename, data, mode='binary', compress=compress)
+    assert host.proc.get_file(filename) == data
+    assert host.proc.sd_write_filename is None
+
+
+@pytest.mark.parametrize('mode', ['raw', 'line', 'binary'])
+def test_save_file_stream(mode):
+    filename = 'xyz.gco'
+    data = b''.join(b'G1 X%d Y%d\r\n' % (i, i) for i in range(500))
+    host = MarlinHost()
+    host.proc.capabilities['MARSER_BINARY'] = 1
+    client = MarlinClient(clock=VirtualClock())
+    client.connect(host)
+    expected = data if mode != 'line' else data.replace(b'\r', b'')
+
+    # file object read in small blocks, so lines straddle block boundaries
+    client.save_file(filename, io.BytesIO(data), mode=mode, block_size=7)
+    assert host.proc.get_file(filename) == expected
+
+    # iterable of chunks of varying size
+    chunks = (data[i:i + 100] for i in range(0, len(data), 100))
+    client.save_file(filename, chunks, mode=mode)
+    assert host.proc.get_file(filename) == expected
+
+
+@pytest.mark.parametrize('advanced_ok', [False, True])
+def test_send_commands(host, advanced_ok):
+    host.proc.advanced_ok = advanced_ok
+    client = MarlinClient(clock=VirtualClock())
+    client.connect(host)
+
+    commands = [f'G1 X{n}' for n in range(20)] + ['M31', 'G12345']
+    replies = client.send_commands(commands, window=8)
+    assert len(replies) == len(commands)
+    assert all(reply.startswith(b'ok') for reply in replies[:20])
+    assert replies[20].startswith(b'echo:0 min, 0 sec\nok')
+    assert replies[21].startswith(b'Unknown command: G12345\nok')
+    assert (client.buffer_free is not None) == advanced_ok
+
+
+def test_async_client():
+    async def run():
+        reader, writer = mock.open_connection()
+        client = AsyncMarlinClient(reader, writer)
+        await client.connect()
+        temperatures = client.subscribe('temperature')
+
+        # replies are matched to concurrent commands in order
+        info, print_time = await asyncio.gather(client.firmware_info(), client.command('M31'))
+        assert info == b'FIRMWARE NAME:MarlinProc V1.0\nok\n'
+        assert print_time == b'echo:0 min, 0 sec\nok\n'
+
+        # reports go to subscribers instead of replies
+        assert await client.command('M105') == b'ok\n'
+        assert temperatures.get_nowait() == b'T:20 E:0 B:20\n'
+        reader.port.proc.temp_timer = Timer(0)
+        assert await asyncio.wait_for(temperatures.get(), 1) == b'T:20 E:0 B:20\n'
+
+        # waiting turns auto reports on and back off
+        await client.wait_for_temperatures()
+        assert client.auto_report_interval == reader.port.proc.auto_report_interval == 0
+
+        # closing fails the commands still waiting for a reply
+        pending = asyncio.create_task(client.command('M31'))
+        await asyncio.sleep(0)
+        assert client.pending
+        await client.close()
+        with pytest.raises(ConnectionError):
+            await pending
+        with pytest.raises(ConnectionError):
+            await client.command('M31')
+
+    asyncio.run(run())
+
+
+def test_parse_args():
+    args = main.parse_args(['spool'])
+    assert args.port == ['mock'] and args.watchdir == 'spool'
+    args = main.parse_args(['-p', '/dev/ttyUSB0', '-p', '/dev/ttyUSB1', 'spool'])
+    assert args.port == ['/dev/ttyUSB0', '/dev/ttyUSB1']
+    assert not args.minify
+    args = main.parse_args(['-z', '-t', '0.05', 'spool'])
+    assert args.minify and args.tolerance == 0.05
+    with pytest.raises(SystemExit):
+        main.parse_args(['-t', '0.05', 'spool'])
+    args = main.parse_args(['-x', 'spool'])
+    assert args.reset and not args.reset_on_connect
+    assert main.parse_args(['--farm', '3', 'spool']).farm == 3
+    assert main.parse_args(['--record', 'captures', 'spool']).record == 'captures'
+    assert main.parse_args(['--tune', 'links.json', 'spool']).tune == 'links.json'
+
+
+def test_poll_watcher(tmp_path):
+    watcher = PollWatcher(str(tmp_path))
+    (tmp_path / 'a.gco').write_bytes(b'G0\n')
+    (tmp_path / 'notes.txt').write_bytes(b'')
+    assert watcher.poll(0) == []
+    assert watcher.poll(0) == [str(tmp_path / 'a.gco')]
+    assert watcher.poll(0) == []
+
+
+@pytest.mark.parametrize('polling', [False, True])
+def test_upload_server(tmp_path, polling):
+    hosts = [MarlinHost(), MarlinHost()]
+    clients = dict()
+    for index, host in enumerate(hosts):
+        clients[f'mock{index}'] = MarlinClient(clock=VirtualClock())
+        clients[f'mock{index}'].connect(host)
+        clients[f'mock{index}'].metrics = Metrics(f'mock{index}')
+
+    watcher = PollWatcher(str(tmp_path)) if polling else watch(str(tmp_path))
+    metrics_path = str(tmp_path / 'metrics.prom')
+    server = UploadServer(str(tmp_path), clients, backlog=2, interval=0.01, watcher=watcher,
+                          metrics_path=metrics_path, estimator=Estimator())
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+
+    names = [f'job{n}.gco' for n in range(6)]
+    for name in names:
+        (tmp_path / name).write_bytes(f'G1 X1 ; {name}\n'.encode())
+
+    deadline = time.time() + 10
+    while len(os.listdir(tmp_path / 'done')) < len(names) and time.time() < deadline:
+        time.sleep(0.01)
+    server.stop()
+    thread.join()
+
+    assert sorted(os.listdir(tmp_path / 'done')) == names
+    uploaded = dict()
+    for host in hosts:
+        uploaded.update(host.proc.files)
+    assert sorted(uploaded) == names
+    assert sum(stats['uploaded'] for stats in server.stats.values()) == len(names)
+    # a file an idle printer took before it was estimated adds no print time
+    estimated = sum(stats['print_seconds'] for stats in server.stats.values()) / \
+        estimate(b'G1 X1\n')['seconds']
+    assert estimated == pytest.approx(round(estimated)) and estimated <= len(names)
+    with open(metrics_path) as f:
+        assert 'command="M29"} ' in f.read()
+    # metrics that cannot be written are logged, the worker carries on
+    server.metrics_path = str(tmp_path / 'missing' / 'metrics.prom')
+    server.write_metrics('mock0', clients['mock0'])
+    assert server.snapshots['mock0'].commands == clients['mock0'].metrics.commands
+
+    # the longest print goes first
+    (tmp_path / 'long.gco').write_bytes(b'G1 X0\nG1 X100\n' * 5)
+    paths = [str(tmp_path / 'done' / 'job0.gco'), str(tmp_path / 'long.gco')]
+    assert min(server._job(path) for path in paths)[2] == paths[1]
+    # an idle printer takes a file the estimator has not got to yet
+    server.unestimated.put(paths[1])
+    assert server._next_job() == ((0.0, None, paths[1]), server.unestimated)
+
+
+def test_session_manager():
+    host = MarlinHost()
+    opened = []
+
+    def opener(device, reset):
+        opened.append((device, reset))
+        return host
+
+    clock = VirtualClock()
+    sessions = SessionManager(opener, check_interval=10, clock=clock)
+    session = sessions.add('mock0', 'mock')
+
+    # connecting does not reset the board, a job only pings after the session idled
+    for n in range(3):
+        with sessions.session('mock0') as client:
+            client.save_file(f'job{n}.gco', b'G1 X1\n')
+        clock.sleep(5)
+    assert opened == [('mock', False)]
+    assert sorted(host.proc.files) == ['job0.gco', 'job1.gco', 'job2.gco']
+    assert host.proc.reboots == 0 and session.reconnects == 0
+
+    # a file left open by an interrupted upload is closed without a reset
+    with pytest.raises(TimeoutError):
+        with sessions.session('mock0') as client:
+            client.command('M28 cut.gco')
+            raise TimeoutError
+    with sessions.session('mock0') as client:
+        assert host.proc.sd_write_filename is None
+        client.save_file('job3.gco', b'G1 X1\n')
+    assert host.proc.reboots == 0 and session.reconnects == 1
+
+    # firmware that does not answer is reset once resuming and reopening have failed
+    host.proc.busy_until = float('inf')
+    clock.sleep(10)
+    with sessions.session('mock0') as client:
+        client.save_file('job4.gco', b'G1 X1\n')
+    assert host.proc.reboots == 1 and session.reconnects == 2 and session.resets == 1
+    assert opened == [('mock', False), ('mock', False)]
+    assert host.proc.files['job4.gco'] == b'G1 X1\n'
+
+    sessions.reset_all()
+    assert host.proc.reboots == 2
+    sessions.close()
+    assert session.client is None
+
+    # the firmware is not at the tuned rate any more, connecting falls back to the default
+    def tuned(device, reset):
+        host.baudrate = 250000
+        return host
+
+    def fallback(device, reset):
+        host.baudrate = host.proc.baud
+        return host
+
+    sessions = SessionManager(tuned, clock=clock, fallback=fallback)
+    session = sessions.add('mock0', 'mock')
+    with sessions.session('mock0') as client:
+        client.save_file('job5.gco', b'G1 X1\n')
+    assert host.baudrate == 115200 and host.proc.files['job5.gco'] == b'G1 X1\n'
+
+
+@pytest.mark.parametrize('transport', ['pty', 'socket'])
+def test_farm(transport, tmp_path):
+    with Farm(4, processes=2, transport=transport, sd_path=str(tmp_path)) as farm:
+        clients = dict()
+        for name in farm.names:
+            clients[name] = MarlinClient(clock=VirtualClock())
+            clients[name].connect(farm.port(name))
+        for name, client in clients.items():
+            client.save_file(f'{name}.gco', b'G1 X1\n' * 1000)
+
+        stats = farm.stats()
+        assert sorted(stats) == farm.names
+        for name in farm.names:
+            assert stats[name]['files'] == {f'{name}.gco': 6000}
+            assert stats[name]['bytes_in'] > 6000
+            assert (tmp_path / name / f'{name}.gco').stat().st_size == 6000
+
+        # a hung printer stops answering, pulsing DTR reboots it
+        client = clients['printer1']
+        farm.inject('printer1', 'hang')
+        client.port.timeout = 0.1
+        assert not client.ping()
+        client.reset()
+        assert client.ping()
+        assert farm.stats()['printer1']['reboots'] == 1
+        assert farm.stats()['printer1']['faults'] == 2
+        with pytest.raises(ValueError):
+            farm.inject('printer1', 'fire')
+
+        # a file still open when the farm stops reaches the card
+        client = clients['printer2']
+        client.command('M28 open.gco')
+        client.port.write(protocol.number_line(1, b'G1 X1'))
+        assert client.port.readline().startswith(b'ok')
+    assert (tmp_path / 'printer2' / 'open.gco').read_bytes() == b'G1 X1\n'
+
+
+def test_record_replay(tmp_path):
+    random.seed(3)
+    path = str(tmp_path / 'session.rec')
+    data = b''.join(b'G1 X%d Y%d\n' % (i, i) for i in range(300))
+    clock = VirtualClock()
+    host = MarlinHost(clock=clock)
+    host.set_wire(115200, clock=clock)
+    client = MarlinClient(clock=clock)
+    client.connect(RecordingPort(host, path, clock))
+    host.error_prob['write'] = 0.01
+    client.save_file('xyz.gco', data, mode='line')
+    host.error_prob['write'] = 0.0
+    assert client.list_sd_card() == {'xyz.gco': len(data)} and client.resends
+    # every record is on disk before the port is closed, the last reply included
+    assert list(read_recording(path))[-1][::2] == ('r', b'ok\n')
+    client.port.dtr = False
+    assert list(read_recording(path))[-1][:1] == ('d', )
+    client.port.close()
+    recorded = clock.time()
+
+    kinds = {kind for kind, _, _ in read_recording(path)}
+    assert {'o', 'w', 'r'} <= kinds
+    assert summary(path)[0]['written'] > len(data)
+
+    def replay(data, speed, strict=False):
+        clock = VirtualClock()
+        port = ReplayPort(path, speed=speed, clock=clock, strict=strict)
+        client = MarlinClient(clock=clock)
+        client.connect(port)
+        client.save_file('xyz.gco', data, mode='line')
+        return client, port, client.list_sd_card()
+
+    # the same client does the same in the same time, retries and all
+    replayed, port, files = replay(data, 1.0, strict=True)
+    assert files == {'xyz.gco': len(data)} and replayed.resends == client.resends
+    assert port.report()['undelivered'] == 0
+    assert port.report()['seconds'] == pytest.approx(recorded, rel=0.01)
+
+    # as fast as possible only takes the client's own time
+    _, port, _ = replay(data, None)
+    assert not port.divergences and port.report()['seconds'] < 1.0
+
+    # a client that sends something else
+    _, port, _ = replay(data.replace(b'X150 ', b'X151 '), None)
+    assert port.divergences and port.divergences[0]['expected'].startswith(b'N151 G1 X150 ')
+
+
+def test_link_tuner(tmp_path, monkeypatch):
+    tuner = LinkTuner(window=2)
+    for _ in range(2 + 3):
+        tuner.acked(0.01)
+    assert tuner.window == 4 and tuner.srtt == 0.01
+    tuner.failed()
+    tuner.failed()
+    assert tuner.window == 1 and tuner.error_rate == 2 / 7
+
+    # a noisy link shrinks the window and packets and goes down a baud rate
+    random.seed(2)
+    path = str(tmp_path / 'links.json')
+    profiles = TuningProfiles(path)
+    host = MarlinHost()
+    host.proc.capabilities['MARSER_BINARY'] = 1
+    host.proc.baud_gcode = True
+    client = MarlinClient(clock=VirtualClock())
+    client.connect(host)
+    host.baudrate = host.proc.baud = 250000
+    client.tuner = profiles.tuner('/dev/ttyUSB0', 250000)
+    data = b''.join(b'G1 X%d Y%d\n' % (i, i) for i in range(2000))
+
+    add_noise(monkeypatch, client, host, 0.05)
+    client.save_file('a.gco', data, mode='line')
+    assert host.proc.get_file('a.gco') == data and client.tuner.error_rate > 0.02
+    assert client.tuner.window < tune.MAX_WINDOW and client.tuner.baud == 115200
+    client.metrics = Metrics()
+    packets = []
+    client.metrics.add_hook('command', lambda code, line: code == 'packet' and
+                            packets.append(len(line) - protocol.HEADER_SIZE - 2))
+    client.save_file('b.gco', data, mode='binary', compress=False)
+    assert host.proc.get_file('b.gco') == data
+    assert max(packets) == protocol.MAX_PAYLOAD and min(packets[1:-2]) <= tune.MIN_PAYLOAD * 2
+    assert TuningProfiles(path).baud('/dev/ttyUSB0') == 57600
+    assert host.baudrate == host.proc.baud == 57600
+
+    # a clean one opens up again
+    monkeypatch.undo()
+    client.tuner = TuningProfiles(path).tuner('/dev/ttyUSB0', 57600)
+    for n in range(5):
+        client.save_file('c.gco', data, mode='line')
+    assert client.tuner.window == tune.MAX_WINDOW and client.tuner.baud == 115200
+    client.save_file('c.gco', data, mode='raw')
+    assert TuningProfiles(path).entries['/dev/ttyUSB0']['transfers'] == 7
+
+    # a firmware without M575 keeps its rate, only the window and packets are tuned
+    host.proc.baud_gcode = False
+    for n in range(5):
+        client.save_file('c.gco', data, mode='line')
+    assert client.tuner.fixed and client.tuner.baud == 115200 and client.ping()
+    assert TuningProfiles(path).tuner('/dev/ttyUSB0').fixed
+    # one that confirms but cannot be reached at the new rate goes back
+    host.proc.cmd_map['M575'] = lambda args: 'echo: Serial 0 baud rate set to 2400\n'
+    assert not client.set_baud(2400) and host.baudrate == 115200 and client.ping()
+
+    # the caller's window caps the tuner's
+    in_flight = [0, 0]
+
+    def write(data, write=client._write):
+        in_flight[0] += data.startswith(b'N')
+        in_flight[1] = max(in_flight)
+        write(data)
+
+    def readline(readline=client._readline):
+        line = readline()
+        # the oks of other commands do not count
+        in_flight[0] = max(in_flight[0] - line.startswith(b'ok'), 0)
+        return line
+
+    monkeypatch.setattr(client, '_write', write)
+    monkeypatch.setattr(client, '_readline', readline)
+    client.save_file('d.gco', data, mode='line', window=2)
+    assert in_flight[1] == 2 and client.tuner.window == tune.MAX_WINDOW
+
+
+def test_fd_port():
+    port_end, printer_end = socket.socketpair()
+    port = FdPort(os.dup(port_end.fileno()), 'pair', timeout=0.05, write_timeout=0.05)
+    printer_end.sendall(b'ok\n')
+    assert port.readline() == b'ok\n' and port.readline() == b''
+    # a printer that stops reading fails the write instead of hanging it
+    with pytest.raises(TimeoutError):
+        port.write(b'G1 X1\n' * 1000000)
+    port.close()
+    port_end.close()
+    printer_end.close()
+
+
+def test_farm_pyserial():
+    serial = pytest.importorskip('serial')
+    with Farm(1) as farm:
+        client = MarlinClient(clock=VirtualClock())
+        client.connect(serial.Serial(farm.device('printer0'), baudrate=115200))
+        client.save_file('x.gco', b'G1 X1\n')
+        assert farm.stats()['printer0']['files'] == {'x.gco': 6}
+
+
+def test_minify():
+    assert [format_number(n) for n in (b'0.500', b'-0.0', b'+1.0', b'007', b'-.250')] == \
+        [b'.5', b'0', b'1', b'7', b'-.25']
+
+    data = (b'; sliced\n\nG28 ; home\nG90\nM83\nG1  F1500.0 X10.000 Y10 Z0.2 (first)\n'
+            b'G1 X20 Y10 E1.0\nG1 X30 Y10.01 E1.0\nG1 X40 Y10 E1.0 F1500\nG1 X40 Y20 E1.0\n'
+            b'G1 X40 Y20\nM117 Hello (world) ; msg\nG1 Y30 F1500\nT1\nG1 X40 Y30 F1500\n')
+    assert minify(data) == (b'G28\nG90\nM83\nG1 F1500 X10 Y10 Z.2\nG1 X20 E1\n'
+                            b'G1 X30 Y10.01 E1\nG1 X40 Y10 E1\nG1 Y20 E1\n'
+                            b'M117 Hello (world)\nG1 Y30\nT1\nG1 X40 Y30 F1500\n')
+    assert minify(data, tolerance=0.05) == (b'G28\nG90\nM83\nG1 F1500 X10 Y10 Z.2\n'
+                                            b'G1 X40 Y10 E3\nG1 Y20 E1\n'
+                                            b'M117 Hello (world)\nG1 Y30\nT1\n'
+                                            b'G1 X40 Y30 F1500\n')
+
+    # streamed through an upload in small blocks
+    host = MarlinHost()
+    client = MarlinClient(clock=VirtualClock())
+    client.connect(host)
+    minifier = Minifier(block_size=16)
+    client.save_file('xyz.gco', io.BytesIO(data), mode='line', block_size=5,
+                     preprocess=minifier)
+    assert host.proc.get_file('xyz.gco') == minify(data)
+    assert minifier.saved == len(data) - len(minify(data)) > 0
+
+
+@pytest.mark.parametrize('mode', ['line', 'binary'])
+def test_upload_manager(tmp_path, monkeypatch, mode):
+    def printer(files):
+        host = MarlinHost()
+        host.proc.files = files
+        host.proc.capabilities.update(MARSER_BINARY=1, SD_RESUME=1)
+        client = MarlinClient(clock=VirtualClock())
+        client.connect(host)
+        return host, client
+
+    path = tmp_path / 'xyz.gco'
+    path.write_bytes(b''.join(b'G1 X%d Y%d\n' % (i, i) for i in range(500)))
+    files = dict()
+    host, client = printer(files)
+    manager = UploadManager(client, 'mock0', HashIndex(str(tmp_path / 'index.json')))
+    assert manager.upload(str(path), mode=mode) == ('uploaded', os.path.getsize(path))
+    assert manager.upload(str(path), mode=mode) == ('skipped', 0)
+
+    # cut the connection part way through a changed file
+    path.write_bytes(path.read_bytes().replace(b'G1', b'G0'))
+    send = client._send_numbered if mode == 'line' else client._send_binary
+
+    def broken(data, *args):
+        def head(data):
+            yield from itertools.islice(data, 200 if mode == 'line' else 3)
+            raise OSError('unplugged')
+        send(head(data), *args)
+
+    monkeypatch.setattr(client, '_send_numbered' if mode == 'line' else '_send_binary', broken)
+    with pytest.raises(OSError):
+        manager.upload(str(path), mode=mode, block_size=1024, compress=False)
+    stored = len(files['xyz.gco'])
+    assert 0 < stored < os.path.getsize(path)
+
+    # the printer resets, the sd card and the index on disk survive
+    host, client = printer(files)
+    manager = UploadManager(client, 'mock0', HashIndex(str(tmp_path / 'index.json')))
+    writes = []
+    monkeypatch.setattr(host, 'write', lambda data, write=host.write: writes.append(data) or
+                        write(data))
+    assert manager.upload(str(path), mode=mode) == ('resumed', os.path.getsize(path) - stored)
+    assert host.proc.get_file('xyz.gco') == path.read_bytes()
+    assert (b'M28 B1 S%d\n' if mode == 'binary' else b'M28 S%d\n') % stored in writes
+    assert manager.upload(str(path), mode=mode) == ('skipped', 0)
+
+    # without the capability the upload starts over
+    host, client = printer(files)
+    del host.proc.capabilities['SD_RESUME']
+    assert not client.can_resume()
+    with pytest.raises(ValueError):
+        client.save_file('xyz.gco', b'G0\n', offset=10)
+
+
+def test_telemetry(host):
+    ring = RingBuffer(4)
+    assert len(ring) == 0 and ring.latest() is None
+    for t in range(6):
+        ring.append(t, t * 10)
+    assert len(ring) == 4 and ring.latest() == (5, 50)
+    assert ring.samples() == [(2, 20), (3, 30), (4, 40), (5, 50)]
+    assert ring.query(since=3, until=4) == [(3, 30), (4, 40)]
+    assert ring.query(step=2) == [(2, 25), (4, 45)]
+
+    assert parse_temperature(b'T:201.3 /210.0 B:59.8 /60.0 @:127 B@:0') == \
+        {'hotend': 201.3, 'hotend_target': 210.0, 'bed': 59.8, 'bed_target': 60.0}
+    assert parse_temperature(b'ok T:20 E:0 B:20') == {'hotend': 20.0, 'bed': 20.0}
+    assert parse_progress(b'NORMAL MODE: Percent done: 90; print time remaining in mins: 24') \
+        == {'progress': 90.0, 'remaining': 1440.0}
+    assert parse_progress(b'SD printing byte 50/200') == {'progress': 25.0}
+
+    clock = VirtualClock()
+    telemetry = Telemetry(size=10, clock=clock)
+    for n in range(20):
+        assert telemetry.feed(b'T:%d /200 B:60 /60\n' % (100 + n)) == 'temperature'
+        clock.sleep(1)
+    assert telemetry.feed(b'ok\n') is None
+    assert telemetry.latest('hotend') == 119 and telemetry.latest('bed_target') == 60
+    assert len(telemetry.query('hotend')) == 10
+    assert telemetry.query('hotend', since=15, step=5) == [(15, 117)]
+
+    # reports mixed into replies are recorded and filtered out
+    client = MarlinClient(clock=VirtualClock())
+    client.connect(host)
+    host.write(b'M155 S1\n')
+    assert client.readall() == b'ok\n'
+    host.proc.temp_timer.target = 0
+    assert client.firmware_info().startswith(b'FIRMWARE NAME')
+    assert client.hotend_temp == 20 and client.bed_temp == 20
+    host.write(b'M155 S0\n')
+    assert client.readall() == b'ok\n' and host.proc.temp_timer is None
+
+
+def test_preheat():
+    clock = VirtualClock()
+    host = MarlinHost()
+    host.proc.clock = clock
+    client = MarlinClient(clock=clock)
+    client.connect(host)
+
+    with pytest.raises(ValueError):
+        client.preheat('wood')
+    client.preheat('pla')
+    assert (host.proc.hotend_target, host.proc.bed_target) == (210, 60)
+
+    # heating overlaps the upload, the link stays free while waiting
+    data = b'G1 X1\n' * 100
+    client.save_file('xyz.gco', data, mode='line')
+    assert host.proc.get_file('xyz.gco') == data
+    with pytest.raises(TimeoutError):
+        client.wait_for_temperatures(timeout=10)
+    client.wait_for_temperatures()
+    assert abs(client.hotend_temp - 210) <= 2 and abs(client.bed_temp - 60) <= 2
+    # the bed is the slower heater, it takes tau * ln(40 / 2) to get within 2 degrees
+    assert clock.time() == pytest.approx(host.proc.bed_tau * math.log(40 / 2), abs=2)
+
+    # back to ambient with the heaters off
+    client.set_hotend_temperature(0)
+    client.set_bed_temperature(0)
+    clock.sleep(3600)
+    assert host.proc._temp_report() == 'T:20 E:0 B:20\n'
+
+
+def test_metrics(host, monkeypatch):
+    assert command_code(b'N12 g1 X10*91\n') == 'G1' and command_code(b'M105\n') == 'M105'
+    histogram = Histogram((0.1, 1.0))
+    for value in (0.05, 0.5, 0.5, 5):
+        histogram.observe(value)
+    assert histogram.cumulative() == [(0.1, 1), (1.0, 3), (float('inf'), 4)]
+    assert histogram.quantile(0.5) == 1.0
+
+    random.seed(1)
+    client = MarlinClient(clock=VirtualClock())
+    client.connect(host)
+    client.metrics = Metrics('mock0')
+    events = []
+    client.metrics.add_hook('reply', lambda code, reply, latency: events.append(code))
+    add_noise(monkeypatch, client, host, 0.1)
+    data = b'G1 X1\n' * 100
+    client.save_file('xyz.gco', data, mode='line')
+    client.send_commands(['M105', 'M105'])
+    assert host.proc.get_file('xyz.gco') == data
+
+    metrics = client.metrics
+    assert metrics.commands['G1'] >= 100 and metrics.commands['M105'] == 2
+    assert metrics.latency['G1'].count == 100 and metrics.latency['M29'].count == 1
+    assert sum(metrics.retries.values()) == client.resends > 0
+    assert metrics.bytes_sent > len(data) and metrics.bytes_received > 0
+    assert events.count('G1') == 100 and events[-2:] == ['M105', 'M105']
+
+    text = export_prometheus([metrics, Metrics('idle')])
+    assert '# TYPE marser_command_latency_seconds histogram' in text
+    assert 'marser_command_latency_seconds_count{printer="mock0",command="G1"} 100' in text
+    assert 'marser_commands_total{printer="mock0",command="M105"} 2' in text
+    assert 'marser_bytes_sent_total{printer="idle"} 0' in text
+    assert json.loads(json.dumps(metrics.to_dict()))['commands']['M105'] == 2
+
+
+def test_tokenize():
+    assert tokenize(b'') == ('', {})
+    assert tokenize(b' g1 X10 y-1.5 E\r\n') == ('G1', {'X': '10', 'y': '-1.5', 'E': ''})
+    assert tokenize(b'M28 B1 file.gco') == ('M28', {'B': '1', '@': 'file.gco'})
+    assert tokenize('M23 a.gco b.gco') == ('M23', {'@': 'b.gco'})
+
+    program = parse(b'G28 (home)\n\n; layer\ng01 x1 Y-.5 E\nM23 x.gco\nG1 X2')
+    assert len(program) == 6 and program.count('G1') == 2
+    assert [program.command(i) for i in range(6)] == ['G28', '', '', 'G1', 'M23', 'G1']
+    words = program.words(3)
+    assert words['X'] == 1.0 and words['Y'] == -0.5 and math.isnan(words['E'])
+    assert program.words(4) == {} and program.words(5) == {'X': 2.0}
+    program = parse(b'G1X10Y-2.5\nG1 X 3 E\n')
+    assert program.command(0) == 'G1' and program.words(0) == {'X': 10.0, 'Y': -2.5}
+    assert program.words(1)['X'] == 3.0 and math.isnan(program.words(1)['E'])
+    # a comment left open ends with its line
+    program = parse(b'M117 hi (b\nG1 X10\nG1 X20 (c)\nG1 X30\n')
+    assert len(program) == 4 and [program.words(i)['X'] for i in (1, 2, 3)] == [10, 20, 30]
+
+
+def test_motion():
+    motion = gcode.Motion(acceleration=1000, feedrate=6000)
+    times = motion.times(parse(b'G1 X100\nG1 X100.1\nG91\nG1 Y-3 Z4 ; 5 mm\nM83\nG1 E2\n'
+                               b'G90\nG92 X0\nG28 Y\nG4 P250\nM105\n'))
+    # full speed moves take distance / speed + speed / acceleration, short ones never get
+    # there and take 2 * sqrt(distance / acceleration)
+    triangle = [2 * math.sqrt(d / 1000) for d in (0.1, 5, 2, 3)]
+    assert list(times) == pytest.approx([1.1, triangle[0], 0, triangle[1], 0, triangle[2],
+                                         0, 0, triangle[3], 0.25, 0])
+    assert motion.position == pytest.approx([0, 0, 4, 2])
+    # the state carries over to the next block
+    assert list(motion.times(parse(b'G1 E3 F600\n'))) == pytest.approx([0.1 + 0.01])
+
+
+def test_estimate(tmp_path):
+    assert list(iter_blocks([b'G1 X1\nG1', b' X2\n', b'G1 X3'])) == \
+        [b'G1 X1\n', b'G1 X2\n', b'G1 X3']
+
+    # a square, the corners are taken at the junction speed instead of stopping
+    square = b'G1 F6000\n' + b'G1 X100 Y0\nG1 X100 Y100\nG1 X0 Y100\nG1 X0 Y0\n' * 10
+    stopping = estimate(square, acceleration=1000, junction_deviation=None)
+    assert stopping['seconds'] == pytest.approx(40 * 1.1)
+    assert stopping['lines'] == 41 and stopping['moves'] == 40
+    planned = estimate(square, acceleration=1000)
+    sin = math.sqrt(0.5)
+    corner = math.sqrt(1000 * 0.013 * sin / (1 - sin))
+    # each corner saves corner / 1000 s on braking and as much on accelerating, less the
+    # time to cover the distance that takes at 100 mm/s
+    saved = 2 * corner / 1000 - corner * corner / 1000 / 100
+    assert planned['seconds'] == pytest.approx(40 * 1.1 - 39 * saved)
+    # straight moves run into each other at full speed
+    line = b'G1 F6000 X10\nG1 X20\nG1 X30\n'
+    assert estimate(line, acceleration=1000)['seconds'] == pytest.approx(0.3 + 0.1)
+    # block boundaries stop, small blocks only add braking
+    assert estimate(square, acceleration=1000, block_size=64)['seconds'] > planned['seconds']
+
+    path = tmp_path / 'square.gco'
+    path.write_bytes(square)
+    cache = str(tmp_path / 'estimates.json')
+    estimator = Estimator(cache, acceleration=1000)
+    assert estimator.estimate(str(path)) == planned
+    assert estimator.estimate(str(path)) == planned
+    assert (estimator.hits, estimator.misses) == (1, 1)
+    # the cache survives restarts, other settings are estimated again
+    estimator = Estimator(cache, acceleration=1000)
+    assert estimator.estimate(str(path)) == planned and estimator.hits == 1
+    estimator = Estimator(cache, acceleration=2000)
+    assert estimator.estimate(str(path))['seconds'] < planned['seconds']
+    assert estimator.misses == 1
+
+
+def test_bench(tmp_path):
+    data = bench.generate_gcode(10000)
+    assert len(data) <= 10000 and data.endswith(b'\n')
+    assert bench.parse_size('10K') == 10240
+
+    output = tmp_path / 'bench.json'
+    bench.main(['-s', '2K', '-m', 'raw,line,binary', '-n', '0,0.05', '-o', str(output)])
+    bench.main(['-s', '2K', '-m', 'line', '-n', '0', '-b', '115200', '-o', str(output),
+                '-c', str(output)])
+    results = json.loads(output.read_text())['results']
+    assert [r['mode'] for r in results] == ['line']
+    assert all(r['verified'] for r in results)
+    assert results[0]['link_seconds'] > 2048 * 10 / 115200
+
+
 if __name__ == '__main__':
     pytest.main(['-v', './tests.py'])
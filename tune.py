@@ -0,0 +1,172 @@
+"""
+Adaptive link tuning.  A LinkTuner attached to a MarlinClient sizes its transfers from the
+errors it sees, the way TCP sizes its congestion window: every window of lines acknowledged
+without an error grows the window of numbered lines in flight by one, every resend request
+or timeout halves it.  Binary transfers do the same with the packet payload, smaller packets
+cost less to send again on a noisy line.
+
+After each transfer the error rate picks the baud rate to move to: a link that fails more
+than MAX_ERROR_RATE of the time goes down a rate, one that has been clean for CLEAN_UPLOADS
+transfers tries the next rate up, and goes back down if that turns out noisy.  The client
+changes the rate with M575 once the file is closed and checks the firmware answers at the
+new one.  A firmware that does not confirm M575, or cannot be reached after it, keeps its
+rate and only the window and payload are tuned from then on.  TuningProfiles keeps the
+settings of each port in a json file so a printer starts where it left off.
+"""
+
+import os
+import json
+import threading
+
+from atomic import write_atomic
+
+MIN_WINDOW = 1
+MAX_WINDOW = 16
+MIN_PAYLOAD = 64
+BAUD_RATES = (57600, 115200, 250000)
+# error rate that makes the link go down a baud rate
+MAX_ERROR_RATE = 0.02
+# clean transfers in a row before trying a faster baud rate
+CLEAN_UPLOADS = 5
+
+
+class LinkTuner:
+    """AIMD window and packet payload of one port.  payload None uses the firmware's
+    maximum, baud None leaves the baud rate alone.  target is the rate the link should move
+    to, fixed is set once the firmware failed to"""
+
+    def __init__(self, window: int = 4, payload: int = None, baud: int = None,
+                 name: str = '', profiles=None):
+        self.window = window
+        self.payload = payload
+        self.baud = self.target = baud
+        self.fixed = False
+        self.name = name
+        self.profiles = profiles
+        self.max_payload = None
+        # smoothed round trip time of a line or packet in seconds
+        self.srtt = None
+        self.clean = 0
+        self.transfers = 0
+        self.acks = self.errors = 0
+        self.credit = 0
+
+    @property
+    def error_rate(self) -> float:
+        """errors per line or packet sent in the current or last transfer"""
+        return self.errors / (self.acks + self.errors) if self.acks or self.errors else 0.0
+
+    def start(self):
+        self.acks = self.errors = self.credit = 0
+
+    def packet_size(self, max_payload: int) -> int:
+        """the payload of the next binary packet, at most max_payload"""
+        self.max_payload = max_payload
+        if self.payload is None or self.payload > max_payload:
+            self.payload = max_payload
+
+        return self.payload
+
+    def acked(self, rtt: float = None):
+        """a line or packet went through, grow by one every window of them"""
+        self.acks += 1
+        if rtt is not None:
+            self.srtt = rtt if self.srtt is None else self.srtt + (rtt - self.srtt) / 8
+        self.credit += 1
+        if self.credit >= self.window:
+            self.credit = 0
+            self.window = min(self.window + 1, MAX_WINDOW)
+            if self.payload and self.max_payload:
+                self.payload = min(self.payload + MIN_PAYLOAD, self.max_payload)
+
+    def failed(self):
+        """a line or packet had to be sent again, halve"""
+        self.errors += 1
+        self.credit = 0
+        self.window = max(self.window // 2, MIN_WINDOW)
+        if self.payload:
+            self.payload = max(self.payload // 2, MIN_PAYLOAD)
+
+    def finish(self):
+        """end of a transfer, pick the baud rate to move to and save the profile.  a raw
+        transfer gets no acknowledgements and tells nothing"""
+        if not self.acks and not self.errors:
+            return
+        self.transfers += 1
+        if self.error_rate > MAX_ERROR_RATE:
+            self.clean = 0
+            self.target = self._step_baud(-1)
+        elif self.errors:
+            self.clean = 0
+        else:
+            self.clean += 1
+            if self.clean >= CLEAN_UPLOADS:
+                self.clean = 0
+                self.target = self._step_baud(1)
+
+        if self.profiles:
+            self.profiles.store(self)
+
+    def switched(self, ok: bool):
+        """the link moved to target, or did not and keeps its baud rate from now on"""
+        if ok:
+            self.baud = self.target
+        else:
+            self.fixed = True
+            self.target = self.baud
+        if self.profiles:
+            self.profiles.store(self)
+
+    def _step_baud(self, step: int):
+        if self.fixed or self.baud not in BAUD_RATES:
+            return self.baud
+        index = BAUD_RATES.index(self.baud) + step
+
+        return BAUD_RATES[min(max(index, 0), len(BAUD_RATES) - 1)]
+
+    def to_dict(self) -> dict:
+        return {'window': self.window, 'payload': self.payload, 'baud': self.baud,
+                'srtt': self.srtt, 'error_rate': self.error_rate, 'clean': self.clean,
+                'transfers': self.transfers, 'fixed': self.fixed}
+
+
+class TuningProfiles:
+    """tuned settings by port, kept in a json file if path is given.  safe to share between
+    the upload threads of several printers"""
+
+    def __init__(self, path: str = None):
+        self.path = path
+        self.entries = dict()
+        self.lock = threading.Lock()
+
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def baud(self, name: str, default=None):
+        """the baud rate to open a port at"""
+        with self.lock:
+            return self.entries.get(name, dict()).get('baud') or default
+
+    def tuner(self, name: str, baud=None) -> LinkTuner:
+        """a tuner for a port starting from its profile, baud is the rate it was opened at"""
+        with self.lock:
+            entry = self.entries.get(name, dict())
+        tuner = LinkTuner(entry.get('window', 4), entry.get('payload'), baud, name, self)
+        tuner.srtt = entry.get('srtt')
+        tuner.clean = entry.get('clean', 0)
+        tuner.transfers = entry.get('transfers', 0)
+        tuner.fixed = entry.get('fixed', False)
+
+        return tuner
+
+    def store(self, tuner: LinkTuner):
+        with self.lock:
+            self.entries[tuner.name] = tuner.to_dict()
+            self._save()
+
+    def _save(self):
+        if not self.path:
+            return
+
+        write_atomic(self.path, json.dumps(self.entries, indent=1, sort_keys=True))
@@ -0,0 +1,128 @@
+"""
+Upload manager.  Keeps an index of the content hash of every file uploaded to each printer
+so a file the sd card already holds is not sent again, and an upload that was cut off part
+way through continues from where it stopped instead of starting over.
+
+The card has no way to report a hash so the index is the record of what was written: a
+file is skipped when the index has it complete with the same hash and the card still lists
+it with the size it had after the upload.  An interrupted upload is resumed when the index
+has it incomplete with the same hash.  Every byte the card lists was confirmed, so the
+upload restarts at that offset, provided the firmware has the SD_RESUME capability and the
+bytes on the card are the bytes of the file.  That rules out preprocessing and, since line
+mode drops carriage returns, comments and blank lines, line mode uploads of files with any
+of those before the offset.
+"""
+
+import os
+import json
+import hashlib
+import logging
+import threading
+
+from atomic import write_atomic
+from gcode import strip_comments
+from stream import BLOCK_SIZE
+
+
+def file_hash(path: str, block_size: int = BLOCK_SIZE) -> tuple:
+    """sha256 hex digest of a file and whether it contains any carriage returns"""
+    digest = hashlib.sha256()
+    has_cr = False
+    with open(path, 'rb') as f:
+        while chunk := f.read(block_size):
+            digest.update(chunk)
+            has_cr = has_cr or b'\r' in chunk
+
+    return digest.hexdigest(), has_cr
+
+
+class HashIndex:
+    """content hashes of the files on each printer, kept in a json file if path is given.
+    safe to share between the upload threads of several printers"""
+
+    def __init__(self, path: str = None):
+        self.path = path
+        self.entries = dict()
+        self.lock = threading.Lock()
+
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def get(self, printer: str, filename: str) -> dict:
+        with self.lock:
+            return self.entries.get(printer, dict()).get(filename)
+
+    def set(self, printer: str, filename: str, entry: dict):
+        with self.lock:
+            self.entries.setdefault(printer, dict())[filename] = entry
+            self._save()
+
+    def _save(self):
+        if not self.path:
+            return
+
+        write_atomic(self.path, json.dumps(self.entries, indent=1, sort_keys=True))
+
+
+class UploadManager:
+    """upload files to one printer through a MarlinClient, skipping and resuming by content
+    hash"""
+
+    def __init__(self, client, name: str, index: HashIndex):
+        self.client = client
+        self.name = name
+        self.index = index
+
+    def _resume_offset(self, path: str, mode: str, stored: int, size: int) -> int:
+        """bytes of an interrupted upload that can be kept, 0 to start over"""
+        if not stored or stored >= size or not self.client.can_resume():
+            return 0
+
+        if mode != 'binary':
+            # text uploads are written a line at a time, the card has to end on a line
+            with open(path, 'rb') as f:
+                f.seek(stored - 1)
+                if f.read(1) != b'\n':
+                    return 0
+                f.seek(0)
+                while mode == 'line' and f.tell() < stored:
+                    line = f.readline()
+                    if not line[:-1] or strip_comments(line) != line[:-1]:
+                        return 0
+
+        return stored
+
+    def upload(self, path: str, filename: str = None, mode: str = 'line', preprocess=None,
+               **kwargs) -> tuple:
+        """upload the file at path unless the printer already has it.  returns 'skipped',
+        'resumed' or 'uploaded' and the bytes of the file sent, less than its size if
+        resumed.  other arguments are passed on to MarlinClient.save_file"""
+        filename = filename or os.path.basename(path)
+        digest, has_cr = file_hash(path)
+        size = os.path.getsize(path)
+        entry = self.index.get(self.name, filename)
+        stored = self.client.list_sd_card().get(filename)
+
+        offset = 0
+        if entry and entry['hash'] == digest and stored is not None:
+            if entry['complete'] and stored == entry['size']:
+                logging.info(f'{self.name}: {filename} is up to date')
+                return 'skipped', 0
+            if not entry['complete'] and not preprocess and not has_cr:
+                offset = self._resume_offset(path, mode, stored, size)
+
+        self.index.set(self.name, filename, {'hash': digest, 'complete': False})
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            self.client.save_file(filename, f, mode=mode, preprocess=preprocess,
+                                  offset=offset, **kwargs)
+            sent = f.tell() - offset
+
+        stored = self.client.list_sd_card().get(filename)
+        self.index.set(self.name, filename, {'hash': digest, 'complete': True, 'size': stored})
+        if offset:
+            logging.info(f'{self.name}: {filename} resumed at byte {offset}')
+            return 'resumed', sent
+
+        return 'uploaded', sent